@@ -2,20 +2,25 @@
 import re
 import os
 import sys
+import inspect
+import functools
+import asyncio
 import logging
 import atexit
+import time
 
-from typing import Dict
+from typing import Callable, Dict, List, Optional
 from telebot import TeleBot
 from telebot.types import Message, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton
 
 from musbot import setup, database
-from musbot.tracks import Track, TrackPool, button_events
-from musbot.track_loader import load_tracks
-from musbot.track_processor import download_process_and_send_track
+from musbot.tracks import Track, TrackPool, TRACK_POOL_LOADING
+from musbot.track_loader import load_tracks, SearchResults, SEARCH_PROGRESSIVE
+from musbot.search_cache import SEARCH_CACHE, SEARCH_CACHE_TTL, SEARCH_CACHE_PERSISTENT
+from musbot.track_processor import enqueue_track
 from musbot.actions import Action, ChooseAction, NO_ACTION, ACTION_BY_BUTTON_MESSAGE
-from musbot.util import get_request_title_and_author, wrap_try_except,\
-		format_last_ex_info, KEYBOARD_REMOVE
+from musbot.util import get_request_title_and_author, wrap_try_except, wrap_try_except_async,\
+		format_last_ex_info, format_stats, register_stats, run_steps, run_steps_async, call, Steps, KEYBOARD_REMOVE
 
 
 START_MESSAGE = '''
@@ -72,59 +77,165 @@ class UserState:
 		return state
 
 
-def main() -> None:
-	database.init()
+ADMIN_ID = int(os.environ.get('ADMIN_ID'))
+ADMIN_PWD = os.environ.get('ADMIN_PWD')
+
+COMMAND_REGEX = re.compile(r'^/\w+\s*')
+
+logger = logging.getLogger('root')
+
+
+def is_admin(message: Message) -> bool:
+	return message.from_user.id == ADMIN_ID
+
+
+def create_change_track_keyboard() -> ReplyKeyboardMarkup:
+	keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
+	keyboard.add(
+		*[KeyboardButton(msg) for msg in ACTION_BY_BUTTON_MESSAGE],
+		row_width=2
+	)
+
+	return keyboard
+
 
-	ADMIN_ID = int(os.environ.get('ADMIN_ID'))
-	ADMIN_PWD = os.environ.get('ADMIN_PWD')
-	bot = TeleBot(os.environ.get('BOT_TOKEN'))
+def cleanup_state() -> None:
+	""" Записывает несохранённые пулы треков и закрывает соединения с БД. Вызывается при выходе и по /stop """
+	try:
+		TrackPool.close()
+	finally:
+		database.cleanup()
+
+
+def init_state(callbacks: List[TrackPool.Callback]) -> None:
+	""" Загружает сохранённое состояние и регистрирует его сохранение при выходе """
+
+	start = time.monotonic()
+
+	if TRACK_POOL_LOADING == 'eager':
+		track_pools = database.deserialize_track_pools(callbacks)
+	else:
+		track_pools = {}
+
+	last_id, last_keynum = database.get_last_track_pool_ids()
+	Track.reserve_keynums(last_keynum)
+	TrackPool.init(track_pools, last_id)
+
+	duration = time.monotonic() - start
+	track_count = sum(len(pool) for pool in track_pools.values())
+	startup_stats = f'{TRACK_POOL_LOADING} loading of {len(track_pools)} track pools '\
+					f'and {track_count} tracks took {duration:.4f} sec'
 	
+	logger.info(f'Startup: {startup_stats}')
+	register_stats('Startup', lambda: startup_stats)
+
+	TrackPool.set_storage(
+		functools.partial(database.load_track_pool, callbacks),
+		database.save_track_pools,
+		database.delete_track_pool
+	)
+
+	if SEARCH_CACHE_PERSISTENT:
+		database.delete_expired_search_pages(SEARCH_CACHE_TTL)
+		SEARCH_CACHE.set_storage(database.load_search_page, database.save_search_page)
+ 
+	atexit.register(cleanup_state)
+
+
+def register_handlers(bot, action_bot: TeleBot) -> List[TrackPool.Callback]:
+	"""
+	Регистрирует обработчики в синхронном (TeleBot) или асинхронном (AsyncTeleBot) боте
+	и возвращает обработчики кнопок треков для init_state. action_bot - синхронный бот
+	для действий над треками, у синхронного бота это он сам.
+	"""
+
+	is_async = inspect.iscoroutinefunction(bot.send_message)
+
+	if is_async:
+		from musbot import aio
+
+		run = run_steps_async
+		wrap = wrap_try_except_async(bot)
+		search = aio.load_tracks
+
+		# Блокирующий код (БД, действия над треками) выполняется в отдельном потоке
+		blocking = aio.run_blocking
+		
+		def process_track(track: Track, chat_id: int, user_id: int):
+			return aio.download_process_and_send_track(track, bot, chat_id)
+
+	else:
+		run = run_steps
+		wrap = wrap_try_except(bot)
+		search = load_tracks
+
+		blocking = call
+		
+		def process_track(track: Track, chat_id: int, user_id: int):
+			enqueue_track(track, bot, chat_id, user_id)
+
+
+	def handler(body: Callable[..., Steps[None]]):
+		""" Превращает тело обработчика (шаги, см. util.Steps) в обработчик бота """
+
+		if is_async:
+			async def wrapper(arg):
+				await run_steps_async(body(arg))
+		else:
+			def wrapper(arg):
+				run_steps(body(arg))
+		
+		return wrap(wrapper)
+
 
 	# ----------------------------------------- Commands ------------------------------------------
 
 	@bot.message_handler(commands=['start'])
-	@wrap_try_except(bot)
-	def start(message: Message) -> None:
-		bot.send_message(message.chat.id, START_MESSAGE, parse_mode='HTML')
+	@handler
+	def start(message: Message):
+		yield bot.send_message(message.chat.id, START_MESSAGE, parse_mode='HTML')
 
 
 	@bot.message_handler(commands=['stop'])
-	@wrap_try_except(bot)
+	@handler
 	def stop(message: Message):
 		if message.from_user.id == ADMIN_ID:
-			database.cleanup()
+			cleanup_state()
 			sys.exit(0)
 
+		# Тело обработчика должно быть генератором
+		yield
+
 
 	@bot.message_handler(commands=['filteron'])
-	@wrap_try_except(bot)
+	@handler
 	def filteron(message: Message):
 		UserState.get(message.from_user.id).disable_filter = False
-		bot.send_message(message.chat.id, 'Фильтр включен')
+		yield bot.send_message(message.chat.id, 'Фильтр включен')
 
 
 	@bot.message_handler(commands=['filteroff'])
-	@wrap_try_except(bot)
+	@handler
 	def filteroff(message: Message):
 		UserState.get(message.from_user.id).disable_filter = True
-		bot.send_message(message.chat.id, 'Фильтр отключен')
+		yield bot.send_message(message.chat.id, 'Фильтр отключен')
 	
 
 	@bot.message_handler(commands=['cancel'])
-	@wrap_try_except(bot)
+	@handler
 	def cancel(message: Message):
 		UserState.get(message.from_user.id).current_action = NO_ACTION
-		bot.send_message(message.chat.id, 'Отменено', reply_markup=KEYBOARD_REMOVE)
+		yield bot.send_message(message.chat.id, 'Отменено', reply_markup=KEYBOARD_REMOVE)
 
 
 	# -------------------------------------- Hidden commands --------------------------------------
 	
 	@bot.message_handler(commands=['diag'])
-	@wrap_try_except(bot)
+	@handler
 	def diagnostics(message: Message):
 		trace = format_last_ex_info()
 
-		bot.send_message(
+		yield bot.send_message(
 			message.chat.id,
 			f'```\n{trace}\n```' if trace else 'Ошибок нет',
 			parse_mode='MarkdownV2'
@@ -133,76 +244,72 @@ def main() -> None:
 
 	pwd_request = False
 
-	def is_admin(message: Message):
-		return message.from_user.id == ADMIN_ID
+	@bot.message_handler(commands=['stats'], func=is_admin)
+	@handler
+	def stats(message: Message):
+		yield bot.send_message(message.chat.id, format_stats())
 
 	@bot.message_handler(commands=['shutdown'], func=is_admin)
-	@wrap_try_except(bot)
+	@handler
 	def shutdown(message: Message):
 		nonlocal pwd_request
 		pwd_request = True
-		bot.send_message(message.chat.id, 'Подтвердите пароль', reply_markup=KEYBOARD_REMOVE)
+		yield bot.send_message(message.chat.id, 'Подтвердите пароль', reply_markup=KEYBOARD_REMOVE)
 	
 	@bot.message_handler(func=lambda message: pwd_request and is_admin(message))
-	@wrap_try_except(bot)
+	@handler
 	def handle_admin_pwd(message: Message):
 		nonlocal pwd_request
 		pwd_request = False
 
 		if message.text == ADMIN_PWD:
-			bot.send_message(message.chat.id, 'Выключение...', reply_markup=KEYBOARD_REMOVE)
-			database.cleanup()
+			yield bot.send_message(message.chat.id, 'Выключение...', reply_markup=KEYBOARD_REMOVE)
+			cleanup_state()
 			os.system("systemctl poweroff")
 			sys.exit(0)
 		else:
-			bot.send_message(message.chat.id, 'Пароль неверен', reply_markup=KEYBOARD_REMOVE)
+			yield bot.send_message(message.chat.id, 'Пароль неверен', reply_markup=KEYBOARD_REMOVE)
 
 
 	# ------------------------------------------- /list -------------------------------------------
-	
-	COMMAND_REGEX = re.compile(r'^/\w+\s*')
-
 
 	@bot.message_handler(commands=['list'])
-	@wrap_try_except(bot)
+	@handler
 	def track_list(message: Message):
 		_, title, author = get_request_title_and_author(re.sub(COMMAND_REGEX, '', message.text))
 		user_id = message.from_user.id
 
-		tracks = database.get_track_list(user_id, title, author)
+		tracks = yield blocking(database.get_track_list, user_id, title, author)
 		pool = TrackPool(user_id=user_id, tracks=tracks, callback=change_track)
-		pool.print(bot, message.chat.id)
+		yield pool.print(bot, message.chat.id)
 	
 
-	# Вызывается при клике на кнопку с треком
-	def change_track(track: Track, bot: TeleBot, chat_id: int, user_id: int):
-		keyboard = ReplyKeyboardMarkup(resize_keyboard=True)
-		keyboard.add(
-			*[KeyboardButton(msg) for msg in ACTION_BY_BUTTON_MESSAGE],
-			row_width=2
-		)
-
-		bot.send_message(chat_id, 'Что вы хотите сделать с треком?', reply_markup=keyboard)
-		UserState.get(user_id).current_action = ChooseAction(track)
+	# Вызывается при клике на кнопку с треком. Имя функции сохраняется в БД вместе с пулом
+	def change_track(track: Track, bot, chat_id: int, user_id: int):
+		def body():
+			keyboard = create_change_track_keyboard()
+			yield bot.send_message(chat_id, 'Что вы хотите сделать с треком?', reply_markup=keyboard)
+			UserState.get(user_id).current_action = ChooseAction(track)
+		
+		return run(body())
 	
 
 	def action_filter(message: Message):
 		return UserState.get(message.from_user.id).current_action.filter(message)
 
 	@bot.message_handler(func=action_filter)
-	@wrap_try_except(bot)
+	@handler
 	def handle_action(message: Message):
 		state = UserState.get(message.from_user.id)
-		state.current_action = state.current_action.handle_message(message, bot)
+		state.current_action = yield blocking(state.current_action.handle_message, message, action_bot)
 
 
 	# ----------------------------------------- messages ------------------------------------------
 
-
 	@bot.message_handler()
-	@wrap_try_except(bot)
-	def handle_message(message: Message) -> None:
-		database.add_or_update_user(message.from_user)
+	@handler
+	def handle_message(message: Message):
+		yield blocking(database.add_or_update_user, message.from_user)
 		
 		request, title, author = get_request_title_and_author(message.text)
 		user_id = message.from_user.id
@@ -211,48 +318,133 @@ def main() -> None:
 			title = None
 			author = None
 		
-		tracks = load_tracks(request, title, author)
-		database.set_ids(user_id, tracks)
+		chat_id = message.chat.id
+		pool: Optional[TrackPool] = None
+
+		# Первые найденные треки отправляются сразу, остальные дописываются в то же сообщение.
+		# Список треков строится, только когда сообщение пора изменить
+		def show(get_tracks: Callable[[], List[Track]], final: bool = False):
+			nonlocal pool
+
+			if pool is not None and not final and not pool.is_update_due():
+				return
+			
+			tracks = get_tracks()
+			yield blocking(database.set_ids, user_id, tracks)
+
+			if pool is None:
+				pool = TrackPool(user_id=user_id, tracks=tracks, callback=on_track_clicked)
+				yield pool.print(bot, chat_id)
+			else:
+				yield pool.update(bot, chat_id, tracks, final)
+		
+		def on_update(results: SearchResults):
+			return run(show(results.get_tracks))
+		
+		tracks = yield search(request, title, author, on_update=on_update if SEARCH_PROGRESSIVE else None)
+		yield from show(lambda: tracks, final=True)
+
+
+	def on_track_clicked(track: Track, bot, chat_id: int, user_id: int):
+		def body():
+			if track.id is None:
+				track.id = yield blocking(database.add_or_update_track, user_id, track)
+				yield process_track(track, chat_id, user_id)
+			else:
+				yield blocking(database.add_or_update_track, user_id, track)
+				yield change_track(track, bot, chat_id, user_id)
+		
+		return run(body())
+	
 
-		pool = TrackPool(user_id=user_id, tracks=tracks, callback=on_track_clicked)
-		pool.print(bot, message.chat.id)
+	@bot.callback_query_handler(func=lambda _: True)
+	@handler
+	def handle_callback(query: CallbackQuery):
+		chat_id = query.message.chat.id
 
+		# Выгруженный пул загружается из БД
+		callback = yield blocking(TrackPool.get_handler, query.data)
 
-	def on_track_clicked(track: Track, bot: TeleBot, chat_id: int, user_id: int):
-		if track.id is None:
-			track.id = database.add_or_update_track(user_id, track)
-			download_process_and_send_track(track, bot, chat_id)
-		else:
-			database.add_or_update_track(user_id, track)
-			change_track(track, bot, chat_id, user_id)
-	
+		if callback is not None:
+			yield callback(bot, chat_id, query.from_user.id)
 
 
-	@bot.callback_query_handler(func=lambda _: True)
-	@wrap_try_except(bot)
-	def handle_callback(query: CallbackQuery) -> None:
-		chat_id = query.message.chat.id
-		handler = button_events.get(query.data)
+	return [change_track, on_track_clicked]
 
-		if handler is not None:
-			handler(bot, chat_id, query.from_user.id)
 
+def create_bot(threaded: bool = True) -> TeleBot:
+	"""
+	Создаёт бота, который обрабатывает сообщения синхронно.
+	threaded - обрабатывать ли сообщения в потоках telebot. В режиме вебхука
+	потоками управляет сервер вебхука, поэтому там передаётся False.
+	"""
 
-	# ------------------------------------------- start -------------------------------------------
- 
-	TrackPool.init(database.deserialize_track_pools([change_track, on_track_clicked]))
- 
-	def cleanup():
-		database.serialize_track_pools(TrackPool.get_track_pools())
-		database.cleanup()
+	bot = TeleBot(os.environ.get('BOT_TOKEN'), threaded=threaded)
+	init_state(register_handlers(bot, bot))
+	return bot
 
-	atexit.register(cleanup)
- 
-	logger = logging.getLogger('root')
-	logger.info('Bot successfully started')
 
-	bot.infinity_polling()
-	
+def create_async_bot():
+	"""
+	Создаёт асинхронного бота на AsyncTeleBot. Поиск, скачивание и отправка треков выполняются
+	в цикле событий, блокирующий код (БД, действия над треками) - в отдельном потоке.
+	"""
+
+	from telebot.async_telebot import AsyncTeleBot
+
+	bot = AsyncTeleBot(os.environ.get('BOT_TOKEN'))
+
+	# Действия над треками синхронные, поэтому им нужен синхронный бот для отправки сообщений
+	sync_bot = TeleBot(os.environ.get('BOT_TOKEN'))
+
+	init_state(register_handlers(bot, sync_bot))
+	return bot
+
+
+async def run_async_bot(bot) -> None:
+	from musbot import aio
+
+	try:
+		await bot.infinity_polling()
+	finally:
+		await aio.close_session()
+
+
+def run_webhook(bot: TeleBot) -> None:
+	""" Принимает обновления через встроенный сервер вебхука вместо long polling """
+
+	from musbot.webhook import WebhookServer, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_WORKERS
+
+	server = WebhookServer(bot.process_new_updates)
+
+	if WEBHOOK_URL:
+		bot.remove_webhook()
+		bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET, max_connections=WEBHOOK_WORKERS)
+
+	logger.info(f'Bot successfully started in webhook mode on {server.server_address}')
+
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+
+def main() -> None:
+	database.init()
+
+	if '--async' in sys.argv[1:]:
+		bot = create_async_bot()
+		logger.info('Bot successfully started in async mode')
+		asyncio.run(run_async_bot(bot))
+
+	elif '--webhook' in sys.argv[1:]:
+		run_webhook(create_bot(threaded=False))
+
+	else:
+		bot = create_bot()
+		logger.info('Bot successfully started')
+		bot.infinity_polling()
+
 
 
 if __name__ == '__main__':
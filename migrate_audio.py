@@ -0,0 +1,31 @@
+#!/bin/python3
+"""
+Добавляет в общее хранилище файлы треков, скачанных до его появления.
+Одинаковые файлы разных пользователей при этом заменяются ссылками на один файл.
+Можно запускать повторно: обрабатываются только треки, которые ещё не в хранилище.
+"""
+
+import os
+
+from musbot import database, file_manager, audio_store
+
+
+def main():
+	database.init()
+
+	tracks = database.get_tracks_without_audio()
+	stored = 0
+
+	for track in tracks:
+		if not os.path.exists(file_manager.get_track_path(track)):
+			continue
+
+		audio_store.store(track)
+		stored += 1
+
+	print(f'Stored {stored} of {len(tracks)} tracks')
+	database.cleanup()
+
+
+if __name__ == '__main__':
+	main()
@@ -1,3 +1,3 @@
-__all__ = ['setup', 'tracks', 'track_loader', 'track_processor', 'file_manager', 'database', 'util']
+__all__ = ['setup', 'tracks', 'http_client', 'search_cache', 'authors', 'probe', 'track_loader', 'jobs', 'transcoder', 'track_processor', 'file_manager', 'database', 'audio_store', 'util']
 
-from . import setup, tracks, track_loader, track_processor, file_manager, database, util
\ No newline at end of file
+from . import setup, tracks, http_client, search_cache, authors, probe, track_loader, jobs, transcoder, track_processor, file_manager, database, audio_store, util
\ No newline at end of file
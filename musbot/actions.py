@@ -2,9 +2,9 @@ from abc import abstractmethod
 from typing import Dict, Type
 from telebot import TeleBot, types
 
-from . import database, file_manager
+from . import database, audio_store
 from .tracks import Track
-from .track_processor import send_track
+from .track_processor import enqueue_send_track
 from .util  import KEYBOARD_REMOVE
 
 class Action:
@@ -70,7 +70,7 @@ class EditAction(Action):
 			self._edit_value(message.text)
 
 			database.update_track(self.track)
-			file_manager.update_track(self.track, old_track)
+			audio_store.update_track(self.track, old_track)
 
 			bot.send_message(message.chat.id, 'Трек изменён', reply_markup=KEYBOARD_REMOVE)
 			return NO_ACTION
@@ -111,7 +111,7 @@ class DownloadTrackAction(Action):
 		super().__init__(track)
 
 	def handle_message(self, message: types.Message, bot: TeleBot) -> Action:
-		send_track(self.track, bot, message.chat.id)
+		enqueue_send_track(self.track, bot, message.chat.id, message.from_user.id)
 		return NO_ACTION
 
 
@@ -133,8 +133,7 @@ class DeleteTrackAction(Action):
 		
 		answer = message.text.lower().strip()
 		if answer == 'да' or answer == 'yes':
-			database.delete_track(self.track)
-			file_manager.delete_track(self.track)
+			audio_store.delete_track(self.track)
 			bot.send_message(message.chat.id, 'Трек удалён', reply_markup=KEYBOARD_REMOVE)
 		else:
 			bot.send_message(message.chat.id, 'Отменено', reply_markup=KEYBOARD_REMOVE)
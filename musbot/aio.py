@@ -0,0 +1,258 @@
+"""
+Асинхронные версии поиска, скачивания и обработки треков для запуска бота с флагом --async.
+HTTP-запросы выполняются через aiohttp, ffmpeg запускается как асинхронный подпроцесс.
+"""
+
+import asyncio
+import logging
+import functools
+import aiohttp
+
+from concurrent.futures import ThreadPoolExecutor
+from telebot.asyncio_helper import ApiTelegramException
+from typing import List, Dict, Set, Tuple, Optional, Callable, Awaitable, Iterable, TypeVar
+
+from .tracks import Track
+from .track_loader import SEARCH_MAX_RESULTS, SimpleTrackSource, Page, UpdateCallback, load_tracks_steps
+from .track_processor import DOWNLOAD_CHUNK_SIZE, TrackIO, download_and_process_steps,\
+		send_track_steps
+from .http_client import HTTP_POOL_HOSTS, HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT,\
+		HTTP_RETRIES, HTTP_BACKOFF
+from . import transcoder
+from .database import DB_POOL_MAX
+from .util import HEADERS, KEYBOARD_REMOVE, run_steps_async
+
+logger = logging.getLogger('root')
+
+T = TypeVar('T')
+
+
+# ------------------------------------------ Блокирующий код ------------------------------------------
+
+# psycopg2 и остальной синхронный код. Каждый вызов берёт своё соединение из пула БД,
+# поэтому потоков столько же, сколько соединений
+_blocking_executor = ThreadPoolExecutor(DB_POOL_MAX, thread_name_prefix='blocking')
+
+async def run_blocking(func: Callable[..., T], *args) -> T:
+	""" Выполняет блокирующую функцию в отдельном потоке, не блокируя цикл событий """
+	return await asyncio.get_running_loop().run_in_executor(_blocking_executor, functools.partial(func, *args))
+
+
+# ------------------------------------------------ HTTP -----------------------------------------------
+
+_session: Optional[aiohttp.ClientSession] = None
+
+def get_session() -> aiohttp.ClientSession:
+	""" Возвращает общую сессию aiohttp. Должна вызываться внутри цикла событий. """
+
+	global _session
+
+	if _session is None:
+		connector = aiohttp.TCPConnector(limit=HTTP_POOL_HOSTS * HTTP_POOL_SIZE, limit_per_host=HTTP_POOL_SIZE)
+		timeout = aiohttp.ClientTimeout(sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+		_session = aiohttp.ClientSession(connector=connector, timeout=timeout, headers=HEADERS)
+
+	return _session
+
+
+async def close_session() -> None:
+	global _session
+
+	if _session is not None:
+		await _session.close()
+		_session = None
+
+
+# Статусы, при которых запрос повторяется
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+async def get(url: str) -> aiohttp.ClientResponse:
+	"""
+	Выполняет GET-запрос с повторными попытками, как http_client.get.
+	Ответ нужно закрыть через async with.
+	"""
+
+	for trying in range(HTTP_RETRIES + 1):
+		last_try = trying == HTTP_RETRIES
+
+		try:
+			response = await get_session().get(url)
+		except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+			if last_try: raise
+		else:
+			if response.status not in _RETRY_STATUSES or last_try:
+				return response
+
+			response.release()
+
+		await asyncio.sleep(HTTP_BACKOFF * 2 ** trying)
+
+
+# ------------------------------------------------ Поиск ----------------------------------------------
+
+# Ограничивают число одновременных запросов к каждому сайту
+_source_semaphores: Dict[int, asyncio.Semaphore] = {}
+
+def _get_semaphore(source: SimpleTrackSource) -> asyncio.Semaphore:
+	semaphore = _source_semaphores.get(id(source))
+
+	if semaphore is None:
+		semaphore = _source_semaphores[id(source)] = asyncio.Semaphore(source.max_connections)
+
+	return semaphore
+
+
+async def _fetch(source: SimpleTrackSource, url: str) -> Tuple[int, str]:
+	async with _get_semaphore(source):
+		async with await get(url) as response:
+			return response.status, await response.text()
+
+
+async def _load_page(source: SimpleTrackSource, url: str, request: str,
+					 req_title: Optional[str], req_author: Optional[str]) -> Optional[Page]:
+	""" Асинхронная версия SimpleTrackSource.load_page """
+
+	fetch = lambda url: _fetch(source, url)
+	return await run_steps_async(source.load_page_steps(url, request, req_title, req_author, fetch, run_blocking))
+
+
+def _submit(source: SimpleTrackSource, url: str, request: str,
+			req_title: Optional[str], req_author: Optional[str]) -> asyncio.Task:
+	return asyncio.ensure_future(_load_page(source, url, request, req_title, req_author))
+
+
+def _wait(tasks: Iterable[asyncio.Task], timeout: float) -> Awaitable[Tuple[Set[asyncio.Task], Set[asyncio.Task]]]:
+	return asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+
+async def load_tracks(request: str, req_title: Optional[str], req_author: Optional[str],
+					  max_results: int = SEARCH_MAX_RESULTS, on_update: Optional[UpdateCallback] = None) -> List[Track]:
+	"""
+	Асинхронная версия track_loader.load_tracks. Отменённые загрузки страниц прерываются сразу,
+	а не после ответа сайта
+	"""
+
+	steps = load_tracks_steps(request, req_title, req_author, max_results, on_update, _submit, _wait)
+	return await run_steps_async(steps)
+
+
+# ------------------------------------------ Обработка треков -----------------------------------------
+
+_transcode_semaphore: Optional[asyncio.Semaphore] = None
+
+def _get_transcode_semaphore() -> asyncio.Semaphore:
+	global _transcode_semaphore
+
+	if _transcode_semaphore is None:
+		_transcode_semaphore = asyncio.Semaphore(transcoder.TRANSCODE_CONCURRENCY)
+
+	return _transcode_semaphore
+
+
+async def _run_process(*args: str, timeout: Optional[float] = None) -> bytes:
+	"""
+	Запускает процесс с приоритетом FFMPEG_NICE и возвращает его stdout.
+	При ненулевом коде возврата выбрасывает RuntimeError, при превышении timeout - TimeoutError.
+	"""
+
+	process = await asyncio.create_subprocess_exec(
+		*args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+	)
+
+	transcoder.renice(process.pid)
+
+	try:
+		stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+	except asyncio.TimeoutError:
+		process.kill()
+		await process.wait()
+		raise TimeoutError(f'{args[0]} exceeded {timeout} seconds')
+
+	if process.returncode != 0:
+		raise RuntimeError(f'{args[0]} exited with code {process.returncode}: {stderr.decode(errors="replace")}')
+
+	return stdout
+
+
+# Процесс ffmpeg и задача, читающая его stderr
+_Ffmpeg = Tuple[asyncio.subprocess.Process, 'asyncio.Future[bytes]']
+
+class AsyncTrackIO(TrackIO):
+	""" Ввод-вывод шагов track_processor через aiohttp и асинхронные подпроцессы. Методы возвращают корутины """
+
+	api_error = ApiTelegramException
+	connection_error = aiohttp.ClientConnectionError
+
+	blocking = staticmethod(run_blocking)
+
+
+	def open(self, url: str) -> Awaitable[aiohttp.ClientResponse]:
+		return get(url)
+	
+	def get_status(self, response: aiohttp.ClientResponse) -> Tuple[int, Optional[int]]:
+		return response.status, response.content_length
+	
+	def read(self, response: aiohttp.ClientResponse) -> Awaitable[bytes]:
+		return response.content.read(DOWNLOAD_CHUNK_SIZE)
+	
+	def close(self, response: aiohttp.ClientResponse) -> None:
+		response.release()
+	
+
+	async def start_ffmpeg(self, args: List[str]) -> _Ffmpeg:
+		process = await asyncio.create_subprocess_exec(
+			*args, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+		)
+
+		transcoder.renice(process.pid)
+
+		# stderr читается параллельно, чтобы ffmpeg не остановился на заполненном канале
+		return process, asyncio.ensure_future(process.stderr.read())
+	
+	async def write(self, ffmpeg: _Ffmpeg, chunk: bytes) -> None:
+		process, _ = ffmpeg
+		process.stdin.write(chunk)
+		await process.stdin.drain()
+	
+	def kill(self, ffmpeg: _Ffmpeg) -> None:
+		try:
+			ffmpeg[0].kill()
+		except ProcessLookupError:
+			pass
+	
+	async def finish(self, ffmpeg: _Ffmpeg) -> Tuple[int, bytes]:
+		process, stderr = ffmpeg
+		process.stdin.close()
+		await process.wait()
+		return process.returncode, await stderr
+	
+
+	async def run_ffmpeg(self, args: List[str], job: transcoder.TranscodeJob) -> None:
+		async with _get_transcode_semaphore():
+			with job:
+				await _run_process(*args, timeout=transcoder.TRANSCODE_TIMEOUT)
+
+
+async def send_track(track: Track, bot, chat_id: int) -> None:
+	""" Асинхронная версия track_processor.send_track """
+	await run_steps_async(send_track_steps(track, AsyncTrackIO(bot), chat_id))
+
+
+async def download_process_and_send_track(track: Track, bot, chat_id: int) -> None:
+	""" Скачивает, обрабатывает и отправляет трек """
+
+	message_id = (await bot.send_message(chat_id, 'Скачиваю файл...', reply_markup=KEYBOARD_REMOVE)).id
+	io = AsyncTrackIO(bot)
+
+	try:
+		# При ошибке скачивания сообщение уже удалено, а пользователь уведомлён
+		if not await run_steps_async(download_and_process_steps(track, io, chat_id, message_id)):
+			return
+
+		await run_steps_async(send_track_steps(track, io, chat_id))
+
+	except Exception:
+		await bot.delete_message(chat_id, message_id)
+		raise
+
+	await bot.delete_message(chat_id, message_id)
@@ -0,0 +1,109 @@
+"""
+Общее хранилище аудиофайлов для всех пользователей. Файл трека DB/<id трека> - жёсткая ссылка
+на файл audio/<sha256>, поэтому трек, который уже кто-то скачал, не скачивается и не сжимается
+повторно, а одинаковые файлы занимают место на диске один раз. Симлинки с именами треков
+по-прежнему указывают на файлы треков.
+
+Записи audio_files считают треки, которые ссылаются на файл. Файл хранилища удаляется,
+когда на него не остаётся ссылок. Если пользователь меняет метаданные общего файла,
+его трек получает собственную копию и отвязывается от хранилища.
+"""
+
+import logging
+import threading
+
+from typing import Tuple, Optional
+
+from . import database, file_manager
+from .tracks import Track
+from .util import register_stats
+
+logger = logging.getLogger('root')
+
+
+class _StoreStats:
+	def __init__(self) -> None:
+		self.linked = 0
+		self.stored = 0
+		self.deduplicated = 0
+		self.unshared = 0
+		self.deleted = 0
+		self.lock = threading.Lock()
+
+	def add(self, name: str) -> None:
+		with self.lock:
+			setattr(self, name, getattr(self, name) + 1)
+
+	def format(self) -> str:
+		return (f'linked: {self.linked}, stored: {self.stored}, deduplicated: {self.deduplicated}, '
+				f'unshared: {self.unshared}, deleted: {self.deleted}')
+
+
+_stats = _StoreStats()
+register_stats('Audio store', _stats.format)
+
+
+def _delete_orphan(sha256: Optional[str]) -> None:
+	if sha256 is not None:
+		file_manager.delete_audio(sha256)
+		_stats.add('deleted')
+
+
+def link_stored(track: Track) -> bool:
+	"""
+	Если файл по ссылке трека уже есть в хранилище, делает файл трека ссылкой на него.
+	Возвращает False, если трек нужно скачать.
+	"""
+
+	sha256 = database.acquire_audio(track.id, track.url)
+	if sha256 is None: return False
+
+	if not file_manager.link_audio(track, sha256):
+		logger.warning(f'Stored file {sha256} of track {track.id} is missing')
+		release(track)
+		return False
+
+	_stats.add('linked')
+	return True
+
+
+def store(track: Track, digest: Optional[Tuple[str, int]] = None) -> None:
+	"""
+	Добавляет скачанный и обработанный файл трека в хранилище.
+	digest - sha256 и размер файла, если они уже посчитаны
+	"""
+
+	sha256, size = digest if digest is not None else file_manager.hash_track(track)
+	_delete_orphan(database.store_audio(track.id, track.url, sha256, size))
+
+	_stats.add('stored' if file_manager.store_audio(track, sha256) else 'deduplicated')
+
+
+def update_track(track: Track, old_track: Optional[Track] = None) -> None:
+	"""
+	Обновляет метаданные файла трека, см. file_manager.update_track. Файл хранилища, на который
+	ссылается только этот трек, изменяется на месте и записывается в хранилище под новым sha256
+	"""
+
+	stored = track.id is not None and database.has_audio(track.id)
+	result = file_manager.update_track(track, old_track, own_links=2 if stored else 1)
+
+	if result == file_manager.TAGS_UNSHARED and track.id is not None:
+		release(track)
+		_stats.add('unshared')
+	
+	elif result == file_manager.TAGS_UPDATED and stored:
+		store(track)
+
+
+def release(track: Track) -> None:
+	""" Отвязывает трек от файла хранилища """
+	_delete_orphan(database.release_audio(track.id))
+
+
+def delete_track(track: Track) -> None:
+	""" Удаляет трек из БД, его файл и симлинк, а также файл хранилища, если на него больше нет ссылок """
+
+	sha256 = database.delete_track(track)
+	file_manager.delete_track(track)
+	_delete_orphan(sha256)
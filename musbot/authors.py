@@ -0,0 +1,178 @@
+"""
+Нормализация имён авторов: единое написание соавторов ("feat.", разделители)
+и известных авторов. Таблица авторов компилируется в одно регулярное выражение,
+а результаты кэшируются для каждой исходной строки.
+"""
+
+import os
+import re
+import logging
+import threading
+
+from functools import lru_cache
+from typing import List, Tuple, Optional
+
+logger = logging.getLogger('root')
+
+# Файл с дополнительными авторами. Каждая строка - имя автора или "псевдоним => автор",
+# строки, начинающиеся с #, пропускаются. Файл перечитывается при изменении без перезапуска бота
+AUTHORS_FILE = os.environ.get('AUTHORS_FILE') or None
+
+# Число исходных строк, для которых кэшируется результат нормализации
+AUTHOR_CACHE_SIZE = int(os.environ.get('AUTHOR_CACHE_SIZE', 10000))
+
+
+AUTHORS = [
+	'9Lana',
+	'Ado',
+	'Alan Walker',
+	'Alba Sera',
+	'Amala',
+	'Chiyo',
+	'DECO*27',
+	'Futakuchi Mana',
+	'GUMI',
+	'Harmony Team',
+	'HaruWei',
+	'Hatsune Miku',
+	'Kasane Teto',
+	'Megurine Luka',
+	'higanbanban',
+	'Narea',
+	'Hiiragi Magnetite',
+	'Hinomori Shizuku',
+	'Jackie-O & Sati Akura',
+	'Jinja',
+	'Kagamine Rin',
+	'Kusuriya no Hitorigoto',
+	'[Labor of Love] Hoski',
+	'LIQ',
+	'LiuVerdea',
+	'May\'n',
+	'Megurine Luka',
+	'Melody Note',
+	'Miku',
+	'Neoni',
+	'Noisia',
+	'Onsa Media',
+	'Planya Ch',
+	'Reoni',
+	'Nyami',
+	'Sati Akura',
+	'SAWTOWNE',
+	'SE[L] EI',
+	'Utsu-P',
+	'Vocaloid',
+	'WEDNESDAY CAMPANELLA',
+	'Yuyoyuppe',
+	'Zephyrianna',
+	'ZHIEND',
+	'ZUTOMAYO',
+	'Ёлка',
+]
+
+# Псевдонимы с учётом регистра: (регулярное выражение, автор)
+AUTHOR_ALIASES = [
+	(r'\b黒うさp\b', 'Kurousa-P'),
+	(r'\bplanya channel\b', 'Planya Ch'),
+]
+
+FEAT_REGEX = re.compile(r'(\w) (?: feat|ft)\. (\w)', re.X)
+FEAT_REPL = r'\1 feat. \2'
+
+SEPARATOR_REGEX = re.compile(r'(\w) (?: \s*[,&]\s* | \s+x\s+) (\w)', re.X)
+SEPARATOR_REPL = r'\1, \2'
+
+
+# Запись таблицы: (регулярное выражение без групп захвата, замена, без учёта регистра)
+NormEntry = Tuple[str, str, bool]
+
+class AuthorNormalizer:
+	"""
+	Заменяет все записи таблицы за один проход одним регулярным выражением.
+	Каждая запись - отдельная группа, поэтому замена определяется по номеру сработавшей группы.
+	"""
+
+	def __init__(self, table: List[NormEntry]) -> None:
+		# При совпадении в одной позиции выигрывает первая альтернатива, поэтому длинные идут первыми
+		table = sorted(table, key=lambda entry: len(entry[0]), reverse=True)
+
+		self.table = table
+		self.replacements = [replacement for _, replacement, _ in table]
+		self.regex = re.compile('|'.join(
+			f'((?i:{pattern}))' if ignorecase else f'({pattern})' for pattern, _, ignorecase in table
+		))
+
+		self.normalize = lru_cache(AUTHOR_CACHE_SIZE)(self.__normalize)
+	
+
+	def __replace(self, match: re.Match) -> str:
+		return self.replacements[match.lastindex - 1]
+
+
+	def __normalize(self, author: str) -> str:
+		author = FEAT_REGEX.sub(FEAT_REPL, author)
+		author = SEPARATOR_REGEX.sub(SEPARATOR_REPL, author)
+		return self.regex.sub(self.__replace, author)
+
+
+def _author_entry(author: str) -> NormEntry:
+	return rf'\b{re.escape(author)}\b', author, True
+
+
+def _default_table() -> List[NormEntry]:
+	table = [_author_entry(author) for author in dict.fromkeys(AUTHORS)]
+	table.extend((pattern, author, False) for pattern, author in AUTHOR_ALIASES)
+	return table
+
+
+def _read_table(path: str) -> List[NormEntry]:
+	""" Читает файл авторов """
+
+	table: List[NormEntry] = []
+
+	with open(path, encoding='utf-8') as file:
+		for line in file:
+			line = line.strip()
+			if len(line) == 0 or line.startswith('#'): continue
+
+			alias, sep, author = line.partition('=>')
+
+			if sep:
+				table.append((rf'\b{re.escape(alias.strip())}\b', author.strip(), True))
+			else:
+				table.append(_author_entry(line))
+	
+	return table
+
+
+_normalizer = AuthorNormalizer(_default_table())
+_file_mtime: Optional[float] = None
+_lock = threading.Lock()
+
+def get_author_normalizer() -> AuthorNormalizer:
+	""" Возвращает нормализатор. Если файл авторов изменился, перечитывает его """
+
+	global _normalizer, _file_mtime
+
+	if AUTHORS_FILE is None:
+		return _normalizer
+
+	try:
+		mtime = os.stat(AUTHORS_FILE).st_mtime
+	except OSError as ex:
+		if _file_mtime is not None:
+			logger.warning(f'Cannot read authors file: {ex}')
+		return _normalizer
+
+	with _lock:
+		if mtime != _file_mtime:
+			try:
+				_normalizer = AuthorNormalizer(_default_table() + _read_table(AUTHORS_FILE))
+				logger.info(f'Authors file {AUTHORS_FILE} loaded, {len(_normalizer.table)} entries')
+			except (OSError, ValueError, re.error) as ex:
+				logger.warning(f'Cannot load authors file {AUTHORS_FILE}', exc_info=ex)
+			
+			_file_mtime = mtime
+	
+	return _normalizer
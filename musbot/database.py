@@ -1,18 +1,164 @@
+import io
 import os
+import csv
+import time
 import psycopg2
 import logging
+import threading
 
+from contextlib import contextmanager
+from psycopg2.extensions import connection as Connection, cursor as Cursor
+from psycopg2.extras import Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from telebot.types import User
-from typing import List, Dict, Optional
+from typing import List, Dict, Tuple, Iterator, Sequence, Optional
 
 from .tracks import Track, TrackPool
+from .search_cache import CachedPage, CacheKey
+from .probe import AudioInfo
+from .util import register_stats
 
 logger = logging.getLogger('root')
 
+# Минимальное и максимальное число соединений в пуле
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+
+# Изменённые имена пользователей записываются в БД пачками: когда их накопится USER_FLUSH_SIZE
+# или с последней записи пройдёт USER_FLUSH_INTERVAL секунд
+USER_FLUSH_SIZE = int(os.environ.get('USER_FLUSH_SIZE', 50))
+USER_FLUSH_INTERVAL = int(os.environ.get('USER_FLUSH_INTERVAL', 60))
+
+
+class _Connection(Connection):
+	""" Соединение, которое помнит, какие подготовленные запросы в нём созданы """
+
+	def __init__(self, *args, **kwargs) -> None:
+		super().__init__(*args, **kwargs)
+		self.prepared = set()
+
+
+class _QueryStats:
+	""" Число и время выполнения запросов по их названиям, а также занятость пула """
+
+	def __init__(self) -> None:
+		# Ключ: название запроса, значение: [число запросов, суммарное время, максимальное время]
+		self.queries: Dict[str, list] = {}
+		self.connections_in_use = 0
+		self.max_connections_in_use = 0
+		self.lock = threading.Lock()
+	
+	def add_query(self, name: str, duration: float) -> None:
+		with self.lock:
+			stats = self.queries.setdefault(name, [0, 0.0, 0.0])
+			stats[0] += 1
+			stats[1] += duration
+			stats[2] = max(stats[2], duration)
+	
+	def add_connection(self, delta: int) -> None:
+		with self.lock:
+			self.connections_in_use += delta
+			self.max_connections_in_use = max(self.max_connections_in_use, self.connections_in_use)
+	
+	def format(self) -> str:
+		lines = [f'connections in use: {self.connections_in_use}/{DB_POOL_MAX}, max: {self.max_connections_in_use}']
+
+		for name, (count, total, max_time) in sorted(self.queries.items()):
+			lines.append(f'  {name}: {count} queries, avg {total / count * 1000:.2f} ms, max {max_time * 1000:.2f} ms')
+
+		return '\n'.join(lines)
+
+
+_stats = _QueryStats()
+register_stats('Database', _stats.format)
+
+# Потоки, которым не хватило соединения, ждут, пока другие вернут соединения в пул
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+
+@contextmanager
+def _cursor(name: str, readonly: bool = False) -> Iterator[Cursor]:
+	"""
+	Берёт соединение из пула и возвращает новый курсор. По выходу из блока фиксирует транзакцию,
+	при исключении откатывает её. name - название запроса для статистики.
+	readonly - выполнить запрос в транзакции только для чтения.
+	"""
+
+	# getconn не ждёт свободного соединения, а бросает PoolError, поэтому очередь ограничивается семафором
+	_pool_slots.acquire()
+
+	try:
+		conn = _pool.getconn()
+	except BaseException:
+		_pool_slots.release()
+		raise
+
+	_stats.add_connection(1)
+	start = time.monotonic()
+
+	try:
+		with conn.cursor() as cur:
+			if readonly:
+				cur.execute("SET TRANSACTION READ ONLY")
+
+			yield cur
+
+		conn.commit()
+
+	except BaseException:
+		if not conn.closed:
+			conn.rollback()
+		raise
+
+	finally:
+		_stats.add_query(name, time.monotonic() - start)
+		_stats.add_connection(-1)
+		try:
+			_pool.putconn(conn, close=bool(conn.closed))
+		finally:
+			_pool_slots.release()
+
+
+# Подготовленные запросы для самых частых операций.
+# Ключ: название, значение: типы параметров и запрос
+_PREPARED_QUERIES = {
+	'add_or_update_user': ('BIGINT, VARCHAR', """
+		INSERT INTO users (id, name) VALUES ($1, $2)
+		ON CONFLICT (id) DO UPDATE SET name=EXCLUDED.name
+	"""),
+
+	'add_or_update_track': ('BIGINT, VARCHAR, VARCHAR, VARCHAR, SMALLINT', """
+		INSERT INTO tracks (user_id, url, title, author, duration)
+		VALUES ($1, $2, $3, $4, $5)
+		ON CONFLICT (user_id, url)
+		DO UPDATE SET title=EXCLUDED.title, author=EXCLUDED.author, duration=EXCLUDED.duration
+		RETURNING id
+	"""),
+
+	'set_ids': ('BIGINT, TEXT[]', """
+		SELECT id, url FROM tracks WHERE user_id=$1 AND url = ANY($2)
+	"""),
+}
+
+def _execute_prepared(cur: Cursor, name: str, args: Sequence) -> None:
+	""" Выполняет подготовленный запрос, при первом использовании в соединении подготавливает его """
+
+	conn = cur.connection
+
+	if name not in conn.prepared:
+		types, query = _PREPARED_QUERIES[name]
+		cur.execute(f"PREPARE {name} ({types}) AS {query}")
+		conn.prepared.add(name)
+	
+	cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(args))})", args)
+
+
 def init() -> None:
-	global connection, cursor
+	global _pool
 	
-	connection = psycopg2.connect(
+	_pool = ThreadedConnectionPool(
+		DB_POOL_MIN, DB_POOL_MAX,
+		connection_factory = _Connection,
 		dbname   = os.environ.get('DB_NAME'),
 		host     = os.environ.get('DB_HOST'),
 		port     = os.environ.get('DB_PORT'),
@@ -20,8 +166,11 @@ def init() -> None:
 		password = os.environ.get('DB_PASSWORD')
 	)
 
-	cursor = connection.cursor()
+	with _cursor('init') as cursor:
+		_create_tables(cursor)
+
 
+def _create_tables(cursor: Cursor) -> None:
 	# Основные таблицы
 	cursor.execute("""CREATE TABLE IF NOT EXISTS users (
 					id BIGINT PRIMARY KEY,
@@ -38,6 +187,29 @@ def init() -> None:
 						UNIQUE(user_id, url)
 					)""")
 
+	# Общее хранилище аудиофайлов. Файл хранится один раз для всех пользователей,
+	# refcount - число треков, которые на него ссылаются
+	cursor.execute("""CREATE TABLE IF NOT EXISTS audio_files (
+						id SERIAL PRIMARY KEY,
+						sha256 CHAR(64) NOT NULL UNIQUE,
+						size BIGINT NOT NULL,
+						refcount INT NOT NULL DEFAULT 0
+					)""")
+
+	# Ссылки, по которым скачаны файлы хранилища
+	cursor.execute("""CREATE TABLE IF NOT EXISTS audio_sources (
+						url VARCHAR(2048) PRIMARY KEY,
+						audio_id INT NOT NULL REFERENCES audio_files(id) ON DELETE CASCADE
+					)""")
+	
+	cursor.execute("CREATE INDEX IF NOT EXISTS audio_sources_audio_id_idx ON audio_sources(audio_id)")
+	cursor.execute("ALTER TABLE tracks ADD COLUMN IF NOT EXISTS audio_id INT REFERENCES audio_files(id)")
+
+	# Формат, битрейт и длительность файла трека, чтобы не определять их повторно
+	cursor.execute("""ALTER TABLE tracks ADD COLUMN IF NOT EXISTS bitrate INT,
+									  ADD COLUMN IF NOT EXISTS format_name VARCHAR(64),
+									  ADD COLUMN IF NOT EXISTS file_duration REAL""")
+
 	# Таблицы для сериализации
 	cursor.execute("""CREATE TABLE IF NOT EXISTS saved_track_pools (
 						id SERIAL PRIMARY KEY,
@@ -59,75 +231,349 @@ def init() -> None:
 	
  	# Для ускорения ON DELETE SET NULL
 	cursor.execute("CREATE INDEX IF NOT EXISTS saved_tracks_saved_id_idx ON saved_tracks(saved_id)")
-	
-	connection.commit()
+
+	# Порядок трека в пуле
+	cursor.execute("ALTER TABLE saved_tracks ADD COLUMN IF NOT EXISTS position INT")
+
+	# Идентификатор загруженного в телеграм файла трека, позволяет отправлять его повторно без загрузки
+	cursor.execute("ALTER TABLE tracks ADD COLUMN IF NOT EXISTS file_id VARCHAR(256)")
+
+	# Для сортировки списка треков пользователя
+	cursor.execute("""CREATE INDEX IF NOT EXISTS tracks_user_sort_idx
+					  ON tracks (user_id, (lower(author) COLLATE "C"), (lower(title) COLLATE "C"))""")
+
+	_create_search_indexes(cursor)
+
+	# Для загрузки выгруженных пулов по id пула или номеру трека
+	cursor.execute("CREATE INDEX IF NOT EXISTS saved_tracks_track_pool_id_idx ON saved_tracks(track_pool_id)")
+	cursor.execute("CREATE INDEX IF NOT EXISTS saved_tracks_keynum_idx ON saved_tracks(keynum)")
+
+	# Кэш страниц поиска
+	cursor.execute("""CREATE TABLE IF NOT EXISTS search_cache (
+						source VARCHAR(256) NOT NULL,
+						request VARCHAR(4096) NOT NULL,
+						url VARCHAR(8192) NOT NULL,
+						rows JSONB NOT NULL,
+						links JSONB NOT NULL,
+						created DOUBLE PRECISION NOT NULL,
+						PRIMARY KEY(source, request, url)
+					)""")
+
+
+def _create_search_indexes(cursor: Cursor) -> None:
+	"""
+	Триграммные индексы для поиска по подстроке в /list. btree_gin позволяет включить в индекс user_id.
+	Если расширения недоступны (нет прав), /list работает без индексов.
+	"""
+
+	cursor.execute("SAVEPOINT search_indexes")
+
+	try:
+		cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+		cursor.execute("CREATE EXTENSION IF NOT EXISTS btree_gin")
+	except psycopg2.Error as ex:
+		cursor.execute("ROLLBACK TO SAVEPOINT search_indexes")
+		logger.warning(f'Cannot create pg_trgm and btree_gin extensions, /list will not use indexes: {ex}')
+		return
+
+	cursor.execute("CREATE INDEX IF NOT EXISTS tracks_title_trgm_idx ON tracks USING gin (user_id, title gin_trgm_ops)")
+	cursor.execute("CREATE INDEX IF NOT EXISTS tracks_author_trgm_idx ON tracks USING gin (user_id, author gin_trgm_ops)")
+	cursor.execute("RELEASE SAVEPOINT search_indexes")
 
 
 def cleanup() -> None:
-	cursor.close()
-	connection.close()
+	if not _pool.closed:
+		flush_users()
+		_pool.closeall()
+
+
+class _UserCache:
+	"""
+	Известные пары (id пользователя, имя). Новые пользователи записываются в БД сразу,
+	так как на них ссылаются треки, а смена имени откладывается до следующего сброса.
+	"""
+
+	def __init__(self) -> None:
+		self.names: Dict[int, Optional[str]] = {}
+		self.pending: Dict[int, Optional[str]] = {}
+		self.last_flush = time.monotonic()
+		self.hits = 0
+		self.writes = 0
+		self.lock = threading.Lock()
+	
+	def format_stats(self) -> str:
+		return f'users: {len(self.names)}, pending: {len(self.pending)}, hits: {self.hits}, writes: {self.writes}'
+
+
+_users = _UserCache()
+register_stats('Users', _users.format_stats)
 
 
 def add_or_update_user(user: User) -> None:
-	cursor.execute("""INSERT INTO users (id, name) VALUES (%s, %s)
-					  ON CONFLICT (id) DO UPDATE SET name=EXCLUDED.name""",
-				   (user.id, user.username))
+	with _users.lock:
+		known = user.id in _users.names
+
+		if known:
+			if _users.names[user.id] == user.username:
+				_users.hits += 1
+				return
+
+			_users.names[user.id] = user.username
+			_users.pending[user.id] = user.username
+
+			flush = len(_users.pending) >= USER_FLUSH_SIZE or \
+					time.monotonic() - _users.last_flush >= USER_FLUSH_INTERVAL
 	
-	connection.commit()
+	if not known:
+		with _cursor('add_or_update_user') as cursor:
+			_execute_prepared(cursor, 'add_or_update_user', (user.id, user.username))
 
+		with _users.lock:
+			_users.names[user.id] = user.username
+			_users.writes += 1
+	
+	elif flush:
+		flush_users()
 
-def add_or_update_track(user_id: int, track: Track) -> int:
-	cursor.execute("""INSERT INTO tracks (user_id, url, title, author, duration)
-					  VALUES (%s, %s, %s, %s, %s)
-					  ON CONFLICT (user_id, url)
-					  DO UPDATE SET title=EXCLUDED.title, author=EXCLUDED.author, duration=EXCLUDED.duration
-       				  RETURNING id""",
-				   (user_id, track.url, track.title, track.author, track.duration))
+
+def flush_users() -> None:
+	""" Записывает в БД накопившиеся изменения имён пользователей """
+
+	with _users.lock:
+		pending = _users.pending
+		_users.pending = {}
+		_users.last_flush = time.monotonic()
 	
-	connection.commit()
-	return cursor.fetchone()[0]
+	if len(pending) == 0: return
+
+	try:
+		with _cursor('flush_users') as cursor:
+			execute_values(cursor, """INSERT INTO users (id, name) VALUES %s
+									  ON CONFLICT (id) DO UPDATE SET name=EXCLUDED.name""",
+						   list(pending.items()))
+	
+	except Exception:
+		# Возвращаем изменения в очередь, если их не перезаписали более новые
+		with _users.lock:
+			for user_id, name in pending.items():
+				_users.pending.setdefault(user_id, name)
+		raise
+	
+	with _users.lock:
+		_users.writes += len(pending)
+	
+	logger.debug(f'Flushed {len(pending)} users')
+
+
+def add_or_update_track(user_id: int, track: Track) -> int:
+	with _cursor('add_or_update_track') as cursor:
+		_execute_prepared(cursor, 'add_or_update_track',
+				(user_id, track.url, track.title, track.author, track.duration))
+
+		return cursor.fetchone()[0]
 
 
 def _escape_like_pattern(string: str) -> str:
-	return '%' + string.replace('=', '==').replace('%', '=%').replace('_', '=_') + '%'
+	""" Экранирует спецсимволы LIKE обратной косой чертой, её pg_trgm понимает без ESCAPE """
+	return '%' + string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
 
 
-def get_track_list(user_id: int, title: Optional[str], author: Optional[str]) -> List[Track]:
+def _track_list_query(user_id: int, title: Optional[str], author: Optional[str]) -> Tuple[str, list]:
 	query = "SELECT id, url, title, author, duration FROM tracks WHERE user_id = %s"
 	args = [user_id]
 	
+	# Подстроки ищутся по индексам tracks_title_trgm_idx и tracks_author_trgm_idx
 	if title is not None:
-		query += " AND title ILIKE %s ESCAPE '='"
+		query += " AND title ILIKE %s"
 		args.append(_escape_like_pattern(title))
 	
 	if author is not None:
-		query += " AND author ILIKE %s ESCAPE '='"
+		query += " AND author ILIKE %s"
 		args.append(_escape_like_pattern(author))
 	
-	query += " ORDER BY author, title DESC"
+	# Порядок близок к Track.sort_key, но lower() в SQL зависит от LC_CTYPE базы: при C/POSIX
+	# он не меняет кириллицу. Поэтому окончательно список сортируется в get_track_list,
+	# а почти отсортированный список Timsort сортирует за линейное время
+	query += """ ORDER BY lower(author) COLLATE "C", author COLLATE "C", lower(title) COLLATE "C", title COLLATE "C",
+						  duration, url COLLATE "C", id"""
 	
-	cursor.execute(query, args)
-	connection.commit()
+	return query, args
+
+
+def get_track_list(user_id: int, title: Optional[str], author: Optional[str]) -> List[Track]:
+	query, args = _track_list_query(user_id, title, author)
+
+	with _cursor('get_track_list', readonly=True) as cursor:
+		cursor.execute(query, args)
 	
-	tracks = list(map(
-		lambda row: Track(id=row[0], url=row[1], title=row[2], author=row[3], duration=row[4]),
-		cursor
-	))
+		tracks = list(map(
+			lambda row: Track(id=row[0], url=row[1], title=row[2], author=row[3], duration=row[4]),
+			cursor
+		))
 
-	tracks.sort()
+	tracks.sort(key=Track.sort_key)
 	return tracks
 
 
 def update_track(track: Track) -> None:
-	cursor.execute("UPDATE tracks SET url=%s, title=%s, author=%s, duration=%s WHERE id=%s",
-				   (track.url, track.title, track.author, track.duration, track.id))
+	# Метаданные файла меняются, поэтому загруженный в телеграм файл больше не подходит
+	with _cursor('update_track') as cursor:
+		cursor.execute("UPDATE tracks SET url=%s, title=%s, author=%s, duration=%s, file_id=NULL WHERE id=%s",
+					   (track.url, track.title, track.author, track.duration, track.id))
+
+
+def get_file_id(track_id: int) -> Optional[str]:
+	""" Возвращает идентификатор загруженного в телеграм файла трека """
+
+	with _cursor('get_file_id', readonly=True) as cursor:
+		cursor.execute("SELECT file_id FROM tracks WHERE id=%s", (track_id,))
+		row = cursor.fetchone()
+	
+	return row[0] if row is not None else None
+
+
+def set_file_id(track_id: int, file_id: Optional[str]) -> None:
+	with _cursor('set_file_id') as cursor:
+		cursor.execute("UPDATE tracks SET file_id=%s WHERE id=%s", (file_id, track_id))
+
+
+def has_audio(track_id: int) -> bool:
+	""" Проверяет, ссылается ли трек на файл общего хранилища """
 
-	connection.commit()
+	with _cursor('has_audio', readonly=True) as cursor:
+		cursor.execute("SELECT audio_id IS NOT NULL FROM tracks WHERE id=%s", (track_id,))
+		row = cursor.fetchone()
+	
+	return row is not None and row[0]
+
+
+def get_audio_info(track_id: int) -> Optional[AudioInfo]:
+	""" Возвращает сохранённые формат, битрейт и длительность файла трека """
+
+	with _cursor('get_audio_info', readonly=True) as cursor:
+		cursor.execute("SELECT bitrate, format_name, file_duration FROM tracks WHERE id=%s", (track_id,))
+		row = cursor.fetchone()
+	
+	return AudioInfo(*row) if row is not None and row[1] is not None else None
+
+
+def set_audio_info(track_id: int, info: AudioInfo) -> None:
+	with _cursor('set_audio_info') as cursor:
+		cursor.execute("UPDATE tracks SET bitrate=%s, format_name=%s, file_duration=%s WHERE id=%s",
+					   (info.bitrate, info.format_name, info.duration, track_id))
+
+
+def delete_track(track: Track) -> Optional[str]:
+	""" Удаляет трек. Возвращает sha256 файла хранилища, на который больше нет ссылок """
+
+	with _cursor('delete_track') as cursor:
+		cursor.execute("DELETE FROM tracks WHERE id=%s RETURNING audio_id", (track.id,))
+		row = cursor.fetchone()
+
+		return _release_audio(cursor, row[0]) if row is not None else None
+
+
+def _release_audio(cursor: Cursor, audio_id: Optional[int]) -> Optional[str]:
+	""" Уменьшает счётчик ссылок на файл. Возвращает sha256 файла, если ссылок не осталось, и удаляет запись о нём """
+
+	if audio_id is None:
+		return None
+
+	cursor.execute("UPDATE audio_files SET refcount = refcount - 1 WHERE id=%s RETURNING refcount, sha256", (audio_id,))
+	refcount, sha256 = cursor.fetchone()
+
+	if refcount > 0:
+		return None
+	
+	cursor.execute("DELETE FROM audio_files WHERE id=%s", (audio_id,))
+	return sha256
+
+
+def _set_track_audio(cursor: Cursor, track_id: int, audio_id: Optional[int]) -> Optional[str]:
+	""" Связывает трек с файлом хранилища. Возвращает sha256 прежнего файла, если на него больше нет ссылок """
+
+	cursor.execute("SELECT audio_id FROM tracks WHERE id=%s FOR UPDATE", (track_id,))
+	row = cursor.fetchone()
+
+	if row is None or row[0] == audio_id:
+		return None
+	
+	cursor.execute("UPDATE tracks SET audio_id=%s WHERE id=%s", (audio_id, track_id))
+
+	if audio_id is not None:
+		cursor.execute("UPDATE audio_files SET refcount = refcount + 1 WHERE id=%s", (audio_id,))
+	
+	return _release_audio(cursor, row[0])
+
+
+def acquire_audio(track_id: int, url: str) -> Optional[str]:
+	"""
+	Связывает трек с файлом хранилища, скачанным по той же ссылке.
+	Возвращает sha256 файла или None, если по этой ссылке ещё ничего не скачано
+	"""
+
+	with _cursor('acquire_audio') as cursor:
+		# Блокировка не даёт удалить запись о файле, пока на него добавляется ссылка
+		cursor.execute("""SELECT a.id, a.sha256 FROM audio_sources s JOIN audio_files a ON a.id = s.audio_id
+						  WHERE s.url=%s FOR UPDATE OF a""", (url,))
+		row = cursor.fetchone()
+
+		if row is None:
+			return None
+		
+		cursor.execute("SELECT audio_id FROM tracks WHERE id=%s", (track_id,))
+		track_row = cursor.fetchone()
+
+		# Трек уже связан с другим файлом, он не меняется
+		if track_row is not None and track_row[0] is not None and track_row[0] != row[0]:
+			return None
+		
+		_set_track_audio(cursor, track_id, row[0])
+		return row[1]
+
+
+def store_audio(track_id: int, url: str, sha256: str, size: int) -> Optional[str]:
+	"""
+	Добавляет файл трека в хранилище или связывает трек с уже сохранённым файлом с тем же sha256.
+	Возвращает sha256 прежнего файла трека, если на него больше нет ссылок
+	"""
+
+	with _cursor('store_audio') as cursor:
+		cursor.execute("""INSERT INTO audio_files (sha256, size) VALUES (%s, %s)
+						  ON CONFLICT (sha256) DO UPDATE SET size=EXCLUDED.size
+						  RETURNING id""", (sha256, size))
+		audio_id = cursor.fetchone()[0]
+
+		cursor.execute("""INSERT INTO audio_sources (url, audio_id) VALUES (%s, %s)
+						  ON CONFLICT (url) DO UPDATE SET audio_id=EXCLUDED.audio_id""", (url, audio_id))
+		
+		return _set_track_audio(cursor, track_id, audio_id)
+
+
+def release_audio(track_id: int) -> Optional[str]:
+	""" Отвязывает трек от файла хранилища. Возвращает sha256 файла, если на него больше нет ссылок """
+
+	with _cursor('release_audio') as cursor:
+		return _set_track_audio(cursor, track_id, None)
+
+
+def get_tracks_without_audio() -> List[Track]:
+	""" Возвращает треки всех пользователей, файлы которых ещё не добавлены в хранилище """
+	return get_all_tracks(without_audio=True)
+
+
+def get_all_tracks(without_audio: bool = False) -> List[Track]:
+	""" Возвращает треки всех пользователей """
+
+	query = "SELECT id, url, title, author, duration FROM tracks"
 
+	if without_audio:
+		query += " WHERE audio_id IS NULL"
 
-def delete_track(track: Track) -> None:
-	cursor.execute("DELETE FROM tracks WHERE id=%s", (track.id,))
-	connection.commit()
+	with _cursor('get_all_tracks', readonly=True) as cursor:
+		cursor.execute(query + " ORDER BY id")
+
+		return [Track(id=row[0], url=row[1], title=row[2], author=row[3], duration=row[4]) for row in cursor]
 
 
 def set_ids(user_id: int, tracks: List[Track]) -> None:
@@ -135,79 +581,182 @@ def set_ids(user_id: int, tracks: List[Track]) -> None:
 
 	if len(tracks) == 0: return
 
-	urls = tuple(track.url for track in tracks)
+	urls = [track.url for track in tracks]
  
-	cursor.execute("SELECT id, url FROM tracks WHERE user_id=%s AND url IN %s", (user_id, urls))
-	connection.commit()
+	with _cursor('set_ids', readonly=True) as cursor:
+		_execute_prepared(cursor, 'set_ids', (user_id, urls))
+		found_urls = { row[1]: row[0] for row in cursor }
 	
-	found_urls = { row[1]: row[0] for row in cursor }
 	for track in tracks:
 		track.id = found_urls.get(track.url, None)
 
 
-def _mogrify_saved_track(track: Track, pool: TrackPool) -> str:
-    return cursor.mogrify(
-			"(%s,%s,%s,%s,%s,%s,%s)",
-			(track.url, track.title, track.author, track.duration, track.id, track.keynum, pool.id)
-		).decode('utf-8')
+def load_search_page(key: CacheKey) -> Optional[Tuple[CachedPage, float]]:
+	""" Возвращает сохранённую страницу поиска и время её создания """
 
+	with _cursor('load_search_page', readonly=True) as cursor:
+		cursor.execute("SELECT rows, links, created FROM search_cache WHERE source=%s AND request=%s AND url=%s", key)
+		row = cursor.fetchone()
 
-def serialize_track_pools(track_pools: Dict[int, TrackPool]) -> None:
-	cursor.execute("DELETE FROM saved_tracks")
-	cursor.execute("DELETE FROM saved_track_pools")
-	connection.commit()
- 
+	if row is None:
+		return None
+	
+	return CachedPage([tuple(track_row) for track_row in row[0]], row[1]), row[2]
+
+
+def save_search_page(key: CacheKey, page: CachedPage) -> None:
+	with _cursor('save_search_page') as cursor:
+		cursor.execute("""INSERT INTO search_cache (source, request, url, rows, links, created)
+						  VALUES (%s, %s, %s, %s, %s, %s)
+						  ON CONFLICT (source, request, url)
+						  DO UPDATE SET rows=EXCLUDED.rows, links=EXCLUDED.links, created=EXCLUDED.created""",
+					   (*key, Json(page.rows), Json(page.links), time.time()))
+
+
+def delete_expired_search_pages(ttl: int) -> None:
+	with _cursor('delete_expired_search_pages') as cursor:
+		cursor.execute("DELETE FROM search_cache WHERE created < %s", (time.time() - ttl,))
+		logger.debug(f'Deleted {cursor.rowcount} expired search pages')
+
+
+def save_track_pools(track_pools: List[TrackPool]) -> None:
+	"""
+	Сохраняет новые пулы вместе с треками и обновляет страницу и сообщение уже сохранённых.
+	Треки сохранённых пулов перезаписываются, только если они изменились (TrackPool.tracks_changed).
+	"""
+
+	# Пул без сообщения не имеет кнопок, и сохранять его незачем
+	track_pools = [pool for pool in track_pools if pool.message_id is not None]
+	if len(track_pools) == 0: return
+
+	with _cursor('save_track_pools') as cursor:
+		args = b",".join(cursor.mogrify(
+				"(%s,%s,%s,%s,%s)",
+				(pool.id, pool.user_id, pool.message_id, pool.page, pool.callback.__name__)
+			) for pool in track_pools)
+		
+		# xmax = 0 только у вставленных, а не обновлённых строк
+		cursor.execute(b"""INSERT INTO saved_track_pools (id, user_id, message_id, page, callback) VALUES """ + args +
+					   b""" ON CONFLICT (id) DO UPDATE
+					   SET message_id=EXCLUDED.message_id, page=EXCLUDED.page, callback=EXCLUDED.callback
+					   RETURNING id, xmax = 0""")
+		
+		inserted = { row[0] for row in cursor if row[1] }
+		new_pools = [pool for pool in track_pools if pool.id in inserted]
+		changed_pools = [pool for pool in track_pools if pool.tracks_changed and pool.id not in inserted]
+
+		if len(changed_pools) > 0:
+			cursor.execute("DELETE FROM saved_tracks WHERE track_pool_id = ANY(%s)", ([pool.id for pool in changed_pools],))
 
-	args = b",".join(cursor.mogrify(
-     		"(%s,%s,%s,%s,%s)",
-			(pool.id, pool.user_id, pool.message_id, pool.page, pool.callback.__name__)
-		) for pool in track_pools.values())
+		track_count = _copy_saved_tracks(cursor, new_pools + changed_pools)
 	
-	if len(args) > 0:
-		cursor.execute(b"INSERT INTO saved_track_pools (id, user_id, message_id, page, callback) VALUES " + args)
+	for pool in track_pools:
+		pool.tracks_changed = False
+	
+	logger.debug(f'Saved {len(track_pools)} track pools ({len(new_pools)} new, {len(changed_pools)} changed) and {track_count} tracks')
+
+
+def _copy_saved_tracks(cursor: Cursor, track_pools: List[TrackPool]) -> int:
+	""" Загружает треки пулов через COPY. Ссылки на удалённые треки заменяются на NULL """
 
+	data = io.StringIO()
+	writer = csv.writer(data, quoting=csv.QUOTE_NONNUMERIC)
 	
-	args = ",".join(_mogrify_saved_track(track, pool) for pool in track_pools.values() for track in pool.tracks)
- 
-	if len(args) > 0:
-		fields = '(url, title, author, duration, saved_id, keynum, track_pool_id)'
+	for pool in track_pools:
+		for position, track in enumerate(pool.tracks):
+			writer.writerow((track.url, track.title, track.author, track.duration,
+							 track.id, track.keynum, pool.id, position))
+	
+	if data.tell() == 0:
+		return 0
+	
+	data.seek(0)
+	fields = '(url, title, author, duration, saved_id, keynum, track_pool_id, position)'
+
+	cursor.execute("CREATE TEMPORARY TABLE tmp_saved_tracks (LIKE saved_tracks) ON COMMIT DROP")
+	# csv.QUOTE_NONNUMERIC записывает None как "", а COPY читает его как пустую строку, а не NULL
+	cursor.copy_expert(f"COPY tmp_saved_tracks {fields} FROM STDIN WITH (FORMAT csv, FORCE_NULL (duration, saved_id))", data)
+	cursor.execute(f"""
+		INSERT INTO saved_tracks {fields}
+			SELECT tmp.url, tmp.title, tmp.author, tmp.duration,
+					CASE WHEN tracks.id IS NULL THEN NULL ELSE tmp.saved_id END,
+					tmp.keynum, tmp.track_pool_id, tmp.position
+			FROM tmp_saved_tracks AS tmp
+			LEFT JOIN tracks ON saved_id=tracks.id
+	""")
+
+	return cursor.rowcount
+
+
+def delete_track_pool(pool_id: int) -> None:
+	with _cursor('delete_track_pool') as cursor:
+		cursor.execute("DELETE FROM saved_tracks WHERE track_pool_id=%s", (pool_id,))
+		cursor.execute("DELETE FROM saved_track_pools WHERE id=%s", (pool_id,))
+
+
+# Треки сохранённых пулов. id трека берётся из tracks, как в set_ids: трек мог быть скачан
+# или удалён после записи пула, а saved_id при этом не перезаписывается
+_SAVED_TRACKS_QUERY = """
+	SELECT saved.url, saved.title, saved.author, saved.duration, tracks.id, saved.keynum, saved.track_pool_id
+	FROM saved_tracks AS saved
+	JOIN saved_track_pools AS pools ON pools.id = saved.track_pool_id
+	LEFT JOIN tracks ON tracks.user_id = pools.user_id AND tracks.url = saved.url
+"""
+
+
+def load_track_pool(callbacks: list, pool_id: Optional[int], keynum: Optional[int]) -> Optional[TrackPool]:
+	""" Загружает сохранённый пул по его id или по номеру одного из его треков """
+
+	callbacks_dict = { callback.__name__: callback for callback in callbacks }
+
+	with _cursor('load_track_pool', readonly=True) as cursor:
+		if pool_id is None:
+			cursor.execute("SELECT track_pool_id FROM saved_tracks WHERE keynum=%s LIMIT 1", (keynum,))
+			row = cursor.fetchone()
+			if row is None: return None
+			pool_id = row[0]
 		
-		cursor.execute(f"""
-			INSERT INTO saved_tracks {fields}
-				SELECT tmp.url, tmp.title, tmp.author, tmp.duration,
-    					CASE WHEN tracks.id IS NULL THEN NULL ELSE tmp.saved_id END,
-         				tmp.keynum, tmp.track_pool_id
-				FROM (VALUES {args}) AS tmp {fields}
-				LEFT JOIN tracks ON saved_id=tracks.id
-    	""")
-    
-	track_count = sum(1 for pool in track_pools.values() for track in pool.tracks)
-	logger.debug(f'Saved {len(track_pools)} track pools and {track_count} tracks')
+		cursor.execute("SELECT id, user_id, message_id, page, callback FROM saved_track_pools WHERE id=%s", (pool_id,))
+		row = cursor.fetchone()
+		if row is None: return None
 
-	connection.commit()
+		pool = TrackPool(id=row[0], user_id=row[1], message_id=row[2], page=row[3], callback=callbacks_dict[row[4]])
+
+		cursor.execute(_SAVED_TRACKS_QUERY + " WHERE saved.track_pool_id=%s ORDER BY saved.position", (pool_id,))
+
+		for row in cursor:
+			pool.add_track(Track(row[0], row[1], row[2], row[3], row[4], row[5]))
+	
+	return pool
+
+
+def get_last_track_pool_ids() -> Tuple[int, int]:
+	""" Возвращает наибольшие id сохранённого пула и номер сохранённого трека """
+
+	with _cursor('get_last_track_pool_ids', readonly=True) as cursor:
+		cursor.execute("""SELECT (SELECT COALESCE(MAX(id), 0) FROM saved_track_pools),
+								 (SELECT COALESCE(MAX(keynum), 0) FROM saved_tracks)""")
+		return cursor.fetchone()
 
 
 def deserialize_track_pools(callbacks: list) -> Dict[int, TrackPool]:
 	callbacks_dict = { callback.__name__: callback for callback in callbacks }
- 
-	cursor.execute("SELECT id, user_id, message_id, page, callback FROM saved_track_pools")
-	connection.commit()
- 
 	track_pools: Dict[int, TrackPool] = {}
+	track_count = 0
+ 
+	with _cursor('deserialize_track_pools', readonly=True) as cursor:
+		cursor.execute("SELECT id, user_id, message_id, page, callback FROM saved_track_pools")
 
-	for row in cursor:
-		track_pools[row[0]] = TrackPool(id=row[0], user_id=row[1], message_id=row[2], page=row[3], callback=callbacks_dict[row[4]])
+		for row in cursor:
+			track_pools[row[0]] = TrackPool(id=row[0], user_id=row[1], message_id=row[2], page=row[3], callback=callbacks_dict[row[4]])
 
 
-	cursor.execute("SELECT url, title, author, duration, saved_id, keynum, track_pool_id FROM saved_tracks")
-	connection.commit()
- 
-	track_count = 0
+		cursor.execute(_SAVED_TRACKS_QUERY + " ORDER BY saved.track_pool_id, saved.position")
 
-	for row in cursor:
-		track = Track(row[0], row[1], row[2], row[3], row[4], row[5])
-		track_pools[row[6]].add_track(track)
-		track_count += 1
+		for row in cursor:
+			track = Track(row[0], row[1], row[2], row[3], row[4], row[5])
+			track_pools[row[6]].add_track(track)
+			track_count += 1
 
 	logger.debug(f'Loaded {len(track_pools)} track pools and {track_count} tracks')
 	return track_pools
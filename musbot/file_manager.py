@@ -1,9 +1,13 @@
+import os
 import os.path
-import requests
+import shutil
+import hashlib
 import logging
+import tempfile
 
-from typing import Optional
+from typing import Tuple, Optional
 from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
 from .tracks import Track
 
 TRACKS_DIR = os.environ.get('TRACKS_DIR')
@@ -11,6 +15,11 @@ EXT = '.' + os.environ.get('TARGET_FORMAT')
 
 logger = logging.getLogger()
 
+# Результат update_track
+TAGS_UNCHANGED = 0  # метаданные уже совпадали
+TAGS_UPDATED   = 1  # файл изменён на месте
+TAGS_UNSHARED  = 2  # общий файл заменён копией с новыми метаданными
+
 
 def get_track_path(track: Track) -> str: 
 	if track.id is None:
@@ -18,6 +27,10 @@ def get_track_path(track: Track) -> str:
 
 	return os.path.join(TRACKS_DIR, 'DB', str(track.id) + EXT)
 
+def get_audio_path(sha256: str) -> str:
+	""" Путь к файлу в общем хранилище. Файлы треков - жёсткие ссылки на эти файлы """
+	return os.path.join(TRACKS_DIR, 'audio', sha256[:2], sha256 + EXT)
+
 def _get_symlink_path(track: Track) -> str:
 	return os.path.join(os.path.join(TRACKS_DIR, track.get_dirname(), track.get_filename() + EXT))
 
@@ -28,9 +41,45 @@ def _remove_if_exists(path: str) -> None:
 
 
 
-def save_file(track: Track, response: requests.Response) -> None:
-	with open(get_track_path(track), '+wb') as file:
-		file.write(response.content)
+class PendingFile:
+	"""
+	Временный файл рядом с path, который атомарно заменяет path при вызове commit.
+	Используется как контекстный менеджер: если commit не вызван, например при ошибке, временный файл удаляется.
+	max_size - максимальный размер в байтах для write, 0 - без ограничения.
+	"""
+
+	def __init__(self, path: str, suffix: str = '.part', max_size: int = 0) -> None:
+		self.path = path
+		self.max_size = max_size
+		self.size = 0
+		self.file = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix=suffix, delete=False)
+
+	@property
+	def name(self) -> str:
+		return self.file.name
+
+	def write(self, chunk: bytes) -> bool:
+		""" Дописывает кусок в файл. Возвращает False, если файл превысил max_size """
+
+		self.size += len(chunk)
+
+		if self.max_size > 0 and self.size > self.max_size:
+			logger.warning(f'File {self.path} exceeds {self.max_size} bytes, download aborted')
+			return False
+
+		self.file.write(chunk)
+		return True
+
+	def commit(self) -> None:
+		self.file.close()
+		os.replace(self.file.name, self.path)
+
+	def __enter__(self) -> 'PendingFile':
+		return self
+
+	def __exit__(self, *_) -> None:
+		self.file.close()
+		_remove_if_exists(self.file.name)
 
 
 def create_track_symlink(track: Track) -> str:
@@ -44,26 +93,122 @@ def create_track_symlink(track: Track) -> str:
 	return symlink_path
 
 
-def update_track(track: Track, old_track: Optional[Track] = None) -> None:
+def hash_track(track: Track) -> Tuple[str, int]:
+	""" Возвращает sha256 и размер файла трека """
+
+	sha256 = hashlib.sha256()
+	size = 0
+
+	with open(get_track_path(track), 'rb') as file:
+		for chunk in iter(lambda: file.read(1024 * 1024), b''):
+			sha256.update(chunk)
+			size += len(chunk)
+	
+	return sha256.hexdigest(), size
+
+
+def link_file(source: str, path: str) -> bool:
+	""" Атомарно заменяет файл path жёсткой ссылкой на source. Возвращает False, если source не существует """
+
+	tmp_path = path + '.link'
+
+	try:
+		os.link(source, tmp_path)
+	except FileNotFoundError:
+		return False
+	except FileExistsError:
+		os.remove(tmp_path)
+		os.link(source, tmp_path)
+	
+	os.replace(tmp_path, path)
+	return True
+
+
+def link_audio(track: Track, sha256: str) -> bool:
+	""" Заменяет файл трека жёсткой ссылкой на файл хранилища. Возвращает False, если файла в хранилище нет """
+	return link_file(get_audio_path(sha256), get_track_path(track))
+
+
+def store_audio(track: Track, sha256: str) -> bool:
+	"""
+	Добавляет файл трека в хранилище. Если файл с таким sha256 там уже есть,
+	файл трека заменяется ссылкой на него. Возвращает False в последнем случае.
+	"""
+
+	audio_path = get_audio_path(sha256)
+	os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+
+	try:
+		os.link(get_track_path(track), audio_path)
+		return True
+	except FileExistsError:
+		link_audio(track, sha256)
+		return False
+
+
+def delete_audio(sha256: str) -> None:
+	_remove_if_exists(get_audio_path(sha256))
+
+
+def _unshare(path: str) -> None:
+	""" Заменяет файл, на который есть другие жёсткие ссылки, его копией """
+
+	tmpfile = tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(path), suffix='.part', delete=False)
+
+	try:
+		with tmpfile, open(path, 'rb') as file:
+			shutil.copyfileobj(file, tmpfile)
+		
+		os.replace(tmpfile.name, path)
+	
+	except BaseException:
+		_remove_if_exists(tmpfile.name)
+		raise
+
+
+def _load_tags(path: str) -> EasyID3:
+	""" Читает теги файла. У файла без заголовка ID3 он будет создан при сохранении """
+	try:
+		return EasyID3(path)
+	except ID3NoHeaderError:
+		return EasyID3()
+
+
+def update_track(track: Track, old_track: Optional[Track] = None, own_links: int = 1) -> int:
 	"""
 	Обновляет метаданные в файле трека и создаёт симлинк, если его нет.
 	old_track - если не None, то удаляет симлинк для старого трека.
+	own_links - число жёстких ссылок на файл, при котором он принадлежит только этому треку:
+	2 для файла в хранилище (файл трека и файл хранилища).
+	Если файл общий с другими треками, а метаданные отличаются, то трек получает свою копию файла.
+	Возвращает TAGS_UNCHANGED, TAGS_UPDATED или TAGS_UNSHARED. В последнем случае трек нужно отвязать от хранилища.
 	"""
     
-	id3 = EasyID3(get_track_path(track))
-	id3.clear()
-	id3['title'] = track.title
-	id3['artist'] = track.author
-	id3.save()
+	path = get_track_path(track)
+	id3 = _load_tags(path)
+	result = TAGS_UNCHANGED
+
+	if id3.get('title') != [track.title] or id3.get('artist') != [track.author]:
+		if os.stat(path).st_nlink > own_links:
+			_unshare(path)
+			result = TAGS_UNSHARED
+		else:
+			result = TAGS_UPDATED
+
+		id3.clear()
+		id3['title'] = track.title
+		id3['artist'] = track.author
+		id3.save(path)
 
 	if old_track is not None:
 		_remove_if_exists(_get_symlink_path(old_track))
 	
 	create_track_symlink(track)
+	return result
 
 
 def delete_track(track: Track) -> None:
-	""" Удаляет файл трека и симлинк на него """
+	""" Удаляет файл трека и симлинк на него. Файл хранилища удаляется отдельно (delete_audio) """
     
 	_remove_if_exists(_get_symlink_path(track))
 	_remove_if_exists(get_track_path(track))
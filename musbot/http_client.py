@@ -0,0 +1,123 @@
+import os
+import logging
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from .util import HEADERS, register_stats
+
+logger = logging.getLogger('root')
+
+# Число хостов, для которых хранятся открытые соединения
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', 10))
+
+# Максимальное число открытых соединений с одним хостом
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+
+# Таймауты подключения и чтения в секундах
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+
+# Число повторных попыток и множитель задержки между ними
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+
+# Как часто писать статистику соединений в лог
+STATS_LOG_INTERVAL = 100
+
+
+class _Counters:
+	""" Считает запросы и новые соединения, чтобы оценить переиспользование соединений """
+
+	def __init__(self) -> None:
+		self.requests = 0
+		self.connections = 0
+		self.lock = threading.Lock()
+	
+	def add_request(self) -> int:
+		with self.lock:
+			self.requests += 1
+			return self.requests
+	
+	def add_connection(self) -> None:
+		with self.lock:
+			self.connections += 1
+	
+	def format(self) -> str:
+		reused = max(0, self.requests - self.connections)
+		ratio = reused / self.requests * 100 if self.requests > 0 else 0
+		return f'requests: {self.requests}, new connections: {self.connections} ({ratio:.1f}% reused)'
+
+
+_counters = _Counters()
+
+
+# Считаем именно установку соединений, так как urllib3 может переподключить закрытое соединение
+
+class _CountingHTTPConnection(HTTPConnection):
+	def connect(self) -> None:
+		_counters.add_connection()
+		super().connect()
+
+class _CountingHTTPSConnection(HTTPSConnection):
+	def connect(self) -> None:
+		_counters.add_connection()
+		super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+	ConnectionCls = _CountingHTTPConnection
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+	ConnectionCls = _CountingHTTPSConnection
+
+
+class _PoolingAdapter(HTTPAdapter):
+	def init_poolmanager(self, *args, **kwargs) -> None:
+		super().init_poolmanager(*args, **kwargs)
+		self.poolmanager.pool_classes_by_scheme = {
+			'http':  _CountingHTTPConnectionPool,
+			'https': _CountingHTTPSConnectionPool,
+		}
+
+
+def _on_response(response: requests.Response, *args, **kwargs) -> None:
+	if _counters.add_request() % STATS_LOG_INTERVAL == 0:
+		logger.debug(f'HTTP connections: {_counters.format()}')
+
+
+def _create_session() -> requests.Session:
+	retry = Retry(
+		total = HTTP_RETRIES,
+		backoff_factor = HTTP_BACKOFF,
+		status_forcelist = (429, 500, 502, 503, 504),
+		allowed_methods = frozenset(['GET', 'HEAD']),
+		raise_on_status = False,
+	)
+
+	adapter = _PoolingAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+	session = requests.Session()
+	session.headers.update(HEADERS)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	session.hooks['response'].append(_on_response)
+	return session
+
+
+# Общая сессия для всего бота. requests.Session потокобезопасна при использовании только get
+_session = _create_session()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+	""" Выполняет GET-запрос через общий пул соединений с таймаутами и повторными попытками """
+
+	kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+	return _session.get(url, **kwargs)
+
+
+register_stats('HTTP', _counters.format)
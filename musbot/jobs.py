@@ -0,0 +1,132 @@
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict, deque
+from typing import Deque, Callable
+
+from .util import register_stats
+
+logger = logging.getLogger('root')
+
+# Число потоков для скачивания и сжатия треков. ffmpeg работает в отдельном процессе,
+# поэтому потоки не упираются в GIL и нагружают все ядра
+PROCESS_THREADS = int(os.environ.get('PROCESS_THREADS', os.cpu_count() or 1))
+
+# Число потоков для отправки файлов в телеграм
+UPLOAD_THREADS = int(os.environ.get('UPLOAD_THREADS', 4))
+
+
+Job = Callable[[], None]
+
+class FairQueue:
+	"""
+	Потокобезопасная очередь задач с отдельной очередью для каждого пользователя.
+	Задачи выдаются по кругу между пользователями, поэтому пользователь с большим
+	числом задач не задерживает остальных.
+	"""
+
+	def __init__(self) -> None:
+		# Ключ: id пользователя, значение: очередь (время добавления, задача)
+		self.__queues: OrderedDict[int, Deque[tuple]] = OrderedDict()
+		self.__size = 0
+		self.__cond = threading.Condition()
+	
+	def put(self, user_id: int, job: Job) -> None:
+		with self.__cond:
+			self.__queues.setdefault(user_id, deque()).append((time.monotonic(), job))
+			self.__size += 1
+			self.__cond.notify()
+	
+	def get(self) -> tuple:
+		""" Ждёт и возвращает следующую задачу и время её добавления """
+
+		with self.__cond:
+			while self.__size == 0:
+				self.__cond.wait()
+			
+			user_id, queue = next(iter(self.__queues.items()))
+			added, job = queue.popleft()
+			self.__size -= 1
+
+			# Пользователь переходит в конец круга
+			if len(queue) > 0:
+				self.__queues.move_to_end(user_id)
+			else:
+				del self.__queues[user_id]
+			
+			return added, job
+	
+	def __len__(self) -> int:
+		return self.__size
+
+
+class JobPool:
+	""" Пул потоков, выполняющих задачи из FairQueue """
+
+	def __init__(self, name: str, workers: int) -> None:
+		self.name = name
+		self.workers = workers
+		self.active = 0
+		self.completed = 0
+		self.failed = 0
+		self.total_wait = 0.0
+
+		self.__queue = FairQueue()
+		self.__lock = threading.Lock()
+
+		for i in range(workers):
+			threading.Thread(target=self.__run, name=f'{name}-{i}', daemon=True).start()
+	
+
+	def submit(self, user_id: int, job: Job) -> None:
+		self.__queue.put(user_id, job)
+	
+	def pending(self) -> int:
+		""" Возвращает число задач, ожидающих свободного потока """
+		return len(self.__queue)
+	
+	def is_busy(self) -> bool:
+		return self.active + len(self.__queue) >= self.workers
+	
+
+	def __run(self) -> None:
+		while True:
+			added, job = self.__queue.get()
+
+			with self.__lock:
+				self.active += 1
+				self.total_wait += time.monotonic() - added
+
+			failed = False
+
+			try:
+				job()
+			except Exception as ex:
+				# Задачи сами сообщают пользователю об ошибках, здесь только логируем
+				logger.error(f'Job failed in pool {self.name}', exc_info=ex)
+				failed = True
+
+			with self.__lock:
+				self.active -= 1
+				self.completed += 1
+				self.failed += failed
+	
+
+	def format_stats(self) -> str:
+		started = self.completed + self.active
+		avg_wait = self.total_wait / started if started > 0 else 0
+
+		return f'active: {self.active}/{self.workers}, pending: {self.pending()}, ' +\
+			   f'completed: {self.completed}, failed: {self.failed}, avg wait: {avg_wait:.2f}s'
+
+
+# Скачивание и сжатие треков
+PROCESS_POOL = JobPool('process', PROCESS_THREADS)
+
+# Отправка файлов в телеграм
+UPLOAD_POOL = JobPool('upload', UPLOAD_THREADS)
+
+register_stats('Process pool', PROCESS_POOL.format_stats)
+register_stats('Upload pool', UPLOAD_POOL.format_stats)
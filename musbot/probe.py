@@ -0,0 +1,153 @@
+"""
+Определение формата, битрейта и длительности аудиофайлов. Заголовки читаются mutagen
+в текущем процессе, ffprobe запускается только для форматов, которые mutagen не распознал.
+"""
+
+import io
+import json
+import time
+import logging
+import threading
+import subprocess
+import mutagen
+
+from mutagen.mp3 import MP3
+from mutagen.flac import FLAC
+from mutagen.oggvorbis import OggVorbis
+from mutagen.oggopus import OggOpus
+from mutagen.wave import WAVE
+from mutagen.mp4 import MP4
+from typing import Optional, NamedTuple
+
+from .util import register_stats
+
+logger = logging.getLogger('root')
+
+# Названия форматов ffmpeg по классам mutagen
+FORMAT_NAMES = {
+	MP3:       'mp3',
+	FLAC:      'flac',
+	OggVorbis: 'ogg',
+	OggOpus:   'ogg',
+	WAVE:      'wav',
+	MP4:       'mov,mp4,m4a,3gp,3g2,mj2',
+}
+
+
+# Кодеки по классам mutagen. Для MP4 кодек определяется по info.codec
+CODEC_NAMES = {
+	MP3:       'mp3',
+	FLAC:      'flac',
+	OggVorbis: 'vorbis',
+	OggOpus:   'opus',
+	WAVE:      'pcm',
+}
+
+# Кодеки MP4 в обозначениях ffmpeg
+_MP4_CODECS = { 'mp4a.40.2': 'aac', 'mp4a.40.5': 'aac', 'mp4a.6B': 'mp3', 'mp4a.69': 'mp3', 'alac': 'alac' }
+
+
+class AudioInfo(NamedTuple):
+	"""
+	Битрейт в бит/с, название формата ffmpeg, длительность в секундах и название кодека ffmpeg.
+	None - значение неизвестно
+	"""
+
+	bitrate: Optional[int]
+	format_name: Optional[str]
+	duration: Optional[float]
+	codec: Optional[str] = None
+
+	def is_complete(self) -> bool:
+		return self.bitrate is not None and self.format_name is not None
+
+
+class _ProbeStats:
+	def __init__(self) -> None:
+		# Ключ: способ, значение: [число файлов, суммарное время]
+		self.methods = { 'mutagen': [0, 0.0], 'ffprobe': [0, 0.0] }
+		self.lock = threading.Lock()
+
+	def add(self, method: str, duration: float) -> None:
+		with self.lock:
+			stats = self.methods[method]
+			stats[0] += 1
+			stats[1] += duration
+
+	def format(self) -> str:
+		return ', '.join(
+			f'{method}: {count} files, avg {total / count * 1000:.2f} ms' if count > 0 else f'{method}: 0 files'
+			for method, (count, total) in self.methods.items()
+		)
+
+
+_stats = _ProbeStats()
+register_stats('Probe', _stats.format)
+
+
+def _mutagen_info(fileobj) -> AudioInfo:
+	try:
+		audio = mutagen.File(fileobj)
+	except Exception as ex:
+		logger.debug(f'Cannot probe file with mutagen: {ex}')
+		return AudioInfo(None, None, None, None)
+
+	if audio is None:
+		return AudioInfo(None, None, None, None)
+
+	if isinstance(audio, MP4):
+		codec = _MP4_CODECS.get(getattr(audio.info, 'codec', None))
+	else:
+		codec = CODEC_NAMES.get(type(audio))
+
+	return AudioInfo(
+		getattr(audio.info, 'bitrate', None) or None,
+		FORMAT_NAMES.get(type(audio)),
+		getattr(audio.info, 'length', None) or None,
+		codec
+	)
+
+
+def probe_head(head: bytes) -> AudioInfo:
+	""" Определяет формат и битрейт по началу файла. Длительность по началу файла может быть неточной """
+	return _mutagen_info(io.BytesIO(head))
+
+
+def _ffprobe(path: str) -> AudioInfo:
+	output = subprocess.run(
+		['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries',
+		 'format=bit_rate,format_name,duration:stream=codec_name', '-of', 'json', path],
+		capture_output=True, check=True
+	).stdout
+
+	result = json.loads(output)
+	info = result['format']
+	streams = result.get('streams') or [{}]
+
+	bitrate = info.get('bit_rate')
+	duration = info.get('duration')
+
+	return AudioInfo(
+		int(bitrate) if bitrate not in (None, 'N/A') else None,
+		info.get('format_name'),
+		float(duration) if duration not in (None, 'N/A') else None,
+		streams[0].get('codec_name')
+	)
+
+
+def probe_file(path: str) -> AudioInfo:
+	""" Определяет формат, битрейт и длительность файла. ffprobe запускается, только если mutagen не справился """
+
+	start = time.monotonic()
+
+	with open(path, 'rb') as file:
+		info = _mutagen_info(file)
+
+	if info.is_complete():
+		_stats.add('mutagen', time.monotonic() - start)
+		return info
+
+	start = time.monotonic()
+	info = _ffprobe(path)
+	_stats.add('ffprobe', time.monotonic() - start)
+	return info
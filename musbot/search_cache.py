@@ -0,0 +1,128 @@
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Callable, NamedTuple
+
+from .util import register_stats
+
+logger = logging.getLogger('root')
+
+# Время жизни записи кэша в секундах
+SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL', 3600))
+
+# Максимальное число страниц в кэше в памяти
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 1000))
+
+# Сохранять ли кэш в БД, чтобы он переживал перезапуск бота
+SEARCH_CACHE_PERSISTENT = os.environ.get('SEARCH_CACHE_PERSISTENT', '0') == '1'
+
+
+# Строка трека: url, название, автор, длительность
+TrackRow = Tuple[str, str, str, int]
+
+class CachedPage(NamedTuple):
+	""" Разобранная страница поиска без фильтрации по запросу """
+
+	rows: List[TrackRow]
+	links: List[str]
+
+
+# Ключ: (сайт, нормализованный запрос, url страницы)
+CacheKey = Tuple[str, str, str]
+
+Loader = Callable[[CacheKey], Optional[Tuple[CachedPage, float]]]
+Saver = Callable[[CacheKey, CachedPage], None]
+
+
+class SearchCache:
+	"""
+	LRU-кэш страниц поиска с ограниченным временем жизни.
+	Может дополнительно хранить страницы во внешнем хранилище (БД).
+	Потокобезопасен.
+	"""
+
+	def __init__(self, ttl: int, max_size: int) -> None:
+		self.ttl = ttl
+		self.max_size = max_size
+
+		self.hits = 0
+		self.persistent_hits = 0
+		self.misses = 0
+
+		# Значение: (страница, время создания)
+		self.__pages: OrderedDict[CacheKey, Tuple[CachedPage, float]] = OrderedDict()
+		self.__lock = threading.Lock()
+		self.__loader: Optional[Loader] = None
+		self.__saver: Optional[Saver] = None
+	
+
+	def set_storage(self, loader: Loader, saver: Saver) -> None:
+		""" Подключает внешнее хранилище. loader возвращает страницу и время её создания """
+		self.__loader = loader
+		self.__saver = saver
+	
+
+	def get(self, key: CacheKey) -> Optional[CachedPage]:
+		now = time.time()
+
+		with self.__lock:
+			entry = self.__pages.get(key)
+
+			if entry is not None:
+				if now - entry[1] < self.ttl:
+					self.__pages.move_to_end(key)
+					self.hits += 1
+					return entry[0]
+				
+				del self.__pages[key]
+		
+		if self.__loader is not None:
+			entry = self.__loader(key)
+
+			if entry is not None and now - entry[1] < self.ttl:
+				with self.__lock:
+					self.__put(key, entry)
+					self.persistent_hits += 1
+				
+				return entry[0]
+		
+		with self.__lock:
+			self.misses += 1
+		
+		return None
+	
+
+	def put(self, key: CacheKey, page: CachedPage) -> None:
+		with self.__lock:
+			self.__put(key, (page, time.time()))
+		
+		if self.__saver is not None:
+			self.__saver(key, page)
+	
+
+	def __put(self, key: CacheKey, entry: Tuple[CachedPage, float]) -> None:
+		self.__pages[key] = entry
+		self.__pages.move_to_end(key)
+
+		while len(self.__pages) > self.max_size:
+			self.__pages.popitem(last=False)
+	
+
+	def clear(self) -> None:
+		with self.__lock:
+			self.__pages.clear()
+	
+
+	def format_stats(self) -> str:
+		total = self.hits + self.persistent_hits + self.misses
+		ratio = (self.hits + self.persistent_hits) / total * 100 if total > 0 else 0
+
+		return f'pages: {len(self.__pages)}/{self.max_size}, hits: {self.hits}, ' +\
+			   f'persistent hits: {self.persistent_hits}, misses: {self.misses} ({ratio:.1f}% hit rate)'
+
+
+SEARCH_CACHE = SearchCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE)
+register_stats('Search cache', SEARCH_CACHE.format_stats)
@@ -1,14 +1,22 @@
 import urllib.parse
-import requests
+import heapq
+import threading
 import logging
+import time
+import os
 import re
 
 from abc import abstractmethod
-from bs4 import BeautifulSoup, Tag
-from typing import List, Dict, Optional, Callable
+from functools import lru_cache
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Dict, Set, Tuple, Optional, Callable, NamedTuple, Iterable, Awaitable, Any
 
+from . import http_client
 from .tracks import Track
-from .util import HEADERS, remove_scheme
+from .search_cache import SEARCH_CACHE, SEARCH_CACHE_PERSISTENT, CachedPage, TrackRow
+from .authors import get_author_normalizer
+from .util import remove_scheme, register_stats, run_steps, call, Steps
 
 # Удаляет '//', 'http://' и 'https://' в начале строки, если есть, и добавляет 'https://'
 HREF_REGEX = re.compile(r'^((https?:)?//)?')
@@ -20,38 +28,132 @@ TIME_REGEX = re.compile(f'^{TIME_GROUP}:{TIME_GROUP}(?::{TIME_GROUP})?$')
 
 WHITESPACE_REGEX = re.compile(r'\s+')
 
+# Число потоков, загружающих страницы поиска
+SEARCH_THREADS = int(os.environ.get('SEARCH_THREADS', 8))
+
+# Максимальное время поиска в секундах. Страницы, не загруженные за это время, пропускаются
+SEARCH_TIMEOUT = float(os.environ.get('SEARCH_TIMEOUT', 15))
+
+# Число найденных треков, после которого страницы пагинации больше не загружаются. 0 - без ограничения
+SEARCH_MAX_RESULTS = int(os.environ.get('SEARCH_MAX_RESULTS', 200))
+
+# Показывать результаты поиска по мере загрузки страниц: сообщение отправляется после первой
+# загруженной страницы с треками и дополняется остальными
+SEARCH_PROGRESSIVE = os.environ.get('SEARCH_PROGRESSIVE', '1') == '1'
+
 logger = logging.getLogger('root')
 
 
+class _SearchStats:
+	""" Время до первого результата и полное время поиска """
+
+	def __init__(self) -> None:
+		self.searches = 0
+		self.empty = 0
+		self.first_result_time = 0.0
+		self.total_time = 0.0
+		self.lock = threading.Lock()
+	
+	def add(self, first_result: Optional[float], total: float) -> None:
+		with self.lock:
+			self.searches += 1
+			self.total_time += total
+
+			if first_result is None:
+				self.empty += 1
+			else:
+				self.first_result_time += first_result
+	
+	def format(self) -> str:
+		if self.searches == 0:
+			return 'no searches'
+		
+		found = self.searches - self.empty
+		first = f'{self.first_result_time / found:.2f} s' if found > 0 else '-'
+		return (f'{self.searches} searches ({self.empty} empty), '
+				f'avg first result: {first}, avg total: {self.total_time / self.searches:.2f} s')
+
+
+SEARCH_STATS = _SearchStats()
+register_stats('Search', SEARCH_STATS.format)
+
+
+@lru_cache(256)
+def _compile_query(required: str) -> Tuple[str, ...]:
+	""" Разбивает запрос на слова в нижнем регистре. Вызывается один раз для каждого запроса """
+	return tuple(re.split(WHITESPACE_REGEX, required.lower()))
+
+
 def _matches(value: str, required: Optional[str]) -> bool:
 	"""
-	Проверяет, что val соответствует тому, что указано в req_val.
-	Если req_val равен None, то возвращает True
+	Проверяет, что value содержит все слова из required без учёта регистра.
+	Если required равен None, то возвращает True
 	"""
 
 	if required is None:
 		return True
 
 	value = value.lower()
-	required = required.lower()
+	return all(req in value for req in _compile_query(required))
+
+
+class Page(NamedTuple):
+	""" Результат загрузки одной страницы поиска """
+
+	tracks: List[Track]
 
-	reqs = re.split(WHITESPACE_REGEX, required)
-	return all(value.find(req) != -1 for req in reqs)
+	# Ссылки на остальные страницы поиска
+	links: List[str]
 
 
 class TrackSource:
 	@abstractmethod
-	def add_tracks(self, tracks: List[Track], request: str, req_title: Optional[str], req_author: Optional[str]) -> None:
-		""" Добавляет треки в итоговый список """
+	def get_search_url(self, request: str) -> str:
+		""" Возвращает ссылку на первую страницу поиска """
+
+	@abstractmethod
+	def load_page(self, url: str, request: str, req_title: Optional[str], req_author: Optional[str]) -> Optional[Page]:
+		"""
+		Загружает страницу поиска и возвращает совпадающие треки и ссылки на остальные страницы.
+		Возвращает None, если сервер вернул ошибку. Может вызываться из нескольких потоков.
+		"""
 
 
 Attrs = Dict[str, str]
 
+def _attrs_to_xpath(attrs: Attrs) -> str:
+	"""
+	Возвращает условие XPath, соответствующее поиску по атрибутам в BeautifulSoup:
+	class совпадает, если содержит указанный класс, остальные атрибуты сравниваются целиком
+	"""
+
+	conditions = []
+
+	for name, value in attrs.items():
+		if name == 'class':
+			conditions.append(f"[contains(concat(' ', normalize-space(@class), ' '), ' {value} ')]")
+		else:
+			conditions.append(f"[@{name}='{value}']")
+	
+	return ''.join(conditions)
+
+
+def _get_text(element: etree._Element) -> str:
+	""" Аналог Tag.get_text(strip=True) """
+	return ''.join(text.strip() for text in element.itertext())
+
+
 class SimpleTrackSource(TrackSource):
+	"""
+	Источник, страницы которого разбираются по атрибутам элементов.
+	Атрибуты при создании компилируются в выражения XPath, которые выполняются напрямую в lxml.
+	"""
+
 	def __init__(self, host: str, base: str,
 				 track_attrs: Attrs, link_attrs: Attrs, title_attrs: Attrs,
 				 author_attrs: Attrs, time_attrs: Attrs, pagination_attrs: Attrs,
-				 pagination_link_predicate: Callable[[Tag], bool]) -> None:
+				 pagination_link_predicate: Callable[[etree._Element], bool],
+				 max_connections: int = 4) -> None:
 		
 		self.host = host
 		self.base = base
@@ -62,54 +164,105 @@ class SimpleTrackSource(TrackSource):
 		self.time_attrs       = time_attrs
 		self.pagination_attrs = pagination_attrs
 		self.pagination_link_predicate = pagination_link_predicate
+
+		self.__track_xpath      = etree.XPath('//*' + _attrs_to_xpath(track_attrs))
+		self.__href_xpath       = etree.XPath('(.//a' + _attrs_to_xpath(link_attrs) + ')[1]/@href')
+		self.__title_xpath      = etree.XPath('(.//*' + _attrs_to_xpath(title_attrs) + ')[1]')
+		self.__author_xpath     = etree.XPath('(.//*' + _attrs_to_xpath(author_attrs) + ')[1]')
+		self.__time_xpath       = etree.XPath('(.//*' + _attrs_to_xpath(time_attrs) + ')[1]')
+		self.__pagination_xpath = etree.XPath('(//*' + _attrs_to_xpath(pagination_attrs) + ')[1]//a[@href]')
+
+		# Ограничивает число одновременных запросов к сайту
+		self.max_connections = max_connections
+		self.__semaphore = threading.BoundedSemaphore(max_connections)
 	
-	def __add_tracks_from_page(self, tracks: List[Track], req_title: Optional[str], req_author: Optional[str], url: str) -> Optional[BeautifulSoup]:
-		""" Добавляет совпадающие треки в переданный список. Возвращает страницу. """
 
-		response = requests.get(url, HEADERS)
+	def get_search_url(self, request: str) -> str:
+		return self.base + urllib.parse.quote(request, safe='')
+
+
+	def load_page(self, url: str, request: str, req_title: Optional[str], req_author: Optional[str]) -> Optional[Page]:
+		return run_steps(self.load_page_steps(url, request, req_title, req_author, self.__fetch, call))
+	
 
-		if not response.ok:
-			logger.warning(f'Server returned code {response.status_code} for GET {url}')
-			return None
+	def __fetch(self, url: str) -> Tuple[int, str]:
+		with self.__semaphore:
+			response = http_client.get(url)
 		
-		soup = BeautifulSoup(response.text, 'lxml')
+		return response.status_code, response.text
+	
 
-		for tag in soup.find_all(attrs=self.track_attrs):
-			href = re.sub(HREF_REGEX, HREF_REPL, tag.find('a', self.link_attrs)['href'])
+	def load_page_steps(self, url: str, request: str, req_title: Optional[str], req_author: Optional[str],
+						fetch: Callable[[str], Any], blocking: Callable[..., Any]) -> Steps[Optional[Page]]:
+		"""
+		Шаги load_page (см. util.Steps). fetch(url) загружает страницу и возвращает код ответа и текст,
+		blocking(func, *args) вызывает блокирующую функцию
+		"""
 
-			title = tag.find(attrs=self.title_attrs).get_text(strip=True)
-			if not _matches(title, req_title):
-				continue
+		key = (self.host, request, url)
 
-			author = tag.find(attrs=self.author_attrs).get_text(strip=True)
-			if not _matches(author, req_author):
-				continue
+		# Постоянный кэш обращается к БД
+		page = yield (blocking(SEARCH_CACHE.get, key) if SEARCH_CACHE_PERSISTENT else SEARCH_CACHE.get(key))
 
-			match = re.search(TIME_REGEX, tag.find(attrs=self.time_attrs).get_text(strip=True))
+		if page is None:
+			status, html = yield fetch(url)
 
-			if match is not None:
-				time = int(match.group(1)) * 60 + int(match.group(2))
+			if status >= 400:
+				logger.warning(f'Server returned code {status} for GET {url}')
+				return None
+			
+			page = self.parse_page(html)
+			yield (blocking(SEARCH_CACHE.put, key, page) if SEARCH_CACHE_PERSISTENT else SEARCH_CACHE.put(key, page))
+		
+		return self.filter_page(page, req_title, req_author)
+	
 
-				if match.group(3):
-					time = time * 60 + int(match.group(3))
-			else:
-				time = -1
+	def filter_page(self, page: CachedPage, req_title: Optional[str], req_author: Optional[str]) -> Page:
+		""" Создаёт треки из строк страницы, совпадающих с запросом """
+
+		tracks = [
+			Track(track_url, title, author, duration)
+			for track_url, title, author, duration in page.rows
+			if _matches(title, req_title) and _matches(author, req_author)
+		]
 
-			tracks.append(Track(remove_scheme(href), title, author, time))
+		return Page(tracks, page.links)
+	
 
+	def parse_page(self, html: str) -> CachedPage:
+		""" Разбирает страницу. Возвращает все треки на ней, без фильтрации """
+		
+		root = etree.HTML(html)
+		rows: List[TrackRow] = []
 
-	def add_tracks(self, tracks: List[Track], request: str, req_title: Optional[str], req_author: Optional[str]):
-		url = self.base + urllib.parse.quote(request, safe='')
+		if root is None:
+			return CachedPage(rows, [])
 
-		soup = self.__add_tracks_from_page(tracks, req_title, req_author, url)
-		if soup is None: return
+		for tag in self.__track_xpath(root):
+			href = re.sub(HREF_REGEX, HREF_REPL, self.__href_xpath(tag)[0])
+			title = _get_text(self.__title_xpath(tag)[0])
+			author = _get_text(self.__author_xpath(tag)[0])
 
-		pagination = soup.find(attrs=self.pagination_attrs)
+			match = re.search(TIME_REGEX, _get_text(self.__time_xpath(tag)[0]))
 
-		if pagination is not None:
-			for link in pagination.find_all('a'):
-				if self.pagination_link_predicate(link):
-					self.__add_tracks_from_page(tracks, req_title, req_author, urllib.parse.urljoin(self.host, link['href']))
+			if match is not None:
+				duration = int(match.group(1)) * 60 + int(match.group(2))
+
+				if match.group(3):
+					duration = duration * 60 + int(match.group(3))
+			else:
+				duration = -1
+
+			rows.append((remove_scheme(href), title, author, duration))
+		
+
+		links = [
+			urllib.parse.urljoin(self.host, link.get('href'))
+			for link in self.__pagination_xpath(root)
+			if self.pagination_link_predicate(link)
+		]
+		
+		return CachedPage(rows, links)
 
 
 
@@ -122,7 +275,7 @@ LIGAUDIO_TRACK_SOURCE = SimpleTrackSource(
 	{'class': 'autor', 'itemprop': 'byArtist'},
 	{'class': 'd'},
 	{'class': 'pagination'},
-	lambda link: 'this' not in link.get_attribute_list('class')
+	lambda link: 'this' not in link.get('class', '').split()
 )
 
 HITMOS_TRACK_SOURCE = SimpleTrackSource(
@@ -138,93 +291,200 @@ HITMOS_TRACK_SOURCE = SimpleTrackSource(
 )
 
 
-AUTHORS = [
-	'9Lana',
-	'Ado',
-	'Alan Walker',
-	'Alba Sera',
-	'Amala',
-	'Chiyo',
-	'DECO*27',
-	'Futakuchi Mana',
-	'GUMI',
-	'Harmony Team',
-	'HaruWei',
-	'Hatsune Miku',
-	'Kasane Teto',
-	'Megurine Luka',
-	'higanbanban',
-	'Narea',
-	'Hiiragi Magnetite',
-	'Hinomori Shizuku',
-	'Jackie-O & Sati Akura',
-	'Jinja',
-	'Kagamine Rin',
-	'Kusuriya no Hitorigoto',
-	'[Labor of Love] Hoski',
-	'LIQ',
-	'LiuVerdea',
-	'May\'n',
-	'Megurine Luka',
-	'Melody Note',
-	'Miku',
-	'Neoni',
-	'Noisia',
-	'Onsa Media',
-	'Planya Ch',
-	'Reoni',
-	'Nyami',
-	'Sati Akura',
-	'SAWTOWNE',
-	'SE[L] EI',
-	'Utsu-P',
-	'Vocaloid',
-	'WEDNESDAY CAMPANELLA',
-	'Yuyoyuppe',
-	'Zephyrianna',
-	'ZHIEND',
-	'ZUTOMAYO',
-	'Ёлка',
-]
-
-AUTHOR_NORM_TABLE = [
-	(re.compile(rf'\b{re.escape(author)}\b', re.I), author) for author in AUTHORS
-]
-
-AUTHOR_NORM_TABLE.extend([
-	(re.compile(r'\b黒うさp\b'), 'Kurousa-P'),
-	(re.compile(r'\bplanya channel\b'), 'Planya Ch'),
-])
-
-FEAT_REGEX = re.compile(r'(\w) (?: feat|ft)\. (\w)', re.X)
-FEAT_REPL = r'\1 feat. \2'
-
-SEPARATOR_REGEX = re.compile(r'(\w) (?: \s*[,&]\s* | \s+x\s+) (\w)', re.X)
-SEPARATOR_REPL = r'\1, \2'
-
-def _normalize(track: Track) -> None:
-	author = track.author
-	author = re.sub(FEAT_REGEX, FEAT_REPL, author)
-	author = re.sub(SEPARATOR_REGEX, SEPARATOR_REPL, author)
+# Порядок источников определяет порядок треков до сортировки
+TRACK_SOURCES: List[TrackSource] = [LIGAUDIO_TRACK_SOURCE, HITMOS_TRACK_SOURCE]
+
+_search_executor = ThreadPoolExecutor(SEARCH_THREADS, thread_name_prefix='search')
+
+
+# Ключ: (номер источника, номер страницы), значение: треки страницы
+PageTracks = Dict[Tuple[int, int], List[Track]]
+
+# Вызывается с промежуточными результатами поиска после каждой загруженной страницы с треками.
+# Может вернуть корутину, тогда асинхронный поиск её дожидается
+UpdateCallback = Callable[['SearchResults'], Optional[Awaitable[None]]]
+
+# Начинает загрузку страницы источника: (источник, url, запрос, название, автор).
+# Возвращает concurrent.futures.Future или asyncio.Task
+PageSubmitter = Callable[[TrackSource, str, str, Optional[str], Optional[str]], Any]
+
+# Ждёт завершения хотя бы одной загрузки из переданных не дольше timeout. Возвращает (done, pending) или корутину
+PageWaiter = Callable[[Iterable[Any], float], Any]
+
+
+def _submit(source: TrackSource, url: str, request: str, req_title: Optional[str], req_author: Optional[str]) -> Future:
+	return _search_executor.submit(source.load_page, url, request, req_title, req_author)
+
+
+def _wait(futures: Iterable[Future], timeout: float) -> Tuple[Set[Future], Set[Future]]:
+	return wait(futures, timeout, FIRST_COMPLETED)
+
+
+def _fetch_pages(request: str, req_title: Optional[str], req_author: Optional[str],
+				 max_results: int = SEARCH_MAX_RESULTS,
+				 on_page: Optional[Callable[[Tuple[int, int], List[Track]], None]] = None) -> PageTracks:
+	"""
+	Параллельно загружает первые страницы всех источников, а затем их страницы пагинации.
+	Когда найдено max_results треков, оставшиеся страницы пагинации не загружаются.
+	on_page вызывается с ключом и треками каждой загруженной страницы с треками.
+	"""
+
+	return run_steps(_fetch_pages_steps(request, req_title, req_author, max_results, on_page, _submit, _wait))
+
+
+def _fetch_pages_steps(request: str, req_title: Optional[str], req_author: Optional[str], max_results: int,
+					   on_page: Optional[Callable[[Tuple[int, int], List[Track]], Any]],
+					   submit: PageSubmitter, wait: PageWaiter) -> Steps[PageTracks]:
+	""" Шаги _fetch_pages (см. util.Steps). on_page может вернуть корутину """
+
+	deadline = time.monotonic() + SEARCH_TIMEOUT
+	found = 0
+
+	pages: PageTracks = {}
+	futures: Dict[Any, Tuple[int, int]] = {}
+	errors: List[Exception] = []
+
+	def submit_page(source_num: int, page_num: int, url: str) -> None:
+		future = submit(TRACK_SOURCES[source_num], url, request, req_title, req_author)
+		futures[future] = (source_num, page_num)
+
+	def enough() -> bool:
+		return max_results > 0 and found >= max_results
+
+	for source_num, source in enumerate(TRACK_SOURCES):
+		submit_page(source_num, 0, source.get_search_url(request))
+	
+	skipped = 0
+
+	while len(futures) > 0:
+		# Первые страницы загружаются всегда, чтобы в результатах были все источники
+		if enough():
+			for future, (_, page_num) in list(futures.items()):
+				if page_num > 0:
+					future.cancel()
+					del futures[future]
+					skipped += 1
+
+			if len(futures) == 0: break
+
+		timeout = deadline - time.monotonic()
+		if timeout <= 0: break
+
+		done, _ = yield wait(futures, timeout)
+
+		for future in done:
+			source_num, page_num = futures.pop(future)
+
+			try:
+				page = future.result()
+			except Exception as ex:
+				logger.warning(f'Cannot load page {page_num} of source {source_num}', exc_info=ex)
+				errors.append(ex)
+				continue
+
+			if page is None:
+				continue
+
+			pages[source_num, page_num] = page.tracks
+			found += len(page.tracks)
+
+			if page_num == 0 and not enough():
+				for link_num, link in enumerate(page.links, 1):
+					submit_page(source_num, link_num, link)
+			
+			if on_page is not None and len(page.tracks) > 0:
+				yield on_page((source_num, page_num), page.tracks)
+	
+
+	if skipped > 0:
+		logger.debug(f'Found {found} tracks by request `{request}`, skipped {skipped} pages')
+
+	if len(futures) > 0:
+		logger.warning(f'Search timeout exceeded by request `{request}`, skipped {len(futures)} pages')
+
+		for future in futures:
+			future.cancel()
 	
-	for entry in AUTHOR_NORM_TABLE:
-		author = re.sub(entry[0], entry[1], author)
+	# Если ни одна страница не загрузилась, показываем пользователю ошибку
+	if len(pages) == 0 and len(errors) > 0:
+		raise errors[0]
 	
-	track.author = author
-            
+	return pages
+
 
+def normalize_request(request: str) -> str:
+	""" Приводит запрос к единому виду, чтобы одинаковые запросы попадали в один ключ кэша """
+	return ' '.join(re.split(WHITESPACE_REGEX, request.strip().lower()))
 
-def load_tracks(request: str, req_title: Optional[str], req_author: Optional[str]) -> List[Track]:
-	""" Возвращает список треков по запросу """
-	tracks = []
+
+class SearchResults:
+	"""
+	Отсортированные треки загруженных страниц поиска. Страницы добавляются в порядке ответов:
+	треки страницы нормализуются и сортируются один раз, а затем сливаются с уже найденными.
+	Треки с одинаковым ключом сортировки идут в порядке (источник, страница), независимо от порядка ответов.
+	"""
+
+	def __init__(self) -> None:
+		# (ключ сортировки, ключ страницы, индекс на странице, трек)
+		self.__entries: List[Tuple[tuple, Tuple[int, int], int, Track]] = []
+		self.__tracks: Optional[List[Track]] = []
 	
-	LIGAUDIO_TRACK_SOURCE.add_tracks(tracks, request, req_title, req_author)
-	HITMOS_TRACK_SOURCE.add_tracks(tracks, request, req_title, req_author)
- 
-	for track in tracks:
-		_normalize(track)
+
+	def add_page(self, key: Tuple[int, int], tracks: List[Track]) -> None:
+		normalizer = get_author_normalizer()
+
+		for track in tracks:
+			track.author = normalizer.normalize(track.author)
+		
+		# Ключ страницы и индекс уникальны, поэтому до сравнения треков дело не доходит
+		page = sorted((track.sort_key(), key, i, track) for i, track in enumerate(tracks))
+		self.__entries = list(heapq.merge(self.__entries, page))
+		self.__tracks = None
+	
+
+	def get_tracks(self) -> List[Track]:
+		""" Возвращает список треков. Он строится только при первом вызове после добавления страницы """
+
+		if self.__tracks is None:
+			self.__tracks = [entry[-1] for entry in self.__entries]
+		
+		return self.__tracks
 	
-	tracks.sort()
 
-	logger.debug(f'Found {len(tracks)} tracks by request `{request}`')
-	return tracks
+	def __len__(self) -> int:
+		return len(self.__entries)
+
+
+def load_tracks(request: str, req_title: Optional[str], req_author: Optional[str],
+				max_results: int = SEARCH_MAX_RESULTS, on_update: Optional[UpdateCallback] = None) -> List[Track]:
+	"""
+	Возвращает список треков по запросу.
+	on_update вызывается с промежуточными результатами, пока загружаются остальные страницы
+	"""
+
+	return run_steps(load_tracks_steps(request, req_title, req_author, max_results, on_update, _submit, _wait))
+
+
+def load_tracks_steps(request: str, req_title: Optional[str], req_author: Optional[str], max_results: int,
+					  on_update: Optional[UpdateCallback], submit: PageSubmitter, wait: PageWaiter) -> Steps[List[Track]]:
+	""" Шаги load_tracks (см. util.Steps). Их выполняют синхронный поиск и aio с разными submit и wait """
+
+	request = normalize_request(request)
+	start = time.monotonic()
+	first_result: Optional[float] = None
+	results = SearchResults()
+
+	def on_page(key: Tuple[int, int], tracks: List[Track]) -> Optional[Awaitable[None]]:
+		nonlocal first_result
+
+		if first_result is None:
+			first_result = time.monotonic() - start
+		
+		results.add_page(key, tracks)
+		return on_update(results) if on_update is not None else None
+
+	yield from _fetch_pages_steps(request, req_title, req_author, max_results, on_page, submit, wait)
+	SEARCH_STATS.add(first_result, time.monotonic() - start)
+
+	logger.debug(f'Found {len(results)} tracks by request `{request}`, search cache: {SEARCH_CACHE.format_stats()}')
+	return results.get_tracks()
@@ -1,15 +1,20 @@
 import os
+import time
 import requests
 import tempfile
+import subprocess
 import logging
 
-from pydub.utils import mediainfo
 from telebot import TeleBot
-from typing import Optional
+from telebot.apihelper import ApiTelegramException
+from typing import Any, Callable, List, Tuple, Type, TypeVar, Optional, IO
 
-from .file_manager import get_track_path, save_file, create_track_symlink, update_track
+from . import http_client, database, audio_store, transcoder
+from .jobs import PROCESS_POOL, UPLOAD_POOL
+from .file_manager import PendingFile, get_track_path, create_track_symlink, update_track
+from .probe import probe_head, probe_file
 from .tracks import Track
-from .util import Timer, add_scheme, HEADERS, KEYBOARD_REMOVE
+from .util import Timer, add_scheme, report_exception, run_steps, Steps, KEYBOARD_REMOVE
 
 
 TARGET_BITRATE = int(os.environ.get('TARGET_BITRATE'))
@@ -17,57 +22,392 @@ TARGET_FORMAT = os.environ.get('TARGET_FORMAT')
 EXT = '.' + TARGET_FORMAT
 MAX_SEND_TRIES = int(os.environ.get('MAX_SEND_TRIES'))
 
+# Максимальный размер скачиваемого файла в байтах, 0 - без ограничения
+MAX_TRACK_SIZE = int(os.environ.get('MAX_TRACK_SIZE', 0))
+
+# Размер куска, которыми скачивается файл
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Минимальный интервал между обновлениями сообщения о прогрессе в секундах
+PROGRESS_INTERVAL = 2
+
+# 1 - передавать скачиваемый файл в ffmpeg по мере скачивания, без промежуточного файла
+TRANSCODE_PIPELINE = os.environ.get('TRANSCODE_PIPELINE', '0') == '1'
+
+# Сколько байт начала файла читается для определения формата и битрейта в режиме TRANSCODE_PIPELINE
+PROBE_SIZE = 128 * 1024
+
+# Части описаний ошибок телеграма, означающих, что file_id больше не действителен
+FILE_ID_ERRORS = (
+	'wrong file identifier',
+	'wrong remote file identifier',
+	'file reference expired',
+	'file_reference_expired',
+	'wrong padding',
+	"can't use file of type",
+)
+
+# Сообщение пользователю, если файл больше MAX_TRACK_SIZE
+TOO_LARGE_MESSAGE = 'Файл слишком большой'
+
 logger = logging.getLogger()
 
+T = TypeVar('T')
+
 
-def download_track(track: Track, bot: TeleBot, chat_id: int) -> Optional[int]:
-	""" Скачивает трек и сохраняет его в файл по пути path """
+class DownloadProgress:
+	""" Текст сообщения "Скачиваю файл..." с прогрессом. Текст меняется не чаще раза в PROGRESS_INTERVAL секунд """
+
+	def __init__(self, total: Optional[int]) -> None:
+		self.total = total
+		self.last_update = time.monotonic()
+		self.last_text = None
 	
-	message_id = bot.send_message(chat_id, 'Скачиваю файл...', reply_markup=KEYBOARD_REMOVE).id
+	def get_text(self, size: int) -> Optional[str]:
+		""" Возвращает новый текст сообщения или None, если его не нужно менять """
 
-	timer = Timer().start()
+		now = time.monotonic()
+		if now - self.last_update < PROGRESS_INTERVAL:
+			return None
+		
+		self.last_update = now
 
-	response = requests.get(add_scheme(track.url), headers=HEADERS)
+		if self.total:
+			text = f'Скачиваю файл... {min(100, size * 100 // self.total)}%'
+		else:
+			text = f'Скачиваю файл... {size / 1024 / 1024 :.1f} МБ'
+		
+		if text == self.last_text:
+			return None
+		
+		self.last_text = text
+		return text
 
-	if not response.ok:
-		logger.warning(f'Server returned status {response.status_code} on request {track.url}')
-		bot.delete_message(chat_id, message_id)
-		bot.send_message(chat_id, 'Ошибка при скачавании файла', reply_markup=KEYBOARD_REMOVE)
-		return None
 
-	save_file(track, response)
+def check_response(track: Track, status: int, total: Optional[int]) -> Optional[str]:
+	""" Проверяет ответ сервера на скачивание трека. Возвращает сообщение об ошибке для пользователя """
+
+	if status >= 400:
+		logger.warning(f'Server returned status {status} on request {track.url}')
+		return 'Ошибка при скачавании файла'
+
+	if MAX_TRACK_SIZE > 0 and total is not None and total > MAX_TRACK_SIZE:
+		logger.warning(f'File {track.url} has size {total}, which exceeds {MAX_TRACK_SIZE} bytes')
+		return TOO_LARGE_MESSAGE
+
+	return None
+
+
+class TrackIO:
+	"""
+	Ввод-вывод шагов обработки трека (см. util.Steps) для синхронного бота: методы выполняют действие сразу.
+	aio.AsyncTrackIO возвращает из тех же методов корутины.
+	"""
+
+	# Ошибки API телеграма и соединения при отправке файла
+	api_error: Type[Exception] = ApiTelegramException
+	connection_error: Type[Exception] = requests.exceptions.ConnectionError
+
+	def __init__(self, bot: TeleBot) -> None:
+		self.bot = bot
 	
-	timer.stop('File downloading')
+
+	def blocking(self, func: Callable[..., T], *args) -> T:
+		""" Вызывает блокирующую функцию (БД, файлы, mutagen) """
+		return func(*args)
+	
+
+	def open(self, url: str) -> requests.Response:
+		""" Начинает скачивание файла. Ответ закрывается через close """
+		return http_client.get(url, stream=True)
+	
+	def get_status(self, response: requests.Response) -> Tuple[int, Optional[int]]:
+		""" Возвращает код ответа и размер файла, если он известен """
+		return response.status_code, int(response.headers.get('Content-Length', 0)) or None
+	
+	def read(self, response: requests.Response) -> bytes:
+		""" Читает следующий кусок файла. Пустой кусок означает конец файла """
+		return response.raw.read(DOWNLOAD_CHUNK_SIZE, decode_content=True)
 	
-	return message_id
+	def close(self, response: requests.Response) -> None:
+		response.close()
+	
+
+	def start_ffmpeg(self, args: List[str]) -> Tuple[subprocess.Popen, IO[bytes]]:
+		""" Запускает ffmpeg, читающий файл из stdin """
+
+		stderr = tempfile.TemporaryFile()
+
+		try:
+			process = subprocess.Popen(args, stdin=subprocess.PIPE, stderr=stderr)
+		except BaseException:
+			stderr.close()
+			raise
+
+		transcoder.renice(process.pid)
+		return process, stderr
+	
+	def write(self, ffmpeg: Tuple[subprocess.Popen, IO[bytes]], chunk: bytes) -> None:
+		ffmpeg[0].stdin.write(chunk)
+	
+	def kill(self, ffmpeg: Tuple[subprocess.Popen, IO[bytes]]) -> None:
+		ffmpeg[0].kill()
+	
+	def finish(self, ffmpeg: Tuple[subprocess.Popen, IO[bytes]]) -> Tuple[int, bytes]:
+		""" Закрывает stdin, дожидается завершения ffmpeg и возвращает код возврата и stderr """
+
+		process, stderr = ffmpeg
+
+		try:
+			process.stdin.close()
+		except BrokenPipeError:
+			pass
+
+		process.wait()
+
+		with stderr:
+			stderr.seek(0)
+			return process.returncode, stderr.read()
+	
+
+	def run_ffmpeg(self, args: List[str], job: transcoder.TranscodeJob) -> None:
+		transcoder.run_ffmpeg(args, job)
 
 
-def process_track(track: Track) -> None:
-	""" Преобразовывает трек в формат TARGET_FORMAT, сжимает до
-		битрейта TARGET_BITRATE и устанавливает метаданные. """
+def _download_failed_steps(io: TrackIO, chat_id: int, message_id: int, text: str) -> Steps[None]:
+	yield io.bot.delete_message(chat_id, message_id)
+	yield io.bot.send_message(chat_id, text, reply_markup=KEYBOARD_REMOVE)
+
+
+# Возвращает следующий кусок файла или корутину с ним. Пустой кусок означает конец файла
+_Reader = Callable[[], Any]
+
+# Шаги обновления прогресса, принимают размер скачанной части файла
+_ProgressSteps = Callable[[int], Steps[None]]
+
+def _save_stream_steps(track: Track, read: _Reader, on_progress: _ProgressSteps) -> Steps[bool]:
+	"""
+	Записывает поток во временный файл рядом с файлом трека и атомарно переименовывает его.
+	Возвращает False, если файл превысил MAX_TRACK_SIZE. В этом случае файл не сохраняется.
+	"""
+
+	with PendingFile(get_track_path(track), max_size=MAX_TRACK_SIZE) as file:
+		while True:
+			chunk = yield read()
+			if not chunk: break
+
+			if not file.write(chunk):
+				return False
+
+			yield from on_progress(file.size)
+		
+		file.commit()
+		return True
+
+
+def plan_stream(head: bytes) -> Tuple[str, int]:
+	"""
+	Определяет по началу файла, что сделать с файлом в режиме TRANSCODE_PIPELINE, и битрейт результата.
+	Если битрейт по началу файла не определился, файл преобразуется.
+	"""
+
+	info = probe_head(head)
+	action = transcoder.plan(info, TARGET_FORMAT, TARGET_BITRATE)
+
+	if action == transcoder.SKIP and info.bitrate is None:
+		action = transcoder.ENCODE
+
+	return action, transcoder.output_bitrate(info, TARGET_BITRATE)
+
+
+def _transcode_stream_steps(track: Track, io: TrackIO, read: _Reader, on_progress: _ProgressSteps) -> Steps[bool]:
+	"""
+	Передаёт поток в stdin ffmpeg по мере скачивания, результат пишется сразу рядом с файлом трека
+	и атомарно переименовывается. Если по началу файла видно, что преобразование не нужно,
+	сохраняет поток как есть. Возвращает False, если файл превысил MAX_TRACK_SIZE.
+	"""
+
+	head = bytearray()
+
+	while len(head) < PROBE_SIZE:
+		chunk = yield read()
+		if not chunk: break
+		head += chunk
+	
+	action, bitrate = plan_stream(bytes(head))
+
+	# Начало файла уже прочитано, поэтому отдаётся первым
+	unread = [bytes(head)]
+	stream = lambda: unread.pop() if unread else read()
+
+	if action == transcoder.SKIP:
+		transcoder.record_skip()
+		return (yield from _save_stream_steps(track, stream, on_progress))
+	
+	size = 0
+
+	# Процесс получает данные со скоростью скачивания, поэтому не занимает слот TRANSCODE_CONCURRENCY
+	with PendingFile(get_track_path(track), suffix=EXT) as output:
+		ffmpeg = yield io.start_ffmpeg(transcoder.ffmpeg_args('pipe:0', output.name, action, TARGET_FORMAT, bitrate))
+
+		try:
+			while True:
+				chunk = yield stream()
+				if not chunk: break
+
+				size += len(chunk)
+
+				if MAX_TRACK_SIZE > 0 and size > MAX_TRACK_SIZE:
+					logger.warning(f'File {track.url} exceeds {MAX_TRACK_SIZE} bytes, download aborted')
+					io.kill(ffmpeg)
+					break
+
+				try:
+					yield io.write(ffmpeg, chunk)
+				except (BrokenPipeError, ConnectionResetError):
+					# ffmpeg завершился раньше времени, ошибка будет в stderr
+					break
+
+				yield from on_progress(size)
+
+		except BaseException:
+			# Скачивание прервалось. Без конца потока ffmpeg ждал бы данных вечно
+			io.kill(ffmpeg)
+			raise
+
+		finally:
+			returncode, errors = yield io.finish(ffmpeg)
+		
+		if MAX_TRACK_SIZE > 0 and size > MAX_TRACK_SIZE:
+			return False
+		
+		if returncode != 0:
+			raise RuntimeError(f'ffmpeg exited with code {returncode}: {errors.decode(errors="replace")}')
+	
+		output.commit()
+		return True
+
+
+def _download_steps(track: Track, io: TrackIO, chat_id: int, message_id: int) -> Steps[bool]:
+	"""
+	Скачивает трек по частям, в режиме TRANSCODE_PIPELINE - одновременно со сжатием. message_id - id сообщения
+	о скачивании, в нём отображается прогресс. Возвращает False при ошибке, пользователь уже уведомлён.
+	"""
+
+	response = yield io.open(add_scheme(track.url))
+
+	try:
+		status, total = io.get_status(response)
+		error = check_response(track, status, total)
+
+		if error is not None:
+			yield from _download_failed_steps(io, chat_id, message_id, error)
+			return False
+
+		progress = DownloadProgress(total)
+
+		def on_progress(size: int) -> Steps[None]:
+			text = progress.get_text(size)
+			if text is None: return
+
+			try:
+				yield io.bot.edit_message_text(text, chat_id, message_id)
+			except io.api_error as ex:
+				logger.debug(f'Cannot update download progress: {ex}')
+
+		read = lambda: io.read(response)
+
+		if TRANSCODE_PIPELINE:
+			saved = yield from _transcode_stream_steps(track, io, read, on_progress)
+		else:
+			saved = yield from _save_stream_steps(track, read, on_progress)
+
+		if not saved:
+			yield from _download_failed_steps(io, chat_id, message_id, TOO_LARGE_MESSAGE)
+			return False
+	
+	finally:
+		io.close(response)
+	
+	return True
+
+
+def _process_steps(track: Track, io: TrackIO) -> Steps[None]:
+	""" Преобразовывает трек в формат TARGET_FORMAT и сжимает до битрейта TARGET_BITRATE """
   
 	path = get_track_path(track)
 	
 	timer = Timer().start()
-	info = mediainfo(path)
-	bitrate = int(info['bit_rate'])
-	timer.stop('Mediainfo reading')
+	info = yield io.blocking(probe_file, path)
+	timer.stop('Probing')
+
+	timer.start()
+	yield from transcoder.transcode_steps(path, info, TARGET_FORMAT, TARGET_BITRATE, io.run_ffmpeg)
+	timer.stop('ffmpeg')
+
+
+def link_stored_track(track: Track) -> bool:
+	"""
+	Если трек по этой ссылке уже скачан кем-то, делает файл трека ссылкой на файл из общего хранилища
+	и устанавливает метаданные. Возвращает False, если трек нужно скачать.
+	"""
+
+	if track.id is None or not audio_store.link_stored(track):
+		return False
+
+	Timer().run('Metadata writing', lambda: audio_store.update_track(track))
+	save_audio_info(track)
+	return True
+
+
+def finish_track(track: Track) -> None:
+	""" Устанавливает метаданные скачанного и обработанного трека и добавляет его файл в общее хранилище """
+
+	Timer().run('Metadata writing', lambda: update_track(track))
+
+	if track.id is not None:
+		Timer().run('Audio storing', lambda: audio_store.store(track))
+		save_audio_info(track)
+
+
+def download_and_process_steps(track: Track, io: TrackIO, chat_id: int, message_id: int) -> Steps[bool]:
+	"""
+	Шаги download_and_process_track. Их выполняют синхронный бот и aio с разными TrackIO.
+	"""
+
+	if (yield io.blocking(link_stored_track, track)):
+		return True
+
+	timer = Timer().start()
+
+	if not (yield from _download_steps(track, io, chat_id, message_id)):
+		return False
 
-	if bitrate > TARGET_BITRATE or info['format_name'] != TARGET_FORMAT:
-		with tempfile.NamedTemporaryFile('w+b', suffix=EXT) as tmpfile:
-			
-			timer.run('ffmpeg', lambda: os.system(
-				f'ffmpeg -y -v error -i {path} -f {TARGET_FORMAT}\
-						-b:a {min(bitrate, TARGET_BITRATE)} {tmpfile.name}'
-			))
+	if TRANSCODE_PIPELINE:
+		timer.stop('File downloading and ffmpeg')
+	else:
+		timer.stop('File downloading')
+		yield from _process_steps(track, io)
+	
+	yield io.blocking(finish_track, track)
+	return True
+
+
+def download_and_process_track(track: Track, bot: TeleBot, chat_id: int, message_id: int) -> bool:
+	"""
+	Скачивает трек по ссылке и сохраняет его на диск, преобразовывает в формат TARGET_FORMAT,
+	сжимает до битрейта TARGET_BITRATE и устанавливает метаданные. Возвращает False при ошибке.
+	Если трек по этой ссылке уже скачан кем-то, берёт файл из общего хранилища.
+	"""
 
-	timer.run('Metadata writing', lambda: update_track(track))
+	return run_steps(download_and_process_steps(track, TrackIO(bot), chat_id, message_id))
 
 
-def send_file(path: str, bot: TeleBot, chat_id: int) -> None:
+def _send_file_steps(path: str, io: TrackIO, chat_id: int) -> Steps[Optional[str]]:
 	"""
-	Отправляет файл в телеграм. Делает MAX_TRIES попыток
-	path - путо до симлинка на файл, его название используется телеграмом.
+	Отправляет файл в телеграм. Делает MAX_SEND_TRIES попыток
+	path - путь до симлинка на файл, его название используется телеграмом.
+	Возвращает идентификатор загруженного файла.
 	"""
 	
 	timer = Timer().start()
@@ -76,32 +416,121 @@ def send_file(path: str, bot: TeleBot, chat_id: int) -> None:
 		for trying in range(MAX_SEND_TRIES):
 			try:
 				file.seek(0)
-				bot.send_audio(chat_id, file, reply_markup=KEYBOARD_REMOVE)
+				message = yield io.bot.send_audio(chat_id, file, reply_markup=KEYBOARD_REMOVE)
 				break
-			except requests.exceptions.ConnectionError as error:
+			except io.connection_error:
 				if trying < MAX_SEND_TRIES - 1:
-					logger.warning('Caugth requests.exceptions.ConnectionError, retrying...')
+					logger.warning(f'Caught {io.connection_error.__name__}, retrying...')
 				else:
-					raise error
+					raise
 
 	timer.stop('Audio sending')
+	return message.audio.file_id if message.audio is not None else None
+
+
+def _send_cached_steps(track: Track, io: TrackIO, chat_id: int) -> Steps[bool]:
+	"""
+	Отправляет ранее загруженный файл трека по его file_id. Возвращает False, если файла нет в кэше
+	или телеграм его не принял. В последнем случае запись кэша удаляется.
+	"""
+
+	file_id = yield io.blocking(database.get_file_id, track.id)
+	if file_id is None: return False
+
+	timer = Timer().start()
+
+	try:
+		yield io.bot.send_audio(chat_id, file_id, reply_markup=KEYBOARD_REMOVE)
+		timer.stop('Cached audio sending')
+		return True
+	
+	except io.api_error as ex:
+		if not is_file_id_rejected(track, ex):
+			raise
+
+	yield io.blocking(database.set_file_id, track.id, None)
+	return False
+
+
+def is_file_id_rejected(track: Track, ex: Exception) -> bool:
+	"""
+	Проверяет, что ошибка означает устаревший file_id трека. Такую запись кэша нужно удалить.
+	Остальные ошибки 400 (разметка, чат не найден и т.п.) к file_id отношения не имеют.
+	"""
+
+	if getattr(ex, 'error_code', None) != 400:
+		return False
+	
+	description = (getattr(ex, 'description', None) or '').lower()
+
+	if not any(error in description for error in FILE_ID_ERRORS):
+		return False
+
+	logger.warning(f'Cached file of track {track.id} is rejected: {ex.description}')
+	return True
+
+
+def send_track_steps(track: Track, io: TrackIO, chat_id: int) -> Steps[None]:
+	""" Шаги send_track. Их выполняют синхронный бот и aio с разными TrackIO """
+
+	if track.id is not None and (yield from _send_cached_steps(track, io, chat_id)):
+		return
+
+	symlink_path = yield io.blocking(create_track_symlink, track)
+	file_id = yield from _send_file_steps(symlink_path, io, chat_id)
+
+	if track.id is not None and file_id is not None:
+		yield io.blocking(database.set_file_id, track.id, file_id)
 
 
 def send_track(track: Track, bot: TeleBot, chat_id: int) -> None:
-	symlink_path = create_track_symlink(track)
-	send_file(symlink_path, bot, chat_id)
+	""" Отправляет трек. Если он уже загружен в телеграм, отправляет его по file_id без повторной загрузки """
+	run_steps(send_track_steps(track, TrackIO(bot), chat_id))
+
+
+def save_audio_info(track: Track) -> None:
+	""" Сохраняет формат, битрейт и длительность готового файла в записи трека """
+	database.set_audio_info(track.id, probe_file(get_track_path(track)))
+
+
+# ------------------------------------------- Очередь ------------------------------------------
 
+def _run_job(bot: TeleBot, chat_id: int, message_id: Optional[int], job: Callable[[], None]) -> None:
+	""" Выполняет задачу, при ошибке удаляет сообщение о статусе и уведомляет пользователя """
 
-def download_process_and_send_track(track: Track, bot: TeleBot, chat_id: int) -> None:
+	try:
+		job()
+	except Exception as ex:
+		if message_id is not None:
+			bot.delete_message(chat_id, message_id)
+		
+		report_exception(bot, chat_id, ex)
+
+
+def enqueue_track(track: Track, bot: TeleBot, chat_id: int, user_id: int) -> None:
 	"""
-	Скачивает трек по ссылке и сохраняет его на диск, преобразовывает в формат TARGET_FORMAT,
-	сжимает до битрейта TARGET_BITRATE и устанавливает метаданные. Затем отправляет файл в тг.
+	Ставит скачивание, обработку и отправку трека в очередь и сразу возвращает управление.
+	Скачивание и сжатие выполняются в PROCESS_POOL, отправка - в UPLOAD_POOL.
 	"""
 
-	message_id = download_track(track, bot, chat_id)
-	process_track(track)
- 
-	symlink_path = create_track_symlink(track)
-	send_file(symlink_path, bot, chat_id)
+	queued = PROCESS_POOL.is_busy()
+	text = f'В очереди, задач перед вами: {PROCESS_POOL.pending()}' if queued else 'Скачиваю файл...'
+	message_id = bot.send_message(chat_id, text, reply_markup=KEYBOARD_REMOVE).id
+
+	def process() -> None:
+		if queued:
+			bot.edit_message_text('Скачиваю файл...', chat_id, message_id)
+
+		if download_and_process_track(track, bot, chat_id, message_id):
+			UPLOAD_POOL.submit(user_id, lambda: _run_job(bot, chat_id, message_id, upload))
 	
-	bot.delete_message(chat_id, message_id)
\ No newline at end of file
+	def upload() -> None:
+		send_track(track, bot, chat_id)
+		bot.delete_message(chat_id, message_id)
+	
+	PROCESS_POOL.submit(user_id, lambda: _run_job(bot, chat_id, message_id, process))
+
+
+def enqueue_send_track(track: Track, bot: TeleBot, chat_id: int, user_id: int) -> None:
+	""" Ставит отправку уже скачанного трека в очередь UPLOAD_POOL """
+	UPLOAD_POOL.submit(user_id, lambda: _run_job(bot, chat_id, None, lambda: send_track(track, bot, chat_id)))
@@ -1,11 +1,20 @@
 import os
 import re
-
+import sys
+import time
+import inspect
+import logging
+import threading
+
+from array import array
+from collections import OrderedDict
 from telebot import TeleBot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import List, Dict, Optional, Callable
+from typing import List, Dict, Set, Tuple, Optional, Callable, Awaitable
+
+from .util import word_form_by_num, register_stats
 
-from .util import word_form_by_num, KEYBOARD_REMOVE
+logger = logging.getLogger('root')
 
 
 # Символы, запрещённые в именах файлов
@@ -15,34 +24,100 @@ FORBIDDEN_CHARS_REPL = '_'
 # Минимальная длина строки для вывода кнопки в Telegram
 MIN_LINE_LENGTH = 200
 
-button_events: Dict[str, Callable[[TeleBot, int, int], None]] = {}
+# Максимальное число пулов треков в памяти, всего и на одного пользователя,
+# и время в секундах, через которое неиспользуемый пул выгружается.
+# Выгруженные пулы сохраняются в БД и загружаются обратно при нажатии на их кнопку
+TRACK_POOLS_MAX = int(os.environ.get('TRACK_POOLS_MAX', 1000))
+TRACK_POOLS_PER_USER = int(os.environ.get('TRACK_POOLS_PER_USER', 10))
+TRACK_POOL_IDLE_TIME = int(os.environ.get('TRACK_POOL_IDLE_TIME', 24 * 3600))
+
+# Загрузка пулов при запуске: eager - все пулы с треками, lazy - только последние id,
+# а пулы загружаются при первом нажатии на их кнопку
+TRACK_POOL_LOADING = os.environ.get('TRACK_POOL_LOADING', 'lazy')
+
+# Минимальный интервал в секундах между изменениями сообщения с результатами поиска,
+# которые дополняются по мере загрузки (SEARCH_PROGRESSIVE)
+PROGRESSIVE_EDIT_INTERVAL = float(os.environ.get('PROGRESSIVE_EDIT_INTERVAL', 1.5))
+
+# Интервал в секундах, с которым новые и изменённые пулы записываются в БД
+TRACK_POOL_FLUSH_INTERVAL = float(os.environ.get('TRACK_POOL_FLUSH_INTERVAL', 5))
+
+# Обработчик кнопки. Для асинхронного бота обработчик может вернуть корутину
+ButtonHandler = Callable[[TeleBot, int, int], Optional[Awaitable[None]]]
+
+# Действия кнопок пула. callback_data кнопки имеет вид "<id пула>:<действие>:<аргумент>".
+# Кнопки треков передают номер трека (keynum), так как индекс меняется при дополнении результатов
+ACTION_TRACK     = 't'
+ACTION_TRACK_KEY = 'k'
+ACTION_NEXT      = 'n'
+ACTION_PREV      = 'p'
+ACTION_DELETE    = 'd'
+
+# Действия в старом формате "<id пула>_<действие>". Кнопки треков в старом формате содержат только номер трека
+_LEGACY_ACTIONS = { 'print_next': ACTION_NEXT, 'print_prev': ACTION_PREV, 'delete': ACTION_DELETE }
+
+# id пула или номер трека (для старого формата), действие, индекс трека в пуле или номер трека (keynum)
+ButtonData = Tuple[Optional[int], Optional[int], str, Optional[int]]
+
+def parse_callback_data(data: str) -> Optional[ButtonData]:
+	parts = data.split(':')
+
+	if len(parts) == 3:
+		if not parts[0].isdigit() or not parts[2].isdigit():
+			return None
+
+		return int(parts[0]), None, parts[1], int(parts[2])
+	
+	pool_id, sep, action = data.partition('_')
+
+	if not pool_id.isdigit():
+		return None
+	
+	if not sep:
+		return None, int(pool_id), ACTION_TRACK, None
+	
+	action = _LEGACY_ACTIONS.get(action)
+	return (int(pool_id), None, action, 0) if action is not None else None
+
+
+def _is_async(bot: TeleBot) -> bool:
+	""" Проверяет, что бот асинхронный (AsyncTeleBot) """
+	return inspect.iscoroutinefunction(bot.send_message)
 
 
 class Track:
+	__slots__ = ('url', 'title', 'author', 'duration', 'id', 'keynum')
+
 	__last_key = 0
+
+	# Треки создаются в потоках поиска, поэтому номера выдаются под блокировкой
+	__key_lock = threading.Lock()
     
 	def __init__(self, url: str, title: str, author: str, duration: int,
             	id: Optional[int] = None, keynum: Optional[int] = None):
 
 		self.url = url
 		self.title = title
-		self.author = author
+		self.author = sys.intern(author)
 		self.duration = duration
 		self.id = id
 
-		if keynum is None:
-			Track.__last_key += 1
-			self.keynum = Track.__last_key
-		else:
-			Track.__last_key = max(Track.__last_key, keynum)
-			self.keynum = keynum
-   
-	@property
-	def key(self) -> str:
-		""" Ключ, уникальный для каждого трека. Используется для идентификации кнопки. """
-		return str(self.keynum)
+		with Track.__key_lock:
+			if keynum is None:
+				Track.__last_key += 1
+				keynum = Track.__last_key
+			else:
+				Track.__last_key = max(Track.__last_key, keynum)
+		
+		self.keynum = keynum
 	
+	@staticmethod
+	def reserve_keynums(last_keynum: int) -> None:
+		""" Гарантирует, что новые треки получат номера больше last_keynum """
 
+		with Track.__key_lock:
+			Track.__last_key = max(Track.__last_key, last_keynum)
+   
 	def format_duration(self) -> str:
 		if self.duration is None:
 			return '--:--'
@@ -66,18 +141,15 @@ class Track:
 		return re.sub(FORBIDDEN_CHARS_REGEX, FORBIDDEN_CHARS_REPL, f'{self.author} - {self.title}')
 	
 
-	@staticmethod
-	def __compare_str_ignorecase(str1: str, str2: str) -> Optional[bool]:
-		low1 = str1.lower()
-		low2 = str2.lower()
-
-		if low1 < low2: return True
-		if low1 > low2: return False
-
-		if str1 < str2: return True
-		if str1 > str2: return False
+	def sort_key(self) -> Tuple[str, str, str, str, int, str, int]:
+		"""
+		Ключ сортировки: автор и название без учёта регистра, затем с учётом,
+		длительность, url и id. Для сортировки списка используйте list.sort(key=Track.sort_key),
+		тогда ключ вычисляется один раз для каждого трека.
+		"""
 
-		return None
+		return (self.author.lower(), self.author, self.title.lower(), self.title,
+				-1 if self.duration is None else self.duration, self.url, -1 if self.id is None else self.id)
 	
 	
 	def __lt__(self, track: object) -> bool:
@@ -86,24 +158,7 @@ class Track:
 		if not isinstance(track, Track):
 			return NotImplemented
 		
-		res = Track.__compare_str_ignorecase(self.author, track.author)
-		if res is not None: return res
-
-		res = Track.__compare_str_ignorecase(self.title, track.title)
-		if res is not None: return res
-
-		if self.duration is not None and track.duration is not None:
-			if self.duration < track.duration: return True
-			if self.duration > track.duration: return False
-		
-		if self.url < track.url: return True
-		if self.url > track.url: return False
-
-		if self.id is not None and track.id is not None:
-			if self.id < track.id: return True
-			if self.id > track.id: return False
-
-		return False # equals
+		return self.sort_key() < track.sort_key()
 	
 	def __eq__(self, track: object) -> bool:
 		if self is track: return True
@@ -125,29 +180,347 @@ class Track:
 		return Track(self.url, self.title, self.author, self.duration, self.id, self.keynum)
 
 
+# Значение в столбце длительностей, означающее её отсутствие
+_NO_DURATION = -2 ** 31
+
 # Размер одной страницы при выводе списка треков
 # Примечание: у телеграма есть ограничение на ~55 строк кнопок
 PAGE_SIZE = 10
 
+PoolLoader = Callable[[Optional[int], Optional[int]], Optional['TrackPool']]
+PoolSaver = Callable[[List['TrackPool']], None]
+PoolDeleter = Callable[[int], None]
+
+
+class _TrackPoolRegistry:
+	"""
+	Пулы треков в памяти в порядке последнего использования. Пулы сверх TRACK_POOLS_MAX
+	или TRACK_POOLS_PER_USER, а также не использовавшиеся TRACK_POOL_IDLE_TIME секунд,
+	выгружаются во внешнее хранилище, если оно подключено. Новые, изменённые, выгруженные
+	и удалённые пулы записываются в хранилище пачками раз в TRACK_POOL_FLUSH_INTERVAL секунд. Потокобезопасен.
+
+	Обращения к хранилищу выполняются без блокировки реестра, чтобы запись не задерживала поиск
+	и нажатия на кнопки. Под блокировкой пулы только выбираются и отмечаются.
+	"""
+
+	def __init__(self) -> None:
+		self.pools: OrderedDict[int, 'TrackPool'] = OrderedDict()
+		self.user_pools: Dict[int, int] = {}
+
+		# Пулы в памяти, которые ещё не записаны в хранилище
+		self.dirty: Dict[int, 'TrackPool'] = {}
+
+		# Выгруженные из памяти пулы, которые ещё не записаны, и id удалённых пулов
+		self.unloading: Dict[int, 'TrackPool'] = {}
+		self.deleted: Set[int] = set()
+
+		self.flusher: Optional[threading.Thread] = None
+		self.flusher_stopped = threading.Event()
+		self.flushed = 0
+
+		self.loader: Optional[PoolLoader] = None
+		self.saver: Optional[PoolSaver] = None
+		self.deleter: Optional[PoolDeleter] = None
+
+		self.evicted = 0
+		self.loaded = 0
+		self.lock = threading.RLock()
+
+		# Записи в хранилище выполняются по одной, чтобы старое состояние пула не перезаписало новое
+		self.save_lock = threading.Lock()
+
+
+	def add(self, pool: 'TrackPool', dirty: bool = False) -> None:
+		with self.lock:
+			if pool.id not in self.pools:
+				self.user_pools[pool.user_id] = self.user_pools.get(pool.user_id, 0) + 1
+			
+			self.pools[pool.id] = pool
+			pool.last_used = time.monotonic()
+
+			if dirty:
+				self.dirty[pool.id] = pool
+
+			self.__evict(pool.user_id)
+	
+
+	def mark_dirty(self, pool: 'TrackPool') -> None:
+		with self.lock:
+			if pool.id in self.pools:
+				self.dirty[pool.id] = pool
+	
+
+	def start_flusher(self) -> None:
+		if self.flusher is None:
+			self.flusher = threading.Thread(target=self.__run_flusher, name='track-pool-flusher', daemon=True)
+			self.flusher.start()
+	
+
+	def stop_flusher(self) -> None:
+		""" Останавливает периодическую запись, дожидаясь окончания текущей """
+
+		self.flusher_stopped.set()
+
+		if self.flusher is not None and self.flusher is not threading.current_thread():
+			self.flusher.join()
+	
+
+	def __run_flusher(self) -> None:
+		while not self.flusher_stopped.wait(TRACK_POOL_FLUSH_INTERVAL):
+			try:
+				self.flush()
+			except Exception as ex:
+				logger.error('Cannot save track pools', exc_info=ex)
+	
+
+	def flush(self) -> None:
+		""" Записывает в хранилище новые, изменённые и выгруженные пулы и удаляет удалённые """
+
+		if self.saver is None:
+			return
+
+		with self.save_lock:
+			with self.lock:
+				# Пул, для которого ещё не отправлено сообщение, записывается позже
+				pools = [pool for pool in self.dirty.values() if pool.message_id is not None]
+
+				for pool in pools:
+					del self.dirty[pool.id]
+
+				# Выгруженные пулы остаются в unloading до конца записи, чтобы get находил их в памяти
+				pools += self.unloading.values()
+				deleted = list(self.deleted)
+
+			if len(pools) > 0:
+				try:
+					self.saver(pools)
+				except BaseException:
+					self.__restore_dirty(pools)
+					raise
+
+			if self.deleter is not None:
+				for pool_id in deleted:
+					self.deleter(pool_id)
+
+			with self.lock:
+				for pool in pools:
+					if self.unloading.get(pool.id) is pool:
+						del self.unloading[pool.id]
+
+				self.deleted.difference_update(deleted)
+				self.flushed += len(pools)
+
+		if len(pools) > 0:
+			logger.debug(f'Flushed {len(pools)} track pools')
+
+
+	def __restore_dirty(self, pools: List['TrackPool']) -> None:
+		""" Возвращает пулы, которые не удалось записать, в очередь на запись """
+
+		with self.lock:
+			for pool in pools:
+				if pool.id in self.pools:
+					self.dirty.setdefault(pool.id, pool)
+				elif pool.id not in self.deleted:
+					self.unloading.setdefault(pool.id, pool)
+	
+
+	def touch(self, pool: 'TrackPool') -> None:
+		with self.lock:
+			if pool.id in self.pools:
+				self.pools.move_to_end(pool.id)
+				pool.last_used = time.monotonic()
+	
+
+	def remove(self, pool: 'TrackPool') -> None:
+		""" Удаляет пул из памяти. Из хранилища он удаляется при следующей записи """
+
+		with self.lock:
+			self.dirty.pop(pool.id, None)
+			self.unloading.pop(pool.id, None)
+
+			if self.__pop(pool.id) is not None and self.deleter is not None:
+				self.deleted.add(pool.id)
+	
+
+	def get(self, pool_id: Optional[int], keynum: Optional[int]) -> Optional['TrackPool']:
+		""" Возвращает пул по id или номеру трека. Если пул выгружен, загружает его из хранилища """
+
+		with self.lock:
+			pool = self.__find(self.pools, pool_id, keynum)
+			if pool is not None: return pool
+
+			# Выгруженный пул, который ещё не записан, возвращается в память без загрузки
+			pool = self.__find(self.unloading, pool_id, keynum)
+
+			if pool is not None:
+				del self.unloading[pool.id]
+				self.add(pool, dirty=True)
+				return pool
+
+			if self.loader is None or pool_id in self.deleted:
+				return None
+
+		pool = self.loader(pool_id, keynum)
+		if pool is None: return None
+
+		with self.lock:
+			if pool.id in self.deleted:
+				return None
+
+			# Пул мог быть загружен другим потоком, пока этот читал хранилище
+			current = self.pools.get(pool.id) or self.unloading.get(pool.id)
+			if current is not None:
+				return self.get(current.id, None)
+
+			self.loaded += 1
+			self.add(pool)
+
+		logger.debug(f'Track pool {pool.id} loaded from storage')
+		return pool
+
+
+	@staticmethod
+	def __find(pools: Dict[int, 'TrackPool'], pool_id: Optional[int], keynum: Optional[int]) -> Optional['TrackPool']:
+		if pool_id is not None:
+			return pools.get(pool_id)
+
+		return next((pool for pool in pools.values() if pool.find_track(keynum) is not None), None)
+
+
+	def __pop(self, pool_id: int) -> Optional['TrackPool']:
+		pool = self.pools.pop(pool_id, None)
+
+		if pool is not None:
+			count = self.user_pools[pool.user_id] - 1
+			if count > 0:
+				self.user_pools[pool.user_id] = count
+			else:
+				del self.user_pools[pool.user_id]
+		
+		return pool
+
+
+	def __evict(self, user_id: int) -> None:
+		victims: List[TrackPool] = []
+
+		# Лишние пулы пользователя, начиная с самых старых
+		if self.user_pools.get(user_id, 0) > TRACK_POOLS_PER_USER:
+			excess = self.user_pools[user_id] - TRACK_POOLS_PER_USER
+
+			for pool in list(self.pools.values()):
+				if pool.user_id == user_id:
+					victims.append(self.__pop(pool.id))
+					excess -= 1
+					if excess == 0: break
+		
+		# Самые старые пулы сверх общего лимита и давно не использовавшиеся
+		deadline = time.monotonic() - TRACK_POOL_IDLE_TIME
+
+		while len(self.pools) > 0:
+			pool = next(iter(self.pools.values()))
+
+			if len(self.pools) <= TRACK_POOLS_MAX and pool.last_used >= deadline:
+				break
+
+			victims.append(self.__pop(pool.id))
+		
+		if len(victims) == 0:
+			return
+
+		# Пулы без изменений уже есть в хранилище, остальные записываются при следующей записи
+		for pool in victims:
+			if self.dirty.pop(pool.id, None) is not None and self.saver is not None:
+				self.unloading[pool.id] = pool
+
+		self.evicted += len(victims)
+		logger.debug(f'Evicted {len(victims)} track pools')
+	
+
+	def format_stats(self) -> str:
+		with self.lock:
+			track_count = sum(len(pool) for pool in self.pools.values())
+			size = sum(pool.get_size() for pool in self.pools.values())
+
+			return f'pools: {len(self.pools)}, tracks: {track_count}, memory: ~{size // 1024} KiB, '\
+				   f'dirty: {len(self.dirty) + len(self.unloading)}, flushed: {self.flushed}, evicted: {self.evicted}, loaded: {self.loaded}'
+
+
+_registry = _TrackPoolRegistry()
+register_stats('Track pools', _registry.format_stats)
+
+
 class TrackPool:
-	""" Хранит список треков и номер последнего трека, показанного пользователю """
+	"""
+	Хранит список треков и номер последнего трека, показанного пользователю.
+	Треки хранятся по столбцам, а объекты Track создаются только при выводе страницы
+	и при нажатии на трек.
+	"""
 
-	Callback = Callable[[Track, TeleBot, int, int], None]
+	Callback = Callable[[Track, TeleBot, int, int], Optional[Awaitable[None]]]
 
-	__track_pools: Dict[int, 'TrackPool'] = []
 	__last_id = 0
  
 	@staticmethod
-	def init(track_pools: Dict[int, 'TrackPool']) -> None:
-		TrackPool.__track_pools = track_pools
-		TrackPool.__last_id = max(track_pools.keys()) if len(track_pools) > 0 else 0
+	def init(track_pools: Dict[int, 'TrackPool'], last_id: int = 0) -> None:
+		"""
+		Регистрирует загруженные пулы. last_id - наибольший id сохранённого пула,
+		нужен, если загружены не все пулы.
+		"""
+		TrackPool.__last_id = max(last_id, max(track_pools.keys(), default=0))
 
 		for pool in track_pools.values():
-			pool._setup_callbacks()
+			_registry.add(pool)
    
 	@staticmethod
 	def get_track_pools() -> Dict[int, 'TrackPool']:
-		return TrackPool.__track_pools
+		""" Возвращает пулы, находящиеся в памяти """
+		with _registry.lock:
+			return dict(_registry.pools)
+	
+	@staticmethod
+	def set_storage(loader: PoolLoader, saver: PoolSaver, deleter: PoolDeleter) -> None:
+		"""
+		Подключает хранилище пулов и запускает их периодическую запись. loader получает id пула
+		или номер трека и возвращает пул, saver сохраняет список пулов, deleter удаляет пул по id.
+		"""
+		_registry.loader = loader
+		_registry.saver = saver
+		_registry.deleter = deleter
+
+		if saver is not None:
+			_registry.start_flusher()
+	
+	@staticmethod
+	def flush() -> None:
+		""" Записывает в хранилище новые и изменённые пулы """
+		_registry.flush()
+	
+	@staticmethod
+	def close() -> None:
+		""" Останавливает периодическую запись и записывает оставшиеся пулы. Вызывается при выходе до закрытия БД """
+		_registry.stop_flusher()
+		_registry.flush()
+	
+	@staticmethod
+	def get_handler(data: str) -> Optional[ButtonHandler]:
+		""" Возвращает обработчик кнопки по её callback_data. Пул при необходимости загружается из хранилища """
+
+		button = parse_callback_data(data)
+		if button is None: return None
+
+		pool_id, keynum, action, index = button
+		pool = _registry.get(pool_id, keynum)
+		if pool is None: return None
+
+		if action == ACTION_TRACK_KEY:
+			keynum = index
+			action = ACTION_TRACK
+
+		if keynum is not None:
+			index = pool.find_track(keynum)
+		
+		return pool._get_handler(action, index)
    
 
 	def __init__(self, user_id: int, callback: Callback, tracks: List[Track] = None,
@@ -162,71 +535,242 @@ class TrackPool:
 			
 		self.id = id
 		self.callback = callback
-		self.tracks = tracks
 		self.user_id = user_id
 		self.message_id = message_id
 		self.page = page or 0
-		self.max_pages = (len(tracks) + PAGE_SIZE - 1) // PAGE_SIZE
+		self.last_used = time.monotonic()
+
+		# Треки изменились после первой записи в хранилище
+		self.tracks_changed = False
+
+		# Время последнего изменения сообщения и хэш номеров треков в нём
+		self.__last_edit = 0.0
+		self.__shown_hash: Optional[int] = None
 
-		self._setup_callbacks()
+		# Треки, переданные обработчикам. Обработчики могут их изменить, поэтому они хранятся целиком
+		self.__materialized: Dict[int, Track] = {}
+		self.__set_columns(tracks)
 		
 		if len(tracks) > 0:
-			TrackPool.__track_pools[id] = self
+			_registry.add(self, dirty=True)
+	
+
+	def __set_columns(self, tracks: List[Track]) -> None:
+		self.__urls: List[str] = [track.url for track in tracks]
+		self.__titles: List[str] = [track.title for track in tracks]
+		self.__authors: List[str] = [sys.intern(track.author) for track in tracks]
+		self.__durations = array('i', (_NO_DURATION if track.duration is None else track.duration for track in tracks))
+		self.__ids: List[Optional[int]] = [track.id for track in tracks]
+		self.__keynums = array('q', (track.keynum for track in tracks))
+		self.max_pages = (len(tracks) + PAGE_SIZE - 1) // PAGE_SIZE
+	
+
+	def set_tracks(self, tracks: List[Track]) -> None:
+		""" Заменяет треки пула. Треки, переданные обработчикам, сохраняются """
+
+		with _registry.lock:
+			materialized = { track.keynum: track for track in self.__materialized.values() }
+			self.__set_columns(tracks)
+
+			self.__materialized = {
+				i: materialized[keynum] for i, keynum in enumerate(self.__keynums) if keynum in materialized
+			}
+
+			self.page = min(self.page, max(0, self.max_pages - 1))
+			self.tracks_changed = True
    
    
 	def add_track(self, track: Track) -> None:
-		self.tracks.append(track)
-		self.max_pages = (len(self.tracks) + PAGE_SIZE - 1) // PAGE_SIZE
+		self.__urls.append(track.url)
+		self.__titles.append(track.title)
+		self.__authors.append(sys.intern(track.author))
+		self.__durations.append(_NO_DURATION if track.duration is None else track.duration)
+		self.__ids.append(track.id)
+		self.__keynums.append(track.keynum)
+		self.max_pages = (len(self) + PAGE_SIZE - 1) // PAGE_SIZE
+	
+
+	def __len__(self) -> int:
+		return len(self.__urls)
+	
+
+	def get_track(self, index: int) -> Track:
+		track = self.__materialized.get(index)
+
+		if track is not None:
+			return track
+		
+		duration = self.__durations[index]
+
+		return Track(self.__urls[index], self.__titles[index], self.__authors[index],
+					 None if duration == _NO_DURATION else duration, self.__ids[index], self.__keynums[index])
+	
+
+	@property
+	def tracks(self) -> List[Track]:
+		""" Создаёт объекты всех треков пула """
+		return [self.get_track(i) for i in range(len(self))]
    
    
-	def _setup_callbacks(self) -> None:
-		for track in self.tracks:
-			button_events[track.key] = lambda *args, _track = track: self.callback(_track, *args)
+	def find_track(self, keynum: int) -> Optional[int]:
+		""" Возвращает индекс трека с данным номером """
+		try:
+			return self.__keynums.index(keynum)
+		except ValueError:
+			return None
+	
+
+	def _get_handler(self, action: str, index: Optional[int]) -> Optional[ButtonHandler]:
+		if action == ACTION_TRACK:
+			if index is None or index >= len(self):
+				return None
+
+			return lambda *args: self.on_track_clicked(index, *args)
 		
-		if len(self.tracks) > 0:
-			button_events[self.key_print_next] = self.print_next
-			button_events[self.key_print_prev] = self.print_prev
-			button_events[self.key_delete]     = self.delete
+		if action == ACTION_NEXT:   return self.print_next
+		if action == ACTION_PREV:   return self.print_prev
+		if action == ACTION_DELETE: return self.delete
+		return None
+
+
+	def _get_callback_data(self, action: str, arg: int = 0) -> str:
+		return f'{self.id}:{action}:{arg}'
 	
 
-	def print(self, bot: TeleBot, chat_id: int):
-		""" Выводит группу треков, кнопку "Скрыть" и кнопки "Вперёд"/"Назад" """
+	def get_size(self) -> int:
+		""" Примерный объём памяти, занимаемый пулом и его треками, в байтах """
 
-		tracks_count = len(self.tracks)
-		keyboard = self._create_keyboard() if tracks_count > 0 else None
+		columns = (self.__urls, self.__titles, self.__authors, self.__durations, self.__ids, self.__keynums)
 
-		if self.message_id is None:
-			msg = word_form_by_num(tracks_count,
-					f'Найден {tracks_count} трек',
-					f'Найдены {tracks_count} трека',
-					f'Найдено {tracks_count} треков'
-			)
+		size = sys.getsizeof(self) + sys.getsizeof(self.__dict__) + sys.getsizeof(self.__materialized)
+		size += sum(map(sys.getsizeof, columns))
+		size += sum(map(sys.getsizeof, self.__urls)) + sum(map(sys.getsizeof, self.__titles))
+
+		# Авторы интернированы, поэтому одинаковые строки учитываются один раз
+		size += sum(map(sys.getsizeof, { id(author): author for author in self.__authors }.values()))
+		size += sum(map(sys.getsizeof, self.__materialized.values()))
+		
+		return size
+	
+
+	def on_track_clicked(self, index: int, *args) -> Optional[Awaitable[None]]:
+		_registry.touch(self)
+
+		track = self.__materialized.get(index)
+
+		if track is None:
+			track = self.__materialized[index] = self.get_track(index)
 
-			self.message_id = bot.send_message(chat_id, msg, reply_markup=keyboard).id
+		return self.callback(track, *args)
+	
+
+	def print(self, bot: TeleBot, chat_id: int) -> Optional[Awaitable[None]]:
+		"""
+		Выводит группу треков, кнопку "Скрыть" и кнопки "Вперёд"/"Назад".
+		Для асинхронного бота возвращает корутину.
+		"""
+
+		if _is_async(bot):
+			return self.print_async(bot, chat_id)
+
+		keyboard = self._create_keyboard() if len(self) > 0 else None
 
+		if self.message_id is None:
+			self.message_id = bot.send_message(chat_id, self._get_message(), reply_markup=keyboard).id
 		else:
 			bot.edit_message_reply_markup(chat_id, self.message_id, reply_markup=keyboard)
+		
+		self.__shown()
+		
+
+	async def print_async(self, bot, chat_id: int) -> None:
+		keyboard = self._create_keyboard() if len(self) > 0 else None
+
+		if self.message_id is None:
+			self.message_id = (await bot.send_message(chat_id, self._get_message(), reply_markup=keyboard)).id
+		else:
+			await bot.edit_message_reply_markup(chat_id, self.message_id, reply_markup=keyboard)
+		
+		self.__shown()
+	
+
+	def __content_hash(self) -> int:
+		""" Хэш номеров треков. Меняется, если треки добавились, удалились или переставились """
+		return hash(self.__keynums.tobytes())
+	
+
+	def __shown(self) -> None:
+		self.__last_edit = time.monotonic()
+		self.__shown_hash = self.__content_hash()
+		_registry.mark_dirty(self)
+	
+
+	def is_update_due(self) -> bool:
+		""" Проверяет, что с последнего изменения сообщения прошло PROGRESSIVE_EDIT_INTERVAL секунд """
+		return time.monotonic() - self.__last_edit >= PROGRESSIVE_EDIT_INTERVAL
+	
+
+	def update(self, bot: TeleBot, chat_id: int, tracks: List[Track], final: bool = False) -> Optional[Awaitable[None]]:
+		"""
+		Заменяет треки и обновляет число найденных треков и кнопки в отправленном сообщении,
+		если треки изменились. Промежуточное обновление выполняется не чаще раза
+		в PROGRESSIVE_EDIT_INTERVAL секунд, последнее (final) - всегда.
+		Для асинхронного бота возвращает корутину.
+		"""
+
+		if _is_async(bot):
+			return self.update_async(bot, chat_id, tracks, final)
+		
+		if not final and not self.is_update_due():
+			return
+		
+		self.set_tracks(tracks)
+
+		if self.message_id is not None and self.__content_hash() != self.__shown_hash:
+			bot.edit_message_text(self._get_message(), chat_id, self.message_id, reply_markup=self._create_keyboard())
+			self.__shown()
+	
+
+	async def update_async(self, bot, chat_id: int, tracks: List[Track], final: bool = False) -> None:
+		if not final and not self.is_update_due():
+			return
+		
+		self.set_tracks(tracks)
+
+		if self.message_id is not None and self.__content_hash() != self.__shown_hash:
+			await bot.edit_message_text(self._get_message(), chat_id, self.message_id, reply_markup=self._create_keyboard())
+			self.__shown()
+	
+
+	def _get_message(self) -> str:
+		tracks_count = len(self)
+
+		return word_form_by_num(tracks_count,
+				f'Найден {tracks_count} трек',
+				f'Найдены {tracks_count} трека',
+				f'Найдено {tracks_count} треков'
+		)
 	
 
 	def _create_keyboard(self):
 		keyboard = InlineKeyboardMarkup()
-		keyboard.add(InlineKeyboardButton('Скрыть', callback_data=self.key_delete))
+		keyboard.add(InlineKeyboardButton('Скрыть', callback_data=self._get_callback_data(ACTION_DELETE)))
 
-		for i in range(self.page * PAGE_SIZE, min(len(self.tracks), (self.page + 1) * PAGE_SIZE)):
-			track = self.tracks[i]
-			keyboard.add(InlineKeyboardButton(track.get_button_message(), callback_data=track.key))
+		for i in range(self.page * PAGE_SIZE, min(len(self), (self.page + 1) * PAGE_SIZE)):
+			track = self.get_track(i)
+			keyboard.add(InlineKeyboardButton(track.get_button_message(), callback_data=self._get_callback_data(ACTION_TRACK_KEY, track.keynum)))
 		
 
 		if self.max_pages > 1:
 			but_prev =\
-				InlineKeyboardButton('← Назад', callback_data=self.key_print_prev)\
+				InlineKeyboardButton('← Назад', callback_data=self._get_callback_data(ACTION_PREV))\
 				if self.page > 0 else\
 				InlineKeyboardButton(' ', callback_data='none')
 			
 			but_page = InlineKeyboardButton(f'{self.page + 1}/{self.max_pages}', callback_data='none')
 
 			but_next =\
-				InlineKeyboardButton('Вперёд →', callback_data=self.key_print_next)\
+				InlineKeyboardButton('Вперёд →', callback_data=self._get_callback_data(ACTION_NEXT))\
 				if self.page < self.max_pages - 1 else\
 				InlineKeyboardButton(' ', callback_data='none')
 			
@@ -238,28 +782,17 @@ class TrackPool:
 
 	def print_next(self, bot: TeleBot, chat_id: int, *_):
 		""" Выводит следующую группу треков """
+		_registry.touch(self)
 		self.page = min(self.max_pages - 1, self.page + 1)
-		self.print(bot, chat_id)
+		return self.print(bot, chat_id)
 
 	def print_prev(self, bot: TeleBot, chat_id: int, *_):
 		""" Выводит предыдущую группу треков """
+		_registry.touch(self)
 		self.page = max(0, self.page - 1)
-		self.print(bot, chat_id)
+		return self.print(bot, chat_id)
 	
 	
 	def delete(self, bot: TeleBot, chat_id: int, *_):
-		bot.edit_message_reply_markup(chat_id, self.message_id, reply_markup=InlineKeyboardMarkup())
-		TrackPool.__track_pools.pop(self.id, None)
-	
-
-	@property
-	def key_print_next(self):
-		return str(self.id) + '_print_next'
-
-	@property
-	def key_print_prev(self):
-		return str(self.id) + '_print_prev'
-
-	@property
-	def key_delete(self):
-		return str(self.id) + '_delete'
+		_registry.remove(self)
+		return bot.edit_message_reply_markup(chat_id, self.message_id, reply_markup=InlineKeyboardMarkup())
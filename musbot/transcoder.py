@@ -0,0 +1,216 @@
+"""
+Преобразование аудиофайлов через ffmpeg. Число одновременных процессов ffmpeg ограничено,
+процессы запускаются с пониженным приоритетом и ограниченным числом потоков, результат
+пишется во временный файл и атомарно заменяет исходный.
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+
+from typing import List, Optional, Callable, Awaitable
+
+from .probe import AudioInfo
+from .file_manager import PendingFile
+from .util import register_stats, run_steps, Steps
+
+logger = logging.getLogger('root')
+
+# Максимальное число одновременно работающих процессов ffmpeg. 0 - по числу ядер
+TRANSCODE_CONCURRENCY = int(os.environ.get('TRANSCODE_CONCURRENCY', 0)) or os.cpu_count() or 1
+
+# Число потоков одного процесса ffmpeg и его приоритет (nice, от 0 до 19)
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', 1))
+FFMPEG_NICE = int(os.environ.get('FFMPEG_NICE', 10))
+
+# Максимальное время работы одного процесса ffmpeg в секундах
+TRANSCODE_TIMEOUT = float(os.environ.get('TRANSCODE_TIMEOUT', 300))
+
+# Кодеки, которые хранятся в форматах ffmpeg
+FORMAT_CODECS = {
+	'mp3':  'mp3',
+	'ogg':  'vorbis',
+	'opus': 'opus',
+	'flac': 'flac',
+}
+
+# Что нужно сделать с файлом
+SKIP   = 'skip'   # файл уже в нужном формате
+COPY   = 'copy'   # отличается только контейнер, поток копируется без перекодирования
+ENCODE = 'encode'
+
+
+class _TranscodeStats:
+	def __init__(self) -> None:
+		self.jobs = { SKIP: 0, COPY: 0, ENCODE: 0 }
+		self.failed = 0
+		self.work_time = 0.0
+		self.audio_time = 0.0
+		self.wait_time = 0.0
+		self.max_wait_time = 0.0
+		self.running = 0
+		self.lock = threading.Lock()
+
+	def add_wait(self, wait_time: float) -> None:
+		with self.lock:
+			self.wait_time += wait_time
+			self.max_wait_time = max(self.max_wait_time, wait_time)
+			self.running += 1
+
+	def add_job(self, action: str, work_time: float, audio_time: Optional[float], ok: bool) -> None:
+		with self.lock:
+			self.running -= 1
+			self.jobs[action] += 1
+			self.work_time += work_time
+			self.audio_time += audio_time or 0
+
+			if not ok:
+				self.failed += 1
+
+	def add_skip(self) -> None:
+		with self.lock:
+			self.jobs[SKIP] += 1
+
+	def format(self) -> str:
+		with self.lock:
+			started = self.jobs[COPY] + self.jobs[ENCODE] + self.running
+
+			if started == 0:
+				return f'skipped: {self.jobs[SKIP]}, no ffmpeg jobs'
+
+			speed = self.audio_time / self.work_time if self.work_time > 0 else 0
+
+			return (f'encoded: {self.jobs[ENCODE]}, copied: {self.jobs[COPY]}, skipped: {self.jobs[SKIP]}, '
+					f'failed: {self.failed}, running: {self.running}/{TRANSCODE_CONCURRENCY}, '
+					f'speed: {speed:.1f}x realtime, '
+					f'queue wait: avg {self.wait_time / started:.2f} s, max {self.max_wait_time:.2f} s')
+
+
+_stats = _TranscodeStats()
+register_stats('Transcoder', _stats.format)
+
+_semaphore = threading.BoundedSemaphore(TRANSCODE_CONCURRENCY)
+
+
+def plan(info: AudioInfo, target_format: str, target_bitrate: int) -> str:
+	""" Возвращает SKIP, COPY или ENCODE для файла с данными параметрами """
+
+	bitrate = info.bitrate or target_bitrate
+
+	if bitrate > target_bitrate:
+		return ENCODE
+
+	if info.format_name == target_format:
+		return SKIP
+
+	if info.codec is not None and info.codec == FORMAT_CODECS.get(target_format):
+		return COPY
+
+	return ENCODE
+
+
+def ffmpeg_args(input: str, output: str, action: str, target_format: str, bitrate: int) -> List[str]:
+	""" Аргументы ffmpeg. input может быть 'pipe:0' """
+
+	codec_args = ['-c:a', 'copy'] if action == COPY else ['-b:a', str(bitrate)]
+
+	return ['ffmpeg', '-y', '-v', 'error', '-i', input, '-threads', str(FFMPEG_THREADS),
+			*codec_args, '-f', target_format, output]
+
+
+def renice(pid: int) -> None:
+	""" Понижает приоритет запущенного процесса до FFMPEG_NICE """
+
+	if FFMPEG_NICE <= 0 or not hasattr(os, 'setpriority'):
+		return
+
+	try:
+		os.setpriority(os.PRIO_PROCESS, pid, FFMPEG_NICE)
+	except OSError as ex:
+		logger.debug(f'Cannot renice process {pid}: {ex}')
+
+
+class TranscodeJob:
+	"""
+	Учитывает в статистике ожидание свободного слота (от создания задачи) и время работы ffmpeg.
+	Используется как контекстный менеджер внутри семафора, синхронного или асинхронного.
+	"""
+
+	def __init__(self, action: str, audio_time: Optional[float]) -> None:
+		self.action = action
+		self.audio_time = audio_time
+		self.created = time.monotonic()
+
+	def __enter__(self) -> 'TranscodeJob':
+		self.started = time.monotonic()
+		_stats.add_wait(self.started - self.created)
+		return self
+
+	def __exit__(self, exc_type, *_) -> None:
+		_stats.add_job(self.action, time.monotonic() - self.started, self.audio_time, exc_type is None)
+
+
+def record_skip() -> None:
+	_stats.add_skip()
+
+
+def _run_ffmpeg(args: List[str]) -> None:
+	process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	renice(process.pid)
+
+	try:
+		_, stderr = process.communicate(timeout=TRANSCODE_TIMEOUT)
+	except subprocess.TimeoutExpired:
+		process.kill()
+		process.communicate()
+		raise TimeoutError(f'ffmpeg exceeded {TRANSCODE_TIMEOUT} seconds')
+
+	if process.returncode != 0:
+		raise RuntimeError(f'ffmpeg exited with code {process.returncode}: {stderr.decode(errors="replace")}')
+
+
+def output_bitrate(info: AudioInfo, target_bitrate: int) -> int:
+	""" Битрейт результата: не выше исходного и target_bitrate """
+	return min(info.bitrate or target_bitrate, target_bitrate)
+
+
+def run_ffmpeg(args: List[str], job: TranscodeJob) -> None:
+	""" Запускает ffmpeg, когда освободится один из TRANSCODE_CONCURRENCY слотов. Асинхронная версия - в aio """
+
+	with _semaphore, job:
+		_run_ffmpeg(args)
+
+
+# Запускает ffmpeg с аргументами в слоте задачи. Возвращает None или корутину
+FfmpegRunner = Callable[[List[str], TranscodeJob], Optional[Awaitable[None]]]
+
+def transcode_steps(path: str, info: AudioInfo, target_format: str, target_bitrate: int,
+					run: FfmpegRunner = run_ffmpeg) -> Steps[AudioInfo]:
+	""" Шаги transcode_file (см. util.Steps). run запускает ffmpeg """
+
+	action = plan(info, target_format, target_bitrate)
+
+	if action == SKIP:
+		record_skip()
+		return info
+
+	bitrate = output_bitrate(info, target_bitrate)
+	_, ext = os.path.splitext(path)
+
+	with PendingFile(path, suffix=ext) as output:
+		# Задача создаётся до ожидания слота, чтобы ожидание попало в статистику
+		yield run(ffmpeg_args(path, output.name, action, target_format, bitrate), TranscodeJob(action, info.duration))
+		output.commit()
+
+	return AudioInfo(bitrate, target_format, info.duration, FORMAT_CODECS.get(target_format, info.codec))
+
+
+def transcode_file(path: str, info: AudioInfo, target_format: str, target_bitrate: int) -> AudioInfo:
+	"""
+	Преобразует файл в target_format с битрейтом не выше target_bitrate, если нужно.
+	Результат атомарно заменяет исходный файл. Возвращает параметры получившегося файла.
+	"""
+
+	return run_steps(transcode_steps(path, info, target_format, target_bitrate))
@@ -1,13 +1,15 @@
 import re
 import sys
 import time
+import asyncio
+import inspect
 import logging
 import traceback
 
 from telebot import TeleBot
 from telebot.types import ReplyKeyboardRemove, Message, CallbackQuery
-from typing import TypeVar, Callable, Tuple, Optional, Union
-from requests.exceptions import ConnectionError
+from typing import TypeVar, Callable, Awaitable, Generator, Any, Dict, Tuple, Optional, Union
+from requests.exceptions import ConnectionError, Timeout
 
 logger = logging.getLogger('root')
 
@@ -45,6 +47,58 @@ class Timer:
 		return result
 
 
+# Шаги, общие для синхронного и асинхронного кода. Это генератор, который отдаёт через yield
+# результаты вызовов ввода-вывода: в синхронном коде это готовые значения, в асинхронном - корутины,
+# результат которых возвращается в генератор. Результат шагов - значение return генератора
+Steps = Generator[Any, Any, T]
+
+def run_steps(steps: Steps[T]) -> T:
+	""" Выполняет шаги синхронно. Все вызовы уже выполнены, остаётся пройти генератор """
+
+	value = None
+
+	try:
+		while True:
+			value = steps.send(value)
+	except StopIteration as stop:
+		return stop.value
+
+
+async def run_steps_async(steps: Steps[T]) -> T:
+	""" Выполняет шаги в цикле событий, ожидая отданные ими корутины. Ошибки корутин передаются в генератор """
+
+	send, value = steps.send, None
+
+	while True:
+		try:
+			step = send(value)
+		except StopIteration as stop:
+			return stop.value
+
+		try:
+			value = await step if inspect.isawaitable(step) else step
+			send = steps.send
+		except BaseException as ex:
+			# В том числе отмена задачи, чтобы шаги освободили ресурсы в finally
+			send, value = steps.throw, ex
+
+
+def call(func: Callable[..., T], *args) -> T:
+	""" Синхронная версия aio.run_blocking для шагов """
+	return func(*args)
+
+
+# Ключ: название подсистемы, значение: функция, возвращающая её статистику
+_stats_providers: Dict[str, Callable[[], str]] = {}
+
+def register_stats(name: str, provider: Callable[[], str]) -> None:
+	""" Регистрирует статистику подсистемы для вывода командой /stats """
+	_stats_providers[name] = provider
+
+def format_stats() -> str:
+	return '\n'.join(f'{name}: {provider()}' for name, provider in _stats_providers.items())
+
+
 def word_form_by_num(num: int, word_1: str, word_2_4: str, word_many: str) -> str:
 	""" Возвращает форму слова в зависимости от числа """
 
@@ -105,6 +159,9 @@ def format_last_ex_info() -> Optional[str]:
 def _get_ex_user_message(ex: Exception) -> str:
 	""" Возврашает сообщение для пользователя """
 
+	if isinstance(ex, (Timeout, asyncio.TimeoutError)):
+		return 'Сервер не отвечает'
+
 	if isinstance(ex, ConnectionError):
 		return 'Ошибка сети'
 	
@@ -113,6 +170,7 @@ def _get_ex_user_message(ex: Exception) -> str:
 
 _MsgOrQuery = Union[Message, CallbackQuery]
 _Handler = Callable[[_MsgOrQuery], None]
+_AsyncHandler = Callable[[_MsgOrQuery], Awaitable[None]]
 
 def wrap_try_except(bot: TeleBot) -> Callable[[_Handler], _Handler]:
 	"""
@@ -131,16 +189,51 @@ def wrap_try_except(bot: TeleBot) -> Callable[[_Handler], _Handler]:
 				else:
 					chat_id = arg1.message.chat.id
 				
-				global _last_ex_info
-				_last_ex_info = sys.exc_info()
+				report_exception(bot, chat_id, ex)
+		
+		return wrapper
+	return decorator
+
+
+def wrap_try_except_async(bot) -> Callable[[_AsyncHandler], _AsyncHandler]:
+	""" То же, что и wrap_try_except, но для асинхронных обработчиков AsyncTeleBot """
+
+	def decorator(func: _AsyncHandler) -> _AsyncHandler:
+		async def wrapper(arg1: _MsgOrQuery) -> None:
+			try:
+				await func(arg1)
+			except Exception as ex:
+				if isinstance(arg1, Message):
+					chat_id = arg1.chat.id
+				else:
+					chat_id = arg1.message.chat.id
 				
-				logger.error(type(ex), exc_info=ex)
-				bot.send_message(chat_id, _get_ex_user_message(ex), reply_markup=KEYBOARD_REMOVE)
+				_save_exception(ex)
+				await bot.send_message(chat_id, _get_ex_user_message(ex), reply_markup=KEYBOARD_REMOVE)
 		
 		return wrapper
 	return decorator
 
 
+def _save_exception(ex: Exception) -> None:
+	""" Выводит стектрейс в лог и сохраняет его для /diag. Должна вызываться из блока except. """
+
+	global _last_ex_info
+	_last_ex_info = sys.exc_info()
+	
+	logger.error(type(ex), exc_info=ex)
+
+
+def report_exception(bot: TeleBot, chat_id: int, ex: Exception) -> None:
+	"""
+	Пишет пользователю сообщение об ошибке, выводит стектрейс в лог и сохраняет его для /diag.
+	Должна вызываться из блока except.
+	"""
+
+	_save_exception(ex)
+	bot.send_message(chat_id, _get_ex_user_message(ex), reply_markup=KEYBOARD_REMOVE)
+
+
 _SCHEME_REGEX = re.compile(r'^\w+://')
 
 def remove_scheme(url: str) -> str:
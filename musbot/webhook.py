@@ -0,0 +1,167 @@
+"""
+Встроенный HTTP-сервер для получения обновлений через вебхук вместо long polling.
+Запускается флагом --webhook. Сервер принимает POST-запросы с обновлениями телеграма,
+кладёт их в ограниченную очередь и сразу отвечает, а обработку выполняют рабочие потоки.
+
+Сервер работает по HTTP, поэтому для телеграма его нужно поставить за обратный прокси с HTTPS.
+Локально его можно проверить, отправив сохранённое обновление:
+	curl -X POST -H 'Content-Type: application/json' -d @update.json http://localhost:8080/
+"""
+
+import os
+import hmac
+import json
+import queue
+import logging
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from telebot.types import Update
+from typing import List, Callable, Optional
+
+from .util import register_stats
+
+logger = logging.getLogger('root')
+
+# Адрес и порт, на которых слушает сервер
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8080))
+
+# Публичный адрес вебхука, который регистрируется в телеграме. Если не задан, вебхук не регистрируется
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+
+# Секрет, который телеграм передаёт в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or None
+
+# Число потоков, обрабатывающих обновления
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 4))
+
+# Максимальное число обновлений в очереди. При переполнении сервер отвечает 503, и телеграм повторяет запрос
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', 100))
+
+# Время в секундах, через которое закрывается простаивающее соединение
+WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', 30))
+
+# Максимальный размер тела запроса
+MAX_BODY_SIZE = 1024 * 1024
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+Dispatcher = Callable[[List[Update]], None]
+
+class WebhookServer(ThreadingHTTPServer):
+	"""
+	HTTP-сервер, принимающий обновления телеграма. dispatch вызывается из рабочих потоков,
+	например TeleBot.process_new_updates для бота, созданного с threaded=False.
+	Каждое соединение обслуживается в своём потоке, поэтому keep-alive соединение не блокирует остальные.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, dispatch: Dispatcher, host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+				 workers: int = WEBHOOK_WORKERS, queue_size: int = WEBHOOK_QUEUE_SIZE,
+				 secret: Optional[str] = WEBHOOK_SECRET) -> None:
+
+		# Очередь соединений в listen() не больше очереди обновлений
+		self.request_queue_size = queue_size
+
+		super().__init__((host, port), _WebhookHandler)
+
+		self.dispatch = dispatch
+		self.secret = secret
+		self.updates: queue.Queue[Optional[Update]] = queue.Queue(queue_size)
+		self.received = 0
+		self.rejected = 0
+
+		self.__workers = [
+			threading.Thread(target=self.__run_worker, name=f'webhook-{i}', daemon=True)
+			for i in range(workers)
+		]
+
+		for worker in self.__workers:
+			worker.start()
+
+		register_stats('Webhook', self.format_stats)
+
+
+	def __run_worker(self) -> None:
+		while True:
+			update = self.updates.get()
+			if update is None: break
+
+			try:
+				self.dispatch([update])
+			except Exception as ex:
+				logger.error(f'Cannot process update {update.update_id}', exc_info=ex)
+
+
+	def server_close(self) -> None:
+		super().server_close()
+
+		for _ in self.__workers:
+			self.updates.put(None)
+
+
+	def format_stats(self) -> str:
+		return f'received: {self.received}, rejected: {self.rejected}, queued: {self.updates.qsize()}'
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+	# Поддерживает keep-alive соединения с телеграмом или балансировщиком
+	protocol_version = 'HTTP/1.1'
+	timeout = WEBHOOK_TIMEOUT
+
+	server: WebhookServer
+
+	def do_GET(self) -> None:
+		""" Проверка работоспособности для балансировщика нагрузки """
+		self.__respond(200)
+
+	def do_POST(self) -> None:
+		server = self.server
+
+		# Сравнение за постоянное время. Байты, так как compare_digest не принимает строки не из ASCII
+		secret = self.headers.get(SECRET_HEADER, '').encode('latin-1', errors='replace')
+
+		if server.secret is not None and not hmac.compare_digest(secret, server.secret.encode()):
+			self.__respond(403)
+			return
+
+		length = int(self.headers.get('Content-Length', 0))
+
+		if length <= 0 or length > MAX_BODY_SIZE:
+			self.__respond(400)
+			return
+
+		try:
+			update = Update.de_json(json.loads(self.rfile.read(length)))
+		except (ValueError, KeyError, TypeError) as ex:
+			logger.warning(f'Invalid update received: {ex}')
+			self.__respond(400)
+			return
+
+		try:
+			server.updates.put_nowait(update)
+		except queue.Full:
+			server.rejected += 1
+			self.__respond(503)
+			return
+
+		server.received += 1
+		self.__respond(200)
+
+
+	def __respond(self, code: int) -> None:
+		self.send_response(code)
+		self.send_header('Content-Length', '0')
+
+		# Тело ошибочного запроса могло остаться непрочитанным, поэтому соединение закрывается
+		if code >= 400:
+			self.send_header('Connection', 'close')
+			self.close_connection = True
+
+		self.end_headers()
+
+	def log_message(self, format: str, *args) -> None:
+		logger.debug('Webhook: ' + format % args)
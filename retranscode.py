@@ -0,0 +1,255 @@
+#!/bin/python3
+"""
+Проверяет все файлы треков после изменения TARGET_FORMAT или TARGET_BITRATE:
+сжимает файлы, которые не подходят под текущие настройки, обновляет метаданные,
+создаёт недостающие симлинки и добавляет файлы в общее хранилище.
+
+Файлы обрабатываются в пуле процессов по TRANSCODE_CONCURRENCY штук. Обработанные файлы
+записываются в файл состояния, поэтому прерванный запуск продолжается с места остановки,
+а повторный запуск проверяет только изменившиеся файлы. Флаг --full обрабатывает все файлы заново.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Tuple, Optional, NamedTuple
+
+from musbot import database, file_manager, audio_store, transcoder
+from musbot.probe import AudioInfo, probe_file
+from musbot.tracks import Track
+from musbot.track_processor import TARGET_FORMAT, TARGET_BITRATE
+
+logger = logging.getLogger('root')
+
+STATE_PATH = os.path.join(file_manager.TRACKS_DIR, 'retranscode-state.json')
+
+# Как часто сохраняется состояние и выводится прогресс
+STATE_SAVE_INTERVAL = 10
+PROGRESS_INTERVAL = 2
+
+
+class Result(NamedTuple):
+	track_id: int
+	action: str
+	digest: Tuple[str, int]
+	info: AudioInfo
+	changed: bool  # содержимое файла трека изменилось
+
+
+def process_group(tracks: List[Track], info: Optional[AudioInfo] = None) -> List[Result]:
+	"""
+	Обрабатывает треки с общим файлом (жёсткие ссылки на один файл хранилища).
+	Файл сжимается один раз, остальные треки становятся ссылками на результат. Выполняется в пуле процессов.
+	info - сохранённые в БД параметры файла, если он не менялся с их определения.
+	"""
+
+	path = file_manager.get_track_path(tracks[0])
+
+	# В БД не хранится кодек, поэтому файл, который нужно преобразовать, проверяется заново
+	if info is None or transcoder.plan(info, TARGET_FORMAT, TARGET_BITRATE) != transcoder.SKIP:
+		info = probe_file(path)
+
+	action = transcoder.plan(info, TARGET_FORMAT, TARGET_BITRATE)
+
+	if action != transcoder.SKIP:
+		info = transcoder.transcode_file(path, info, TARGET_FORMAT, TARGET_BITRATE)
+
+		for track in tracks[1:]:
+			file_manager.link_file(path, file_manager.get_track_path(track))
+
+	results = []
+	digests: Dict[Tuple[int, int], Tuple[str, int]] = {}
+
+	for track in tracks:
+		# Метаданные записываются, только если отличаются, и создаётся симлинк, если его нет.
+		# Трек с другими метаданными получает свою копию файла
+		tags = file_manager.update_track(track)
+
+		stat = os.stat(file_manager.get_track_path(track))
+		key = (stat.st_ino, stat.st_mtime_ns)
+
+		if key not in digests:
+			digests[key] = file_manager.hash_track(track)
+
+		changed = action != transcoder.SKIP or tags != file_manager.TAGS_UNCHANGED
+		results.append(Result(track.id, action, digests[key], info, changed))
+
+	return results
+
+
+class State:
+	""" Файлы, обработанные с текущими настройками. Ключ: id трека, значение: mtime_ns и размер файла """
+
+	def __init__(self, path: str, full: bool) -> None:
+		self.path = path
+		self.target = f'{TARGET_FORMAT}:{TARGET_BITRATE}'
+		self.files: Dict[str, List[int]] = {}
+
+		# Файлы, обработанные прошлым запуском с любыми настройками. Их параметры в БД актуальны
+		self.probed: Dict[str, List[int]] = {}
+
+		if not full and os.path.exists(path):
+			with open(path) as file:
+				data = json.load(file)
+
+			self.probed = data['files']
+
+			# После смены настроек все файлы проверяются заново
+			if data.get('target') == self.target:
+				self.files = dict(self.probed)
+
+	def is_done(self, track: Track, stat: os.stat_result) -> bool:
+		return self.files.get(str(track.id)) == [stat.st_mtime_ns, stat.st_size]
+
+	def is_probed(self, track: Track, stat: os.stat_result) -> bool:
+		return self.probed.get(str(track.id)) == [stat.st_mtime_ns, stat.st_size]
+
+	def set_done(self, track: Track) -> None:
+		stat = os.stat(file_manager.get_track_path(track))
+		self.files[str(track.id)] = [stat.st_mtime_ns, stat.st_size]
+
+	def save(self) -> None:
+		tmp_path = self.path + '.tmp'
+
+		with open(tmp_path, 'w') as file:
+			json.dump({ 'target': self.target, 'files': self.files }, file)
+
+		os.replace(tmp_path, self.path)
+
+
+class Progress:
+	def __init__(self, total: int) -> None:
+		self.total = total
+		self.done = 0
+		self.actions = defaultdict(int)
+		self.errors = 0
+		self.start = time.monotonic()
+		self.last_print = 0.0
+
+	def add(self, results: List[Result]) -> None:
+		self.done += len(results)
+
+		for result in results:
+			self.actions[result.action] += 1
+
+	def add_error(self, count: int) -> None:
+		self.done += count
+		self.errors += count
+
+	def print(self, force: bool = False) -> None:
+		now = time.monotonic()
+		if not force and now - self.last_print < PROGRESS_INTERVAL:
+			return
+
+		self.last_print = now
+		elapsed = now - self.start
+		speed = self.done / elapsed if elapsed > 0 else 0
+		eta = (self.total - self.done) / speed if speed > 0 else 0
+
+		print(f'{self.done}/{self.total} ({self.done * 100 // max(self.total, 1)}%), '
+			  f'encoded: {self.actions[transcoder.ENCODE]}, copied: {self.actions[transcoder.COPY]}, '
+			  f'unchanged: {self.actions[transcoder.SKIP]}, errors: {self.errors}, '
+			  f'{speed:.1f} files/s, ETA {eta:.0f} s', flush=True)
+
+
+def _group_by_file(tracks: List[Track], state: State) -> Tuple[List[List[Track]], int, int]:
+	""" Группирует треки по файлу (inode). Возвращает группы, число обработанных ранее и отсутствующих файлов """
+
+	groups: Dict[Tuple[int, int], List[Track]] = defaultdict(list)
+	done = 0
+	missing = 0
+
+	for track in tracks:
+		try:
+			stat = os.stat(file_manager.get_track_path(track))
+		except FileNotFoundError:
+			missing += 1
+			continue
+
+		if state.is_done(track, stat):
+			# Симлинк мог быть удалён после прошлого запуска
+			file_manager.create_track_symlink(track)
+			done += 1
+			continue
+
+		groups[stat.st_dev, stat.st_ino].append(track)
+
+	return list(groups.values()), done, missing
+
+
+def _stored_info(track: Track, state: State) -> Optional[AudioInfo]:
+	""" Параметры файла из БД, если файл не менялся с прошлого запуска """
+
+	if not state.is_probed(track, os.stat(file_manager.get_track_path(track))):
+		return None
+
+	return database.get_audio_info(track.id)
+
+
+def main(full: bool = False) -> None:
+	database.init()
+
+	tracks = database.get_all_tracks()
+	tracks_by_id = { track.id: track for track in tracks }
+
+	state = State(STATE_PATH, full)
+	groups, done, missing = _group_by_file(tracks, state)
+
+	print(f'{len(tracks)} tracks: {done} already processed, {missing} files missing, '
+		  f'{sum(map(len, groups))} to check', flush=True)
+
+	progress = Progress(sum(map(len, groups)))
+	last_save = time.monotonic()
+
+	executor = ProcessPoolExecutor(transcoder.TRANSCODE_CONCURRENCY)
+
+	try:
+		futures = { executor.submit(process_group, group, _stored_info(group[0], state)): group for group in groups }
+
+		for future in as_completed(futures):
+			try:
+				results = future.result()
+			except Exception as ex:
+				logger.error(f'Cannot process tracks {[track.id for track in futures[future]]}', exc_info=ex)
+				progress.add_error(len(futures[future]))
+				continue
+
+			for result in results:
+				track = tracks_by_id[result.track_id]
+				audio_store.store(track, result.digest)
+				database.set_audio_info(track.id, result.info)
+
+				# Загруженный в телеграм файл устарел и больше не отправляется по file_id
+				if result.changed:
+					database.set_file_id(track.id, None)
+
+				# Файл может быть заменён ссылкой на такой же файл в хранилище, поэтому состояние записывается после
+				state.set_done(track)
+
+			progress.add(results)
+			progress.print()
+
+			if time.monotonic() - last_save >= STATE_SAVE_INTERVAL:
+				state.save()
+				last_save = time.monotonic()
+
+	except KeyboardInterrupt:
+		print('Interrupted, progress is saved', flush=True)
+		executor.shutdown(wait=False, cancel_futures=True)
+		raise
+
+	finally:
+		state.save()
+		database.cleanup()
+
+	executor.shutdown()
+	progress.print(force=True)
+
+
+if __name__ == '__main__':
+	main(full='--full' in sys.argv[1:])
@@ -1,8 +1,32 @@
 import re
 
+import os
+import json
+import contextlib
+import time
+import itertools
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import psycopg2.pool
+import http.client
+import urllib.request
+import urllib.parse
+
 from timeit import timeit
-from musbot.util import AUTHOR_NAME_REGEX, AUTHOR_REGEX, TITLE_REGEX, add_scheme, remove_scheme
-from musbot.track_loader import TIME_REGEX
+from telebot.apihelper import ApiTelegramException
+from mutagen.easyid3 import EasyID3
+from bs4 import BeautifulSoup
+from musbot.util import AUTHOR_NAME_REGEX, AUTHOR_REGEX, TITLE_REGEX, add_scheme, remove_scheme, run_steps
+from musbot.track_loader import TIME_REGEX, HREF_REGEX, HREF_REPL, LIGAUDIO_TRACK_SOURCE, HITMOS_TRACK_SOURCE
+from musbot.search_cache import SearchCache, CachedPage
+from musbot.jobs import FairQueue
+from musbot.webhook import WebhookServer
+from musbot.tracks import Track, TrackPool
+from musbot import tracks, authors, track_loader, track_processor, file_manager, probe, transcoder, database
+from musbot.authors import AuthorNormalizer, AUTHORS, AUTHOR_ALIASES, FEAT_REGEX, FEAT_REPL, SEPARATOR_REGEX, SEPARATOR_REPL,\
+		get_author_normalizer
 
 
 def test():
@@ -80,9 +104,864 @@ def test_time_regex():
 	assert match.group(2) == '0'
 
 
+def test_search_cache():
+	cache = SearchCache(ttl=3600, max_size=2)
+	page = CachedPage([('host/track', 'Title', 'Author', 60)], [])
+
+	cache.put(('src', 'a', 'url1'), page)
+	cache.put(('src', 'b', 'url2'), page)
+	assert cache.get(('src', 'a', 'url1')) is page
+
+	# url2 - самая старая запись, она вытесняется
+	cache.put(('src', 'c', 'url3'), page)
+	assert cache.get(('src', 'b', 'url2')) is None
+	assert cache.get(('src', 'a', 'url1')) is page
+	assert cache.hits == 2 and cache.misses == 1
+
+	cache = SearchCache(ttl=0, max_size=2)
+	cache.put(('src', 'a', 'url1'), page)
+	assert cache.get(('src', 'a', 'url1')) is None
+
+
+def test_fair_queue():
+	queue = FairQueue()
+	queue.put(1, 'a1')
+	queue.put(1, 'a2')
+	queue.put(1, 'a3')
+	queue.put(2, 'b1')
+	queue.put(3, 'c1')
+	queue.put(2, 'b2')
+
+	jobs = [queue.get()[1] for _ in range(len(queue))]
+	assert jobs == ['a1', 'b1', 'c1', 'a2', 'b2', 'a3']
+
+
+def test_webhook():
+	received = []
+	done = threading.Event()
+
+	def dispatch(updates):
+		received.extend(updates)
+		done.set()
+
+	server = WebhookServer(dispatch, '127.0.0.1', 0, workers=1, queue_size=10, secret='secret')
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	url = f'http://127.0.0.1:{server.server_address[1]}/'
+
+	update = {
+		'update_id': 1,
+		'message': {
+			'message_id': 2, 'date': 0, 'text': 'Kanaria',
+			'chat': {'id': 3, 'type': 'private'},
+			'from': {'id': 3, 'is_bot': False, 'first_name': 'User'},
+		},
+	}
+
+	def post(secret):
+		request = urllib.request.Request(url, json.dumps(update).encode(), {
+			'Content-Type': 'application/json',
+			'X-Telegram-Bot-Api-Secret-Token': secret,
+		})
+
+		try:
+			return urllib.request.urlopen(request).status
+		except urllib.error.HTTPError as error:
+			return error.code
+
+	# Простаивающее keep-alive соединение не должно блокировать другие
+	idle = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=5)
+	idle.request('GET', '/')
+	assert idle.getresponse().status == 200
+
+	assert post('wrong') == 403
+	assert post('sécret') == 403
+	assert post('secret') == 200
+	assert done.wait(5)
+	assert received[0].message.text == 'Kanaria'
+
+	idle.close()
+
+	server.shutdown()
+	server.server_close()
+
+
+def test_db_pool_wait():
+	# Пул psycopg2 бросает PoolError, если соединений не хватает, поэтому лишние потоки должны ждать
+	class FakeConnection:
+		closed = 0
+
+		def cursor(self):
+			return contextlib.nullcontext(None)
+
+		def commit(self):
+			time.sleep(0.01)
+
+	class FakePool:
+		def __init__(self, size):
+			self.free = [FakeConnection() for _ in range(size)]
+			self.lock = threading.Lock()
+
+		def getconn(self):
+			with self.lock:
+				if not self.free:
+					raise psycopg2.pool.PoolError('connection pool exhausted')
+				return self.free.pop()
+
+		def putconn(self, conn, close=False):
+			with self.lock:
+				self.free.append(conn)
+
+	errors = []
+
+	def query():
+		try:
+			with database._cursor('test'):
+				pass
+		except Exception as ex:
+			errors.append(ex)
+
+	old_pool, old_slots = getattr(database, '_pool', None), database._pool_slots
+	database._pool, database._pool_slots = FakePool(2), threading.BoundedSemaphore(2)
+
+	try:
+		threads = [threading.Thread(target=query) for _ in range(8)]
+		for thread in threads: thread.start()
+		for thread in threads: thread.join()
+	finally:
+		database._pool, database._pool_slots = old_pool, old_slots
+
+	assert errors == []
+
+
+def test_track_pool_registry():
+	storage = {}
+
+	def load(pool_id, keynum):
+		if pool_id is None:
+			pool_id = next((pool.id for pool in storage.values() for track in pool.tracks if track.keynum == keynum), None)
+
+		return storage.get(pool_id)
+
+	def save(pools):
+		saved.extend(pool.id for pool in pools)
+		storage.update((pool.id, pool) for pool in pools)
+
+	saved = []
+	TrackPool.set_storage(load, save, lambda pool_id: storage.pop(pool_id, None))
+	per_user = tracks.TRACK_POOLS_PER_USER
+	tracks.TRACK_POOLS_PER_USER = 2
+
+	try:
+		callback = lambda track, *_: track.title
+		pools = [TrackPool(user_id=1, callback=callback, tracks=[Track(f'url{i}', f'title{i}', 'author', 1)]) for i in range(3)]
+
+		in_memory = TrackPool.get_track_pools()
+		assert pools[0].id not in in_memory and pools[1].id in in_memory and pools[2].id in in_memory
+
+		# Выгруженный пул записывается в хранилище при следующей записи, а не при вытеснении
+		assert saved == []
+		TrackPool.flush()
+		assert saved == [pools[0].id]
+
+		# Кнопка выгруженного пула загружает его обратно и вытесняет самый старый из оставшихся
+		assert TrackPool.get_handler(f'{pools[0].id}:t:0')(None, 0, 0) == 'title0'
+		assert pools[0].id in TrackPool.get_track_pools()
+		TrackPool.flush()
+		assert saved == [pools[0].id, pools[1].id]
+
+		# Кнопки в старом формате
+		assert TrackPool.get_handler(str(pools[1].tracks[0].keynum))(None, 0, 0) == 'title1'
+		TrackPool.flush()
+		assert TrackPool.get_handler(f'{pools[2].id}_print_next') is not None
+
+		# Пулы без изменений повторно не сохраняются
+		assert saved == [pools[0].id, pools[1].id, pools[2].id]
+
+		pools[1].message_id = 1
+		tracks._registry.mark_dirty(pools[1])
+		TrackPool.flush()
+		assert saved[-1] == pools[1].id
+
+		assert TrackPool.get_handler(f'{pools[2].id}:t:1') is None
+		assert TrackPool.get_handler(f'{pools[2].id}:x:0') is None
+		assert TrackPool.get_handler('unknown') is None
+		assert TrackPool.get_handler('none') is None
+
+		# Выгруженный, но ещё не записанный пул возвращается из памяти, а не из хранилища
+		tracks._registry.mark_dirty(pools[1])
+		TrackPool(user_id=1, callback=callback, tracks=[Track('url3', 'title3', 'author', 1)])
+		assert pools[1].id in tracks._registry.unloading
+
+		loaded = tracks._registry.loaded
+		storage.clear()
+		assert TrackPool.get_handler(f'{pools[1].id}:t:0')(None, 0, 0) == 'title1'
+		assert tracks._registry.loaded == loaded and pools[1].id not in tracks._registry.unloading
+
+		# Удалённый пул удаляется из хранилища при следующей записи
+		TrackPool.flush()
+		tracks._registry.remove(pools[1])
+		assert pools[1].id in storage
+		TrackPool.flush()
+		assert pools[1].id not in storage and len(tracks._registry.deleted) == 0
+
+		# При выходе периодическая запись останавливается, а оставшиеся пулы записываются
+		pools[2].message_id = 2
+		tracks._registry.add(pools[2], dirty=True)
+		TrackPool.close()
+		assert not tracks._registry.flusher.is_alive() and pools[2].id in storage
+
+	finally:
+		tracks.TRACK_POOLS_PER_USER = per_user
+		TrackPool.set_storage(None, None, None)
+
+
+def test_track_pool_columns():
+	source = [Track(f'url{i}', f'title{i}', 'author', None if i == 1 else i, id=i if i % 2 else None) for i in range(3)]
+	pool = TrackPool(user_id=2, callback=lambda track, *_: track)
+
+	for track in source:
+		pool.add_track(track)
+
+	assert len(pool) == 3
+	assert pool.tracks == source
+	assert pool.get_track(1).duration is None
+	assert pool.find_track(source[2].keynum) == 2
+	assert pool.find_track(-1) is None
+
+	# Треки создаются в нескольких потоках поиска, номера не должны повторяться
+	keynums = []
+
+	def create_tracks():
+		keynums.extend(Track('url', 'title', 'author', None).keynum for _ in range(10000))
+	
+	threads = [threading.Thread(target=create_tracks) for _ in range(4)]
+
+	for thread in threads: thread.start()
+	for thread in threads: thread.join()
+
+	assert len(set(keynums)) == len(keynums)
+
+	# Изменения трека, переданного обработчику, сохраняются в пуле
+	clicked = pool._get_handler('t', 0)(None, 0, 0)
+	clicked.title = 'changed'
+	assert pool.get_track(0) is clicked
+	assert pool.tracks[0].title == 'changed'
+
+
+class _FakeTrackSource(track_loader.TrackSource):
+	def __init__(self, name, links):
+		self.name = name
+		self.links = links
+	
+	def get_search_url(self, request):
+		return f'{self.name}/0'
+	
+	def load_page(self, url, request, req_title, req_author):
+		page_num = int(url.rsplit('/', 1)[1])
+		time.sleep(0.05 * page_num)
+
+		rows = [Track(f'{url}/{i}', f'title {i}', 'author', 1) for i in range(10)]
+		return track_loader.Page(rows, [f'{self.name}/{i}' for i in range(1, self.links + 1)] if page_num == 0 else [])
+
+
+def test_search_limits():
+	assert track_loader._matches('Kasane Teto - Brain', 'teto  KASANE')
+	assert not track_loader._matches('Kasane Teto', 'teto miku')
+	assert track_loader._matches('anything', None)
+
+	sources = track_loader.TRACK_SOURCES
+	track_loader.TRACK_SOURCES = [_FakeTrackSource('a', 5), _FakeTrackSource('b', 0)]
+
+	try:
+		# Первые страницы всех источников загружаются всегда, остальные - пока не набрано 25 треков
+		pages = track_loader._fetch_pages('request', None, None, max_results=25)
+		assert sorted(pages) == [(0, 0), (0, 1), (1, 0)]
+
+		pages = track_loader._fetch_pages('request', None, None, max_results=0)
+		assert len(pages) == 7
+	
+	finally:
+		track_loader.TRACK_SOURCES = sources
+
+
+class _FakeMessage:
+	id = 1
+
+
+class _FakeBot:
+	def __init__(self):
+		self.edits = []
+	
+	def send_message(self, chat_id, text, reply_markup=None):
+		return _FakeMessage()
+	
+	def edit_message_text(self, text, chat_id, message_id, reply_markup=None):
+		self.edits.append(text)
+
+
+def test_progressive_search():
+	sources = track_loader.TRACK_SOURCES
+	track_loader.TRACK_SOURCES = [_FakeTrackSource('a', 2), _FakeTrackSource('b', 0)]
+
+	try:
+		updates = []
+		found = track_loader.load_tracks('request', None, None, max_results=0, on_update=lambda t: updates.append(len(t)))
+		assert updates == [10, 20, 30, 40] and len(found) == 40
+	
+	finally:
+		track_loader.TRACK_SOURCES = sources
+	
+	interval = tracks.PROGRESSIVE_EDIT_INTERVAL
+	tracks.PROGRESSIVE_EDIT_INTERVAL = 0
+
+	try:
+		bot = _FakeBot()
+		pool = TrackPool(user_id=3, tracks=found[5:10], callback=lambda track, *_: track)
+		pool.print(bot, 0)
+
+		# Кнопка трека ссылается на keynum и остаётся верной после пересортировки
+		clicked = TrackPool.get_handler(f'{pool.id}:k:{found[7].keynum}')(None, 0, 0)
+		assert clicked.keynum == found[7].keynum
+
+		pool.update(bot, 0, found)
+		assert len(bot.edits) == 1 and pool.tracks_changed
+		assert pool.get_track(7) is clicked
+
+		# Без новых треков сообщение не изменяется
+		pool.update(bot, 0, found, final=True)
+		assert len(bot.edits) == 1
+
+		# Сообщение изменяется, если треки другие, даже при том же числе треков
+		pool.update(bot, 0, found[:20] + found[:-21:-1])
+		assert len(bot.edits) == 2
+
+		# Промежуточное обновление ждёт интервала, последнее выполняется сразу
+		tracks.PROGRESSIVE_EDIT_INTERVAL = 60
+		pool.update(bot, 0, found[:10])
+		assert len(bot.edits) == 2
+
+		start = time.monotonic()
+		pool.update(bot, 0, found[:10], final=True)
+		assert len(bot.edits) == 3 and time.monotonic() - start < 1
+	
+	finally:
+		tracks.PROGRESSIVE_EDIT_INTERVAL = interval
+	
+	# Порядок добавления страниц не влияет на результат
+	pages = [((0, 0), found[20:30]), ((1, 0), found[:10]), ((0, 1), found[5:25])]
+	expected = sorted((track for _, page in sorted(pages) for track in page), key=Track.sort_key)
+
+	for order in itertools.permutations(pages):
+		results = track_loader.SearchResults()
+
+		for key, page in order:
+			results.add_page(key, page)
+		
+		assert len(results) == 40 and results.get_tracks() == expected
+
+
+def test_file_id_errors():
+	track = Track('url', 'title', 'author', None, id=1)
+
+	def error(code, description):
+		return ApiTelegramException('sendAudio', None, {'error_code': code, 'description': description})
+
+	assert track_processor.is_file_id_rejected(track, error(400, 'Bad Request: wrong file identifier/HTTP URL specified'))
+	assert track_processor.is_file_id_rejected(track, error(400, 'Bad Request: FILE_REFERENCE_EXPIRED'))
+	assert not track_processor.is_file_id_rejected(track, error(400, 'Bad Request: chat not found'))
+	assert not track_processor.is_file_id_rejected(track, error(400, "Bad Request: can't parse entities"))
+	assert not track_processor.is_file_id_rejected(track, error(403, 'Forbidden: bot was blocked by the user'))
+
+
+def test_audio_store_files():
+	tracks_dir = file_manager.TRACKS_DIR
+
+	with tempfile.TemporaryDirectory() as directory:
+		file_manager.TRACKS_DIR = directory
+		os.makedirs(os.path.join(directory, 'DB'))
+
+		try:
+			first = Track('url', 'title', 'author', 10, id=1)
+			second = Track('url', 'title', 'author', 10, id=2)
+			path = file_manager.get_track_path(first)
+
+			with open(path, 'wb') as file:
+				file.write(b'\0' * 4096)
+			
+			EasyID3().save(path)
+			assert file_manager.update_track(first) == file_manager.TAGS_UPDATED
+			sha256, size = file_manager.hash_track(first)
+
+			assert file_manager.store_audio(first, sha256)
+			assert file_manager.link_audio(second, sha256)
+			assert os.stat(path).st_nlink == 3
+
+			# Те же метаданные - файл остаётся общим
+			assert not file_manager.update_track(second)
+			assert os.path.samefile(path, file_manager.get_track_path(second))
+
+			# Другие метаданные - трек получает свою копию, общий файл не меняется
+			second.title = 'other'
+			assert file_manager.update_track(second, own_links=2) == file_manager.TAGS_UNSHARED
+			assert os.stat(path).st_nlink == 2
+			assert file_manager.hash_track(first) == (sha256, size)
+
+			# Файл хранилища, на который ссылается только один трек, изменяется на месте
+			first.title = 'other'
+			assert file_manager.update_track(first, own_links=2) == file_manager.TAGS_UPDATED
+			assert os.stat(path).st_nlink == 2
+			assert os.path.samefile(path, file_manager.get_audio_path(sha256))
+
+			# Такой же файл по другой ссылке не дублируется
+			third = Track('url3', 'title', 'author', 10, id=3)
+			shutil.copyfile(path, file_manager.get_track_path(third))
+			assert not file_manager.store_audio(third, sha256)
+			assert os.stat(path).st_nlink == 3
+
+			file_manager.delete_audio(sha256)
+			assert not file_manager.link_audio(second, sha256)
+		
+		finally:
+			file_manager.TRACKS_DIR = tracks_dir
+
+
+def test_track_sort():
+	tracks = [
+		Track('url1', 'title', 'b', 10),
+		Track('url2', 'title', 'A', 10),
+		Track('url3', 'Title', 'a', 10),
+		Track('url4', 'title', 'a', None),
+		Track('url5', 'title', 'a', 5),
+		Track('url0', 'title', 'a', 5),
+	]
+
+	expected = [tracks[1], tracks[2], tracks[3], tracks[5], tracks[4], tracks[0]]
+	assert sorted(tracks, key=Track.sort_key) == expected
+	assert sorted(tracks) == expected
+
+
+def time_track_sort():
+	tracks = [Track(f'url{i}', f'Title {i * 7919 % 10000}', f'Author {i % 300}', i % 600) for i in range(10000)]
+
+	time1 = timeit(lambda: sorted(tracks), number=20)
+	time2 = timeit(lambda: sorted(tracks, key=Track.sort_key), number=20)
+
+	print(f'__lt__: {time1:.3f}s, sort_key: {time2:.3f}s: {(time2 - time1) / time1 * 100 :.1f}%')
+
+
+_SEQUENTIAL_TABLE = [(re.compile(rf'\b{re.escape(name)}\b', re.I), name) for name in AUTHORS] +\
+		[(re.compile(pattern), name) for pattern, name in AUTHOR_ALIASES]
+
+def _normalize_author_sequential(author):
+	""" Прежняя реализация: отдельный проход для каждой записи таблицы """
+
+	author = re.sub(FEAT_REGEX, FEAT_REPL, author)
+	author = re.sub(SEPARATOR_REGEX, SEPARATOR_REPL, author)
+
+	for regex, name in _SEQUENTIAL_TABLE:
+		author = re.sub(regex, name, author)
+	
+	return author
+
+_AUTHOR_SAMPLES = [
+	'hatsune miku', 'HATSUNE MIKU feat. kagamine rin', 'Kasane Teto ft. Ado', 'deco*27 & gumi',
+	'ado x kasane teto', 'Planya channel', 'planya channel', '黒うさp', 'Yuyoyuppe, ZHIEND', 'ёлка',
+	'Mikuo', 'Unknown Author', 'se[l] ei', 'may\'n', 'Alan Walker,Noisia',
+]
+
+def test_author_normalizer():
+	normalizer = get_author_normalizer()
+
+	for author in _AUTHOR_SAMPLES:
+		assert normalizer.normalize(author) == _normalize_author_sequential(author), author
+	
+	assert normalizer.normalize('HATSUNE MIKU feat. kagamine rin') == 'Hatsune Miku feat. Kagamine Rin'
+	assert normalizer.normalize('Mikuo') == 'Mikuo'
+
+	custom = AuthorNormalizer([(r'\bab\b', 'AB', True), (r'\bab cd\b', 'Ab Cd', True)])
+	assert custom.normalize('ab cd, ab') == 'Ab Cd, AB'
+
+	# Файл авторов подхватывается без перезапуска
+	with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+		file.write('# comment\nSome Author\nmiku-chan => Hatsune Miku\n')
+	
+	try:
+		authors.AUTHORS_FILE = file.name
+		assert get_author_normalizer().normalize('some author, Miku-Chan') == 'Some Author, Hatsune Miku'
+	finally:
+		authors.AUTHORS_FILE = None
+		os.remove(file.name)
+
+
+def time_author_normalizer():
+	normalizer = AuthorNormalizer(get_author_normalizer().table)
+	authors = [f'{author} #{i}' for i in range(200) for author in _AUTHOR_SAMPLES]
+
+	time1 = timeit(lambda: [_normalize_author_sequential(author) for author in authors], number=1)
+	time2 = timeit(lambda: [normalizer.normalize(author) for author in authors], number=1)
+	time3 = timeit(lambda: [normalizer.normalize(author) for author in authors], number=1)
+
+	count = len(authors)
+	print(f'per track: sequential {time1 / count * 1e6:.1f}us, compiled {time2 / count * 1e6:.1f}us, '
+		  f'cached {time3 / count * 1e6:.2f}us')
+
+
+def _parse_page_bs4(source, html):
+	""" Прежняя реализация SimpleTrackSource.parse_page на BeautifulSoup """
+
+	soup = BeautifulSoup(html, 'lxml')
+	rows = []
+
+	for tag in soup.find_all(attrs=source.track_attrs):
+		href = re.sub(HREF_REGEX, HREF_REPL, tag.find('a', source.link_attrs)['href'])
+		title = tag.find(attrs=source.title_attrs).get_text(strip=True)
+		author = tag.find(attrs=source.author_attrs).get_text(strip=True)
+
+		match = re.search(TIME_REGEX, tag.find(attrs=source.time_attrs).get_text(strip=True))
+
+		if match is not None:
+			duration = int(match.group(1)) * 60 + int(match.group(2))
+
+			if match.group(3):
+				duration = duration * 60 + int(match.group(3))
+		else:
+			duration = -1
+
+		rows.append((remove_scheme(href), title, author, duration))
+	
+	links = []
+	pagination = soup.find(attrs=source.pagination_attrs)
+
+	if pagination is not None:
+		for link in pagination.find_all('a'):
+			if 'this' not in link.get_attribute_list('class'):
+				links.append(urllib.parse.urljoin(source.host, link['href']))
+	
+	return CachedPage(rows, links)
+
+
+def _read_fixture(name):
+	with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', name), encoding='utf-8') as file:
+		return file.read()
+
+_FIXTURES = [(LIGAUDIO_TRACK_SOURCE, 'ligaudio.html'), (HITMOS_TRACK_SOURCE, 'hitmotop.html')]
+
+def test_parse_page():
+	for source, name in _FIXTURES:
+		html = _read_fixture(name)
+		page = source.parse_page(html)
+
+		assert len(page.rows) > 0 and len(page.links) > 0, name
+		assert page == _parse_page_bs4(source, html), name
+	
+	page = LIGAUDIO_TRACK_SOURCE.parse_page(_read_fixture('ligaudio.html'))
+	assert page.rows[0][0].startswith('web.ligaudio.ru/dl/')
+	assert page.rows[7][3] == -1
+	assert page.rows[11][3] == 3723
+	assert page.links[0] == 'https://web.ligaudio.ru/mp3/kasane%20teto/2'
+
+	assert LIGAUDIO_TRACK_SOURCE.parse_page('') == CachedPage([], [])
+
+
+def time_parse_page():
+	for source, name in _FIXTURES:
+		html = _read_fixture(name)
+
+		time1 = timeit(lambda: _parse_page_bs4(source, html), number=100)
+		time2 = timeit(lambda: source.parse_page(html), number=100)
+
+		print(f'{name}: bs4 {100 / time1:.0f} pages/s, lxml {100 / time2:.0f} pages/s, {time1 / time2:.1f}x')
+
+
+def _write_mp3(path, frames):
+	""" Записывает файл из пустых кадров MPEG-1 Layer III, 128 кбит/с, 44100 Гц """
+	with open(path, 'wb') as file:
+		file.write((b'\xff\xfb\x90\x00' + b'\0' * 413) * frames)
+
+
+def test_probe():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'track.mp3')
+		_write_mp3(path, 200)
+
+		info = probe.probe_file(path)
+		assert info.bitrate == 128000 and info.format_name == 'mp3'
+		assert round(info.duration) == 5
+
+		with open(path, 'rb') as file:
+			assert probe.probe_head(file.read(16 * 1024))[:2] == (128000, 'mp3')
+		
+		assert probe.probe_file(path).codec == 'mp3'
+		assert probe.probe_head(b'not an audio file') == (None, None, None, None)
+
+
+def test_transcoder():
+	mp3 = probe.AudioInfo(128000, 'mp3', 10.0, 'mp3')
+	assert transcoder.plan(mp3, 'mp3', 192000) == transcoder.SKIP
+	assert transcoder.plan(mp3, 'mp3', 96000) == transcoder.ENCODE
+	assert transcoder.plan(probe.AudioInfo(128000, 'mov,mp4,m4a,3gp,3g2,mj2', 10.0, 'mp3'), 'mp3', 192000) == transcoder.COPY
+	assert transcoder.plan(probe.AudioInfo(128000, 'flac', 10.0, 'flac'), 'mp3', 192000) == transcoder.ENCODE
+
+	args = transcoder.ffmpeg_args('in file.wav', 'out.mp3', transcoder.COPY, 'mp3', 128000)
+	assert args[args.index('-i') + 1] == 'in file.wav' and args[args.index('-c:a') + 1] == 'copy'
+
+	path_env = os.environ['PATH']
+	timeout = transcoder.TRANSCODE_TIMEOUT
+
+	with tempfile.TemporaryDirectory() as directory:
+		# ffmpeg заменяется скриптом, который записывает в выходной файл аргумент -b:a
+		with open(os.path.join(directory, 'ffmpeg'), 'w') as file:
+			file.write('#!/bin/sh\nsleep "${SLEEP:-0}"\nfor last; do :; done\necho "$@" > "$last"\n')
+
+		os.chmod(os.path.join(directory, 'ffmpeg'), 0o755)
+		os.environ['PATH'] = directory + os.pathsep + path_env
+
+		path = os.path.join(directory, 'with space.mp3')
+
+		try:
+			with open(path, 'w') as file:
+				file.write('original')
+
+			info = transcoder.transcode_file(path, probe.AudioInfo(320000, 'mp3', 1.0, 'mp3'), 'mp3', 128000)
+			assert info.bitrate == 128000
+
+			with open(path) as file:
+				assert '-b:a 128000' in file.read()
+
+			os.environ['SLEEP'] = '1'
+			transcoder.TRANSCODE_TIMEOUT = 0.2
+
+			try:
+				transcoder.transcode_file(path, probe.AudioInfo(320000, 'mp3', 1.0, 'mp3'), 'mp3', 96000)
+				assert False
+			except TimeoutError:
+				pass
+
+			with open(path) as file:
+				assert '-b:a 128000' in file.read()
+			
+			assert sorted(os.listdir(directory)) == ['ffmpeg', 'with space.mp3']
+
+			# Обрыв скачивания в режиме TRANSCODE_PIPELINE не оставляет ffmpeg ждать конца потока
+			with open(os.path.join(directory, 'ffmpeg'), 'w') as file:
+				file.write('#!/bin/sh\nfor last; do :; done\ncat > "$last"\n')
+
+			def broken_stream():
+				yield b'\0' * track_processor.PROBE_SIZE
+				raise ConnectionResetError('connection reset')
+
+			track = Track('url', 'title', 'author', 1)
+			track.id = -1
+			track_dir = os.path.dirname(file_manager.get_track_path(track))
+			os.makedirs(track_dir, exist_ok=True)
+			files = set(os.listdir(track_dir))
+			errors = []
+
+			def transcode():
+				try:
+					chunks = broken_stream()
+					io = track_processor.TrackIO(None)
+					run_steps(track_processor._transcode_stream_steps(track, io, lambda: next(chunks, b''), lambda size: iter(())))
+				except ConnectionResetError as ex:
+					errors.append(ex)
+
+			thread = threading.Thread(target=transcode, daemon=True)
+			thread.start()
+			thread.join(5)
+
+			assert not thread.is_alive() and len(errors) == 1
+			assert set(os.listdir(track_dir)) == files
+		
+		finally:
+			os.environ['PATH'] = path_env
+			os.environ.pop('SLEEP', None)
+			transcoder.TRANSCODE_TIMEOUT = timeout
+
+
+def test_retranscode():
+	import retranscode
+
+	tracks_dir = file_manager.TRACKS_DIR
+
+	with tempfile.TemporaryDirectory() as directory:
+		file_manager.TRACKS_DIR = directory
+		os.makedirs(os.path.join(directory, 'DB'))
+
+		try:
+			first = Track('url', 'title', 'author', 5, id=1)
+			second = Track('url', 'other title', 'author', 5, id=2)
+			missing = Track('url', 'title', 'author', 5, id=3)
+
+			_write_mp3(file_manager.get_track_path(first), 200)
+			os.link(file_manager.get_track_path(first), file_manager.get_track_path(second))
+
+			state = retranscode.State(os.path.join(directory, 'state.json'), full=False)
+			groups, done, missing_count = retranscode._group_by_file([first, second, missing], state)
+			assert groups == [[first, second]] and done == 0 and missing_count == 1
+
+			# Битрейт не выше TARGET_BITRATE, поэтому файл не сжимается, но у второго трека свои метаданные
+			results = retranscode.process_group([first, second])
+			assert [result.action for result in results] == [transcoder.SKIP, transcoder.SKIP]
+			assert results[0].digest != results[1].digest
+			assert all(result.changed for result in results)
+			assert os.path.islink(os.path.join(directory, 'author', 'author - title.mp3'))
+
+			state.set_done(first)
+			state.set_done(second)
+			state.save()
+
+			state = retranscode.State(os.path.join(directory, 'state.json'), full=False)
+			assert retranscode._group_by_file([first, second], state)[:2] == ([], 2)
+
+			state = retranscode.State(os.path.join(directory, 'state.json'), full=True)
+			assert len(retranscode._group_by_file([first, second], state)[0]) == 2
+
+			# После смены настроек файлы проверяются заново, но их сохранённые параметры можно использовать
+			with open(os.path.join(directory, 'state.json')) as file:
+				data = json.load(file)
+
+			with open(os.path.join(directory, 'state.json'), 'w') as file:
+				json.dump({ **data, 'target': 'other' }, file)
+
+			state = retranscode.State(os.path.join(directory, 'state.json'), full=False)
+			stat = os.stat(file_manager.get_track_path(first))
+			assert len(retranscode._group_by_file([first], state)[0]) == 1 and state.is_probed(first, stat)
+
+			probed = probe._stats.methods['mutagen'][0]
+			results = retranscode.process_group([first], probe.AudioInfo(128000, 'mp3', 5.0))
+			assert results[0].action == transcoder.SKIP and probe._stats.methods['mutagen'][0] == probed
+			assert not results[0].changed
+		
+		finally:
+			file_manager.TRACKS_DIR = tracks_dir
+
+
+def test_track_list_indexes():
+	assert database._escape_like_pattern('50%_a\\b') == '%50\\%\\_a\\\\b%'
+
+	# Проверка плана запроса требует PostgreSQL с расширениями pg_trgm и btree_gin
+	if os.environ.get('DB_NAME') is None:
+		print('test_track_list_indexes: skipped, DB_NAME is not set')
+		return
+
+	database.init()
+	user_id = -1
+
+	with database._cursor('test') as cursor:
+		cursor.execute("INSERT INTO users (id, name) VALUES (%s, 'test')", (user_id,))
+		cursor.execute("""INSERT INTO tracks (user_id, url, title, author, duration)
+						  SELECT %s, 'url' || i, 'title ' || i, 'author ' || (i % 100), 60 FROM generate_series(1, 20000) i""",
+					   (user_id,))
+		cursor.execute("ANALYZE tracks")
+
+		for title, author, index in (('title 1234', None, 'tracks_title_trgm_idx'), (None, 'author 42', 'tracks_author_trgm_idx')):
+			query, args = database._track_list_query(user_id, title, author)
+			cursor.execute("EXPLAIN " + query, args)
+			plan = '\n'.join(row[0] for row in cursor)
+			assert index in plan, plan
+
+		# Тестовые данные не сохраняются
+		cursor.connection.rollback()
+
+
+def test_saved_track_pools():
+	# Запись через COPY и чтение требуют PostgreSQL
+	if os.environ.get('DB_NAME') is None:
+		print('test_saved_track_pools: skipped, DB_NAME is not set')
+		return
+
+	database.init()
+	user_id = -1
+
+	def on_track_clicked(track, *_):
+		return track
+
+	with database._cursor('test') as cursor:
+		cursor.execute("INSERT INTO users (id, name) VALUES (%s, 'test') ON CONFLICT DO NOTHING", (user_id,))
+	
+	last_id, last_keynum = database.get_last_track_pool_ids()
+	Track.reserve_keynums(last_keynum)
+
+	# Треки результатов поиска ещё не скачаны, поэтому у них нет id и может не быть длительности
+	saved = [Track('url1', 'title 1', 'author', None), Track('url2', 'title 2', 'author', 60)]
+	pool = TrackPool(user_id=user_id, tracks=saved, callback=on_track_clicked, id=last_id + 1, message_id=1)
+
+	try:
+		database.save_track_pools([pool])
+		loaded = database.load_track_pool([on_track_clicked], pool.id, None)
+		assert [track.id for track in loaded.tracks] == [None, None]
+		assert loaded.tracks == saved and loaded.callback is on_track_clicked
+
+		# id трека, скачанного после записи пула, берётся из tracks
+		track_id = database.add_or_update_track(user_id, loaded.get_track(1))
+		loaded = database.load_track_pool([on_track_clicked], None, saved[1].keynum)
+		assert [track.id for track in loaded.tracks] == [None, track_id]
+	
+	finally:
+		database.delete_track_pool(pool.id)
+
+		with database._cursor('test') as cursor:
+			cursor.execute("DELETE FROM tracks WHERE user_id=%s", (user_id,))
+			cursor.execute("DELETE FROM users WHERE id=%s", (user_id,))
+
+
+def time_probe():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'track.mp3')
+		_write_mp3(path, 10000)
+
+		time1 = timeit(lambda: probe._ffprobe(path), number=20) / 20
+		time2 = timeit(lambda: probe.probe_file(path), number=20) / 20
+
+		print(f'ffprobe: {time1 * 1000:.2f} ms, mutagen: {time2 * 1000:.2f} ms, {time1 / time2:.0f}x')
+
+
+def time_track_memory():
+	count = 100000
+
+	def measure(create):
+		tracemalloc.start()
+		result = create()
+		size = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		del result
+		return size / count
+
+	def create_tracks():
+		return [Track(f'https://host/track/{i}.mp3', f'Title {i}', f'Author {i % 100}', i % 600) for i in range(count)]
+
+	list_size = measure(create_tracks)
+	pool_size = measure(lambda: TrackPool(user_id=3, callback=print, tracks=create_tracks()))
+
+	print(f'list of tracks: {list_size:.1f} bytes per track, track pool: {pool_size:.1f} bytes per track')
+
+
 if __name__ == '__main__':
 	test()
 	test_time_regex()
+	test_search_cache()
+	test_fair_queue()
+	test_webhook()
+	test_db_pool_wait()
+	test_track_pool_registry()
+	test_track_pool_columns()
+	test_track_sort()
+	test_author_normalizer()
+	test_parse_page()
+	test_search_limits()
+	test_progressive_search()
+	test_file_id_errors()
+	test_audio_store_files()
+	test_probe()
+	test_transcoder()
+	test_retranscode()
+	test_track_list_indexes()
+	test_saved_track_pools()
 	# time_command_regex()
+	# time_track_memory()
+	# time_track_sort()
+	# time_author_normalizer()
+	# time_parse_page()
+	# time_probe()
 
 	print('SUCCESS')
\ No newline at end of file